@@ -1,20 +1,23 @@
 import streamlit as st
 import requests
+import api_client
+import base64
 from io import BytesIO
 from PIL import Image
 
-API_ENDPOINT = "http://127.0.0.1:8000/generate-image/"
-HISTORY_ENDPOINT = "http://127.0.0.1:8000/image-records/"
+
+def stream_generation(prompt, neg_prompt):
+    """
+    Yields (event, data) pairs from the server-sent event stream of a generation.
+    """
+    payload = {"model": "ssd-1b", "prompt": prompt, "negative_prompt": neg_prompt}
+    yield from api_client.stream_generation(payload)
 
 
 def fetch_image_records():
     try:
-        response = requests.get(HISTORY_ENDPOINT)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            return []
-    except Exception as e:
+        return api_client.recent_records("ssd-1b")
+    except requests.RequestException as e:
         print(f"Error fetching image records: {str(e)}")
         return []
 
@@ -40,8 +43,7 @@ image_records = fetch_image_records()
 for record in image_records:
     col1, col2 = st.sidebar.columns([1, 3])
     with col1:
-        image_obj = Image.open(record["image_path"])
-        col1.image(image_obj, use_column_width=True)
+        col1.image(api_client.image_url(record, thumb=True), use_column_width=True)
     with col2:
         col2.markdown(f"**Prompt:** {record['prompt']}")
         col2.text(f"Negative Prompt: {record['negative_prompt']}")
@@ -49,21 +51,27 @@ for record in image_records:
 
 # Main UI
 if execute_button:
-    with st.spinner("Generating image..."):
-        # Make a POST request to the API
-        response = requests.post(API_ENDPOINT, json={"prompt": prompt, "negative_prompt": neg_prompt})
-
-        # Check for a valid response
-        if response.status_code == 200:
-            # Convert the response content to a PIL Image
-            image_bytes = BytesIO(response.content)
-            image_obj = Image.open(image_bytes)
-
-            # Display the image in Streamlit
-            st.image(image_obj, caption="Generated Image", use_column_width=True)
-
-        else:
-            st.error(f"Failed to generate image. API responded with: {response.text}")
+    # Show progress and latent previews while the image is being generated
+    progress_bar = st.progress(0, text="Waiting in queue...")
+    image_placeholder = st.empty()
+    try:
+        for event, data in stream_generation(prompt, neg_prompt):
+            if event == "progress" and data.get("total_steps"):
+                progress_bar.progress(
+                    data["step"] / data["total_steps"],
+                    text=f"Step {data['step']} of {data['total_steps']}"
+                )
+            elif event == "preview":
+                image_obj = Image.open(BytesIO(base64.b64decode(data["image"])))
+                image_placeholder.image(image_obj, caption="Preview", use_column_width=True)
+            elif event == "done":
+                progress_bar.progress(1.0, text="Done")
+                image_obj = Image.open(BytesIO(base64.b64decode(data["image"])))
+                image_placeholder.image(image_obj, caption="Generated Image", use_column_width=True)
+            elif event == "error":
+                st.error(f"Failed to generate image. API responded with: {data['detail']}")
+    except Exception as e:
+        st.error(f"Failed to generate image. API responded with: {str(e)}")
 
 
 
@@ -0,0 +1,199 @@
+from contextlib import contextmanager
+import threading
+import torch
+
+
+# Memory-saving levels, from the fast path to the most frugal. Each level keeps the
+# optimizations of the ones before it.
+FAST = "fast"
+ATTENTION_SLICING = "attention_slicing"
+VAE_SLICING = "vae_slicing"
+VAE_TILING = "vae_tiling"
+CPU_OFFLOAD = "sequential_cpu_offload"
+LEVELS = (FAST, ATTENTION_SLICING, VAE_SLICING, VAE_TILING, CPU_OFFLOAD)
+
+# SDXL pipelines default to 1024x1024 when a request gives no size
+DEFAULT_RESOLUTION = 1024
+
+# Rough fp16 activation peaks per output pixel of one image, with classifier-free guidance
+UNET_BYTES_PER_PIXEL = 4096
+VAE_BYTES_PER_PIXEL = 3072
+# Attention slicing roughly halves the UNet peak, VAE tiling decodes 512x512 tiles
+SLICED_UNET_FACTOR = 0.5
+VAE_TILE_PIXELS = 512 * 512
+
+
+class MemoryBudgetError(Exception):
+    """
+    Raised when a request would not fit the device even with every memory-saving fallback.
+    """
+
+
+def is_out_of_memory(error):
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in str(error).lower()
+
+
+class AdmissionController:
+    """
+    Estimates the peak activation memory of a pipeline call from its resolution and
+    batch size, and picks the fastest memory-saving level that fits what the device
+    has left after the resident weights. Estimates are scaled per model by the peaks
+    actually observed, so they tighten as the server runs.
+
+    Devices without CUDA always run the fast path.
+    """
+
+    def __init__(self, device="cuda:0", headroom_bytes=512 * 1024 * 1024):
+        self.device = torch.device(device)
+        self.headroom_bytes = headroom_bytes
+        self.enabled = self.device.type == "cuda" and torch.cuda.is_available()
+        # Observed / estimated peak ratio per model
+        self.scales = {}
+        self._lock = threading.Lock()
+
+    def estimate_bytes(self, model, params, batch_size, level=FAST):
+        width = params.get("width") or DEFAULT_RESOLUTION
+        height = params.get("height") or DEFAULT_RESOLUTION
+        pixels = width * height
+
+        unet = batch_size * pixels * UNET_BYTES_PER_PIXEL
+        if LEVELS.index(level) >= LEVELS.index(ATTENTION_SLICING):
+            unet *= SLICED_UNET_FACTOR
+
+        # VAE slicing decodes one image at a time, tiling bounds the size of each decode
+        vae_images = batch_size if LEVELS.index(level) < LEVELS.index(VAE_SLICING) else 1
+        vae_pixels = min(pixels, VAE_TILE_PIXELS) if LEVELS.index(level) >= LEVELS.index(VAE_TILING) else pixels
+        vae = vae_images * vae_pixels * VAE_BYTES_PER_PIXEL
+
+        # Denoising and decoding run one after the other, so the peak is the larger of the two
+        return int(max(unet, vae) * self.scales.get(model, 1.0))
+
+    def total_bytes(self):
+        return torch.cuda.get_device_properties(self.device).total_memory - self.headroom_bytes
+
+    def available_bytes(self):
+        return self.total_bytes() - torch.cuda.memory_allocated(self.device)
+
+    def check(self, model, params):
+        """
+        Rejects a request that cannot fit even with weights offloaded and every fallback on.
+        """
+        if not self.enabled:
+            return
+        needed = self.estimate_bytes(model, params, 1, CPU_OFFLOAD)
+        if needed > self.total_bytes():
+            raise MemoryBudgetError(
+                f"Request needs about {needed // (1024 * 1024)} MB of device memory, "
+                f"more than the {self.total_bytes() // (1024 * 1024)} MB available."
+            )
+
+    def plan(self, model, params, batch_size, evict=None):
+        """
+        Returns the fastest level at which the call fits the memory the device has left.
+        When the fast path does not fit, `evict()` is called first to move other models
+        off the device, for as long as it finds one, and the call only runs slower if
+        it still does not fit.
+        """
+        if not self.enabled:
+            return FAST
+        needed = self.estimate_bytes(model, params, batch_size, FAST)
+        while evict is not None and needed > self.available_bytes() and evict():
+            pass
+        available = self.available_bytes()
+        for level in LEVELS[:-1]:
+            if self.estimate_bytes(model, params, batch_size, level) <= available:
+                return level
+        return CPU_OFFLOAD
+
+    def max_batch_size(self, model, params, limit):
+        """
+        Largest batch up to `limit` that fits without offloading weights. A single
+        job is always admitted, the fallbacks take care of it.
+        """
+        if not self.enabled:
+            return limit
+        available = self.available_bytes()
+        batch_size = limit
+        while batch_size > 1 and self.estimate_bytes(model, params, batch_size, VAE_TILING) > available:
+            batch_size -= 1
+        return batch_size
+
+    def record(self, model, params, batch_size, level, peak_bytes):
+        """
+        Folds an observed activation peak into the model's estimate scale.
+        """
+        estimate = self.estimate_bytes(model, params, batch_size, level) / self.scales.get(model, 1.0)
+        if estimate <= 0 or level == CPU_OFFLOAD:
+            return
+        with self._lock:
+            observed = peak_bytes / estimate
+            previous = self.scales.get(model)
+            # Move quickly towards larger peaks and slowly towards smaller ones
+            if previous is None or observed > previous:
+                self.scales[model] = observed
+            else:
+                self.scales[model] = 0.9 * previous + 0.1 * observed
+
+    @contextmanager
+    def measure(self, model, params, batch_size, level):
+        """
+        Tracks the activation peak of one pipeline call and records it.
+        """
+        if not self.enabled:
+            yield
+            return
+        baseline = torch.cuda.memory_allocated(self.device)
+        torch.cuda.reset_peak_memory_stats(self.device)
+        yield
+        self.record(model, params, batch_size, level, torch.cuda.max_memory_allocated(self.device) - baseline)
+
+    def raise_scale(self, model, factor=1.25):
+        # An out-of-memory error means the estimate was too low
+        with self._lock:
+            self.scales[model] = self.scales.get(model, 1.0) * factor
+
+    def stats(self):
+        if not self.enabled:
+            return {"enabled": False}
+        return {
+            "enabled": True,
+            "total_bytes": self.total_bytes(),
+            "available_bytes": self.available_bytes(),
+            "headroom_bytes": self.headroom_bytes,
+            "scales": dict(self.scales),
+        }
+
+
+@contextmanager
+def memory_level(pipeline, level, device):
+    """
+    Turns on the memory-saving options of `level` for one call and restores the fast path after.
+    Pipelines without an option (e.g. test stand-ins) simply skip it.
+    """
+    index = LEVELS.index(level)
+    enabled = []
+
+    def enable(name, *args, **kwargs):
+        method = getattr(pipeline, f"enable_{name}", None)
+        if method is not None:
+            method(*args, **kwargs)
+            enabled.append(name)
+
+    try:
+        if index >= LEVELS.index(ATTENTION_SLICING):
+            enable("attention_slicing")
+        if index >= LEVELS.index(VAE_SLICING):
+            enable("vae_slicing")
+        if index >= LEVELS.index(VAE_TILING):
+            enable("vae_tiling")
+        if index >= LEVELS.index(CPU_OFFLOAD):
+            enable("sequential_cpu_offload", device=device)
+        yield level
+    finally:
+        for name in reversed(enabled):
+            if name == "sequential_cpu_offload":
+                # Dropping the offload hooks puts the weights back where they were, then on the device
+                pipeline.remove_all_hooks()
+                pipeline.to(device)
+            else:
+                getattr(pipeline, f"disable_{name}")()
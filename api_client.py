@@ -0,0 +1,243 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+import threading
+import requests
+import json
+import time
+import os
+
+
+# Shared by the Streamlit pages. Streamlit reruns a page script on every interaction but
+# imports modules once per process, so the session, cache and prefetch pool below are
+# shared by every rerun and every page.
+API_URL = os.environ.get("SSD_API_URL", "http://127.0.0.1:8000").rstrip("/")
+
+# How long history and database info responses are reused before they are fetched again.
+# Anything the UI changes (generations, imports, clearing) invalidates them right away.
+CACHE_TTL_SECONDS = float(os.environ.get("SSD_UI_CACHE_TTL_SECONDS", "30"))
+
+# Thumbnails of upcoming history pages fetched in the background, and how many are kept
+PREFETCH_WORKERS = int(os.environ.get("SSD_UI_PREFETCH_WORKERS", "8"))
+THUMBNAIL_CACHE_ENTRIES = int(os.environ.get("SSD_UI_THUMBNAIL_CACHE_ENTRIES", "500"))
+
+# Generations can take a while; everything else should answer quickly
+REQUEST_TIMEOUT_SECONDS = 30
+GENERATION_TIMEOUT_SECONDS = 600
+
+
+def make_session():
+    # Keep-alive connections are reused across reruns, and the pool is large enough for the prefetch threads
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=PREFETCH_WORKERS + 4)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+session = make_session()
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="ui-prefetch")
+
+
+class ResponseCache:
+    """
+    Keeps decoded JSON responses for `ttl` seconds, keyed by path and query parameters.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self):
+        with self._lock:
+            self.entries.clear()
+
+
+response_cache = ResponseCache(CACHE_TTL_SECONDS)
+
+# Thumbnail bytes by URL, or the future fetching them, least recently used first
+thumbnails = OrderedDict()
+thumbnails_lock = threading.Lock()
+
+
+def url(path):
+    return f"{API_URL}{path}"
+
+
+def get_json(path, params=None, cache=True):
+    """
+    GETs a JSON response through the shared session, reusing a cached one while it is fresh.
+    Raises `requests.HTTPError` on error responses, which are never cached.
+    """
+    params = {key: value for key, value in (params or {}).items() if value is not None}
+    key = (path, tuple(sorted(params.items())))
+    if cache:
+        value = response_cache.get(key)
+        if value is not None:
+            return value
+    response = session.get(url(path), params=params, timeout=REQUEST_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    value = response.json()
+    if cache:
+        response_cache.put(key, value)
+    return value
+
+
+def invalidate():
+    # Called after anything that adds or removes records
+    response_cache.invalidate()
+
+
+def image_id(record):
+    return os.path.splitext(os.path.basename(record["image_path"]))[0]
+
+
+def image_url(record, thumb=False):
+    """
+    Builds the API URL of a record's image; the browser fetches it directly.
+    """
+    if thumb:
+        return url(f"/images/{image_id(record)}/thumb")
+    return url(f"/images/{image_id(record)}")
+
+
+#===================================================================================================
+############### READS ###############
+#===================================================================================================
+
+
+def history_page(cursor=None, limit=50, model=None):
+    return get_json("/history/", {"limit": limit, "cursor": cursor, "model": model})
+
+
+def recent_records(model):
+    # The few newest records shown in the sidebars of the generation pages
+    path = "/image-records/" if model == "ssd-1b" else "/sdxl-records/"
+    return get_json(path)
+
+
+def database_info():
+    return get_json("/database-info/")
+
+
+def fetch_thumbnail(thumbnail_url):
+    response = session.get(thumbnail_url, timeout=REQUEST_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    return response.content
+
+
+def prefetch_thumbnails(records):
+    """
+    Starts fetching the thumbnails of records in the background, skipping those already fetched.
+    """
+    with thumbnails_lock:
+        for record in records:
+            thumbnail_url = image_url(record, thumb=True)
+            if thumbnail_url in thumbnails:
+                thumbnails.move_to_end(thumbnail_url)
+                continue
+            thumbnails[thumbnail_url] = prefetch_executor.submit(fetch_thumbnail, thumbnail_url)
+        while len(thumbnails) > THUMBNAIL_CACHE_ENTRIES:
+            thumbnails.popitem(last=False)
+
+
+def prefetch_history_page(cursor, limit=50, model=None):
+    """
+    Fetches the next history page and its thumbnails in the background, so moving to it is instant.
+    """
+    def prefetch():
+        page = history_page(cursor, limit, model)
+        prefetch_thumbnails(page["records"])
+
+    return prefetch_executor.submit(prefetch)
+
+
+def thumbnail(record):
+    """
+    Returns a record's thumbnail bytes if they were prefetched, otherwise its URL for the browser to load.
+    """
+    thumbnail_url = image_url(record, thumb=True)
+    with thumbnails_lock:
+        future = thumbnails.get(thumbnail_url)
+        if future is not None:
+            thumbnails.move_to_end(thumbnail_url)
+    if future is None or not future.done() or future.exception() is not None:
+        return thumbnail_url
+    return future.result()
+
+
+#===================================================================================================
+############### WRITES ###############
+#===================================================================================================
+
+
+def stream_generation(payload):
+    """
+    Yields (event, data) pairs from the server-sent event stream of a generation.
+    """
+    try:
+        with session.post(url("/generate-stream/"), json=payload, stream=True,
+                          timeout=GENERATION_TIMEOUT_SECONDS) as response:
+            response.raise_for_status()
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    yield event, json.loads(line[len("data: "):])
+    finally:
+        invalidate()
+
+
+def generate_sdxl(prompt):
+    """
+    Generates an SDXL image, returning the response with the raw image bytes.
+    """
+    try:
+        return session.post(url("/sdxl-gen/"), data=prompt, headers={"Content-Type": "text/plain"},
+                            timeout=GENERATION_TIMEOUT_SECONDS)
+    finally:
+        invalidate()
+
+
+def clear_database():
+    try:
+        return session.post(url("/clear-database/"), timeout=REQUEST_TIMEOUT_SECONDS)
+    finally:
+        invalidate()
+
+
+def import_records(records):
+    try:
+        return session.post(url("/import-records/"), json=records, timeout=REQUEST_TIMEOUT_SECONDS)
+    finally:
+        invalidate()
+
+
+def import_records_stream(uploaded_file):
+    # Imports can be large, so the file is streamed and there is no read timeout
+    try:
+        return session.post(url("/import-records-stream/"), data=uploaded_file,
+                            headers={"Content-Type": "application/x-ndjson"})
+    finally:
+        invalidate()
+
+
+def export_url():
+    return url("/export-records/")
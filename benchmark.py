@@ -0,0 +1,293 @@
+"""
+Load-test the API with a fake pipeline, no GPU or model weights needed.
+
+The real pipelines are swapped for a stub that spends a fixed time (or CPU work)
+per denoising step and returns tiny random images, and N concurrent clients drive
+the generate, history and info endpoints. Throughput and latency percentiles are
+reported as JSON so runs can be compared between commits:
+
+    python benchmark.py --clients 16 --duration 30 --step-ms 20 --output bench.json
+"""
+from types import SimpleNamespace
+from PIL import Image
+import argparse
+import tempfile
+import asyncio
+import random
+import json
+import math
+import time
+import os
+
+
+class FakeScheduler:
+    """
+    Stands in for the pipeline's scheduler, so per-request schedulers can be built from its config.
+    """
+
+    def __init__(self, **config):
+        # SDXL's EulerDiscreteScheduler settings
+        self.config = {
+            "num_train_timesteps": 1000,
+            "beta_start": 0.00085,
+            "beta_end": 0.012,
+            "beta_schedule": "scaled_linear",
+            "prediction_type": "epsilon",
+            "timestep_spacing": "leading",
+            "steps_offset": 1,
+            **config,
+        }
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        return cls(**dict(config, **kwargs))
+
+
+class FakeVAE:
+    """
+    Stands in for the pipeline's VAE: decodes any latents to random pixels in [-1, 1].
+    """
+
+    def __init__(self, torch, image_size):
+        self.torch = torch
+        self.image_size = image_size
+        self.dtype = torch.float32
+        self.device = torch.device("cpu")
+        self.config = SimpleNamespace(force_upcast=False, scaling_factor=0.13025)
+        self.post_quant_conv = torch.nn.Conv2d(4, 4, 1)
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def decode(self, latents, return_dict=True):
+        image = self.torch.rand(latents.shape[0], 3, self.image_size, self.image_size) * 2 - 1
+        return (image,) if not return_dict else SimpleNamespace(sample=image)
+
+
+class FakeImageProcessor:
+    """
+    Turns decoded (batch, 3, height, width) pixels in [-1, 1] into PIL images.
+    """
+
+    def postprocess(self, image, output_type="pil"):
+        pixels = ((image / 2 + 0.5).clamp(0, 1) * 255).round().byte().permute(0, 2, 3, 1).numpy()
+        return [Image.fromarray(array) for array in pixels]
+
+
+class FakePipeline:
+    """
+    Stands in for StableDiffusionXLPipeline: same call signature, no weights. Its
+    scheduler and VAE are stand-ins too, so scheduler swaps and latent decodes run.
+    """
+
+    def __init__(self, step_ms=20.0, step_mode="sleep", image_size=64, steps=50):
+        import torch
+        self.torch = torch
+        self.step_ms = step_ms
+        self.step_mode = step_mode
+        self.image_size = image_size
+        self.default_steps = steps
+        self.device = torch.device("cpu")
+        self.components = {}
+        self.num_timesteps = None
+        self.scheduler = FakeScheduler()
+        self.vae = FakeVAE(torch, image_size)
+        self.image_processor = FakeImageProcessor()
+
+    def to(self, device):
+        return self
+
+    def encode_prompt(self, prompt, device=None, num_images_per_prompt=1,
+                      do_classifier_free_guidance=True, negative_prompt=None, **kwargs):
+        # Tiny tensors shaped like the real (batch, tokens, dim) and (batch, dim) outputs
+        torch = self.torch
+        return (
+            torch.randn(1, 77, 8),
+            torch.randn(1, 77, 8),
+            torch.randn(1, 8),
+            torch.randn(1, 8),
+        )
+
+    def _step(self):
+        if self.step_mode == "cpu":
+            # Busy work roughly proportional to step_ms
+            deadline = time.perf_counter() + self.step_ms / 1000.0
+            matrix = self.torch.randn(64, 64)
+            while time.perf_counter() < deadline:
+                matrix = matrix @ matrix
+                matrix = matrix / matrix.norm()
+        else:
+            time.sleep(self.step_ms / 1000.0)
+
+    def __call__(self, prompt=None, prompt_embeds=None, num_inference_steps=None,
+                 callback_on_step_end=None, output_type="pil", **kwargs):
+        if prompt_embeds is not None:
+            batch_size = prompt_embeds.shape[0]
+        elif isinstance(prompt, list):
+            batch_size = len(prompt)
+        else:
+            batch_size = 1
+
+        steps = num_inference_steps or self.default_steps
+        self.num_timesteps = steps
+        latents = self.torch.randn(batch_size, 4, 8, 8)
+        for step in range(steps):
+            self._step()
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, steps - step, {"latents": latents})
+
+        if output_type == "latent":
+            # Latent-first requests get the final latents, like the real pipeline
+            return SimpleNamespace(images=latents)
+        images = [
+            Image.effect_noise((self.image_size, self.image_size), 64).convert("RGB")
+            for _ in range(batch_size)
+        ]
+        return SimpleNamespace(images=images)
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))
+    return values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": latencies[-1] if latencies else None,
+    }
+
+
+# (name, method, path, payload builder) for each kind of request a client makes
+def build_scenarios(prompts):
+    return {
+        "generate": ("POST", "/generate-image/", lambda: {
+            "prompt": random.choice(prompts),
+            "negative_prompt": "ugly, blurry, poor quality",
+        }),
+        "history": ("GET", "/history/?limit=50", None),
+        "recent": ("GET", "/image-records/", None),
+        "info": ("GET", "/database-info/", None),
+    }
+
+
+async def run_client(client, scenarios, weights, deadline, results):
+    names = list(weights)
+    while time.perf_counter() < deadline:
+        name = random.choices(names, weights=[weights[n] for n in names])[0]
+        method, path, payload = scenarios[name]
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, path, json=payload() if payload else None)
+            ok = response.status_code < 400
+        except Exception:
+            ok = False
+        latency_ms = (time.perf_counter() - start) * 1000.0
+        if ok:
+            results[name]["latencies"].append(latency_ms)
+        else:
+            results[name]["errors"] += 1
+
+
+async def run_benchmark(args):
+    import httpx
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+        app_module = None
+    else:
+        # Configure the API before importing it: throwaway database and image store, CPU device
+        work_dir = tempfile.mkdtemp(prefix="ssd-bench-")
+        os.environ.setdefault("SSD_DATABASE_URL", f"sqlite:///{os.path.join(work_dir, 'bench.db')}")
+        os.environ.setdefault("SSD_STORAGE_ROOT", os.path.join(work_dir, "images"))
+        os.environ.setdefault("SSD_DEVICE", "cpu")
+        import api as app_module
+
+        app_module.Base.metadata.create_all(bind=app_module.engine)
+        for entry in app_module.registry.entries.values():
+            entry.loader = lambda: FakePipeline(args.step_ms, args.step_mode, args.image_size, args.steps)
+        await app_module.startup()
+        transport = httpx.ASGITransport(app=app_module.app)
+        client = httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=args.timeout)
+
+    prompts = [f"benchmark prompt {i}" for i in range(args.distinct_prompts)]
+    scenarios = build_scenarios(prompts)
+    weights = {
+        "generate": args.generate_weight,
+        "history": args.history_weight,
+        "recent": args.history_weight,
+        "info": args.info_weight,
+    }
+    weights = {name: weight for name, weight in weights.items() if weight > 0}
+    results = {name: {"latencies": [], "errors": 0} for name in weights}
+
+    try:
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*[
+            run_client(client, scenarios, weights, deadline, results) for _ in range(args.clients)
+        ])
+        elapsed = time.perf_counter() - start
+    finally:
+        await client.aclose()
+        if app_module is not None:
+            await app_module.shutdown()
+
+    all_latencies = [latency for result in results.values() for latency in result["latencies"]]
+    return {
+        "config": {
+            "clients": args.clients,
+            "duration_s": args.duration,
+            "step_ms": args.step_ms,
+            "step_mode": args.step_mode,
+            "steps": args.steps,
+            "target": args.url or "in-process",
+        },
+        "elapsed_s": elapsed,
+        "overall": summarize(all_latencies, sum(result["errors"] for result in results.values()), elapsed),
+        "endpoints": {
+            name: summarize(result["latencies"], result["errors"], elapsed)
+            for name, result in results.items()
+        },
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load-test the SSD-1B API with a fake pipeline.")
+    parser.add_argument("--url", help="Benchmark a running server instead of an in-process app with a fake pipeline")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to run")
+    parser.add_argument("--step-ms", type=float, default=20.0, help="Fake pipeline time per denoising step")
+    parser.add_argument("--step-mode", choices=["sleep", "cpu"], default="sleep", help="Sleep or burn CPU per step")
+    parser.add_argument("--steps", type=int, default=25, help="Fake pipeline denoising steps per image")
+    parser.add_argument("--image-size", type=int, default=64, help="Fake image width and height")
+    parser.add_argument("--distinct-prompts", type=int, default=20, help="Number of distinct prompts to draw from")
+    parser.add_argument("--generate-weight", type=float, default=1.0, help="Relative share of generate requests")
+    parser.add_argument("--history-weight", type=float, default=2.0, help="Relative share of history requests")
+    parser.add_argument("--info-weight", type=float, default=1.0, help="Relative share of info requests")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout in seconds")
+    parser.add_argument("--output", help="Write the JSON report to this file as well")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    report = asyncio.run(run_benchmark(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
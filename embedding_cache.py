@@ -0,0 +1,152 @@
+from collections import OrderedDict
+import threading
+import torch
+
+
+# Pipelines that share these text encoders produce the same embeddings
+TEXT_ENCODER_NAMES = ("text_encoder", "text_encoder_2")
+
+
+def tensor_bytes(tensor):
+    return tensor.element_size() * tensor.nelement()
+
+
+def encoder_key(pipeline):
+    """
+    Identifies the text encoders of a pipeline; one without them stands for its own.
+    """
+    return tuple(id(getattr(pipeline, name, pipeline)) for name in TEXT_ENCODER_NAMES)
+
+
+def combine_stats(stats):
+    """
+    Adds up the `PromptEmbeddingCache.stats()` of several caches, e.g. one per device.
+    """
+    combined = {
+        name: sum(cache_stats[name] for cache_stats in stats)
+        for name in ("entries", "max_entries", "bytes", "max_bytes", "hits", "misses", "evictions")
+    }
+    lookups = combined["hits"] + combined["misses"]
+    combined["hit_rate"] = combined["hits"] / lookups if lookups else 0.0
+    return combined
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of SDXL `encode_prompt` outputs, bounded by entry count and bytes.
+
+    Entries are keyed by (encoder_key(pipeline), prompt, negative_prompt) and hold the
+    prompt embeds, pooled embeds and their negative counterparts for a single prompt, so
+    a repeated prompt or negative prompt costs no text encoder passes, whichever of the
+    models sharing those text encoders it was first encoded for.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry["embeds"]
+
+    def put(self, key, embeds):
+        size = sum(tensor_bytes(tensor) for tensor in embeds)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)["bytes"]
+            self.entries[key] = {"embeds": embeds, "bytes": size}
+            self.total_bytes += size
+            # Evict least recently used entries until both bounds hold
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted["bytes"]
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Drops every entry.
+        """
+        with self._lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def release(self, pipelines):
+        """
+        Drops the entries of text encoders that none of `pipelines`, the ones still loaded,
+        uses. Their keys could otherwise match encoders later loaded at the same address.
+        """
+        keep = {encoder_key(pipeline) for pipeline in pipelines}
+        with self._lock:
+            for key in list(self.entries):
+                if key[0] not in keep:
+                    self.total_bytes -= self.entries.pop(key)["bytes"]
+
+    def encode(self, pipeline, prompt, negative_prompt=None):
+        """
+        Returns the (prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds,
+        negative_pooled_prompt_embeds) tuple for one prompt, encoding it on a miss.
+        """
+        key = (encoder_key(pipeline), prompt, negative_prompt)
+        embeds = self.get(key)
+        if embeds is None:
+            with torch.no_grad():
+                embeds = pipeline.encode_prompt(
+                    prompt=prompt,
+                    device=pipeline.device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=True,
+                    negative_prompt=negative_prompt,
+                )
+            embeds = tuple(tensor.detach() for tensor in embeds)
+            self.put(key, embeds)
+        return embeds
+
+    def encode_batch(self, pipeline, prompts, negative_prompts=None):
+        """
+        Builds the `prompt_embeds` keyword arguments for a list-of-prompts pipeline call.
+        """
+        if negative_prompts is None:
+            negative_prompts = [None] * len(prompts)
+
+        per_prompt = [
+            self.encode(pipeline, prompt, negative_prompt)
+            for prompt, negative_prompt in zip(prompts, negative_prompts)
+        ]
+        # Cached tensors may live on another device if the pipeline was moved since
+        prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = (
+            torch.cat([embeds[i] for embeds in per_prompt]).to(pipeline.device) for i in range(4)
+        )
+        return {
+            "prompt_embeds": prompt_embeds,
+            "negative_prompt_embeds": negative_prompt_embeds,
+            "pooled_prompt_embeds": pooled_prompt_embeds,
+            "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds,
+        }
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
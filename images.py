@@ -0,0 +1,182 @@
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from PIL import Image
+import io
+import os
+
+
+# Generated images never change once written, so clients may cache them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Except the preview thumbnails of latent-first images, replaced once the image is decoded
+PREVIEW_CACHE_CONTROL = "no-cache"
+
+
+def thumbnail_key(key, size):
+    """
+    Thumbnails are stored next to the original, e.g. 3f/a2/<id>_thumb_256.jpg.
+    """
+    root, _ = os.path.splitext(key)
+    return f"{root}_thumb_{size}.jpg"
+
+
+def encode_thumbnail(image, size, quality=80):
+    thumbnail = image.copy()
+    thumbnail.thumbnail((size, size), Image.LANCZOS)
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def save_thumbnails(storage, image, key, sizes):
+    """
+    Writes one thumbnail per size alongside the original image.
+    """
+    keys = []
+    for size in sizes:
+        keys.append(thumbnail_key(key, size))
+        storage.put(keys[-1], encode_thumbnail(image, size))
+    return keys
+
+
+def ensure_thumbnail(storage, key, size):
+    """
+    Returns the thumbnail key, building it from the original for images saved before thumbnails existed.
+    """
+    thumb_key = thumbnail_key(key, size)
+    if not storage.exists(thumb_key):
+        with Image.open(io.BytesIO(storage.get(key))) as image:
+            storage.put(thumb_key, encode_thumbnail(image.convert("RGB"), size))
+    return thumb_key
+
+
+def file_etag(path, stat_result):
+    # Strong validator: files are written once under a unique name
+    name = os.path.basename(path)
+    return f'"{name}-{stat_result.st_size}-{stat_result.st_mtime_ns}"'
+
+
+def object_etag(key, size):
+    # Strong validator of a remote object, computable from its size alone
+    return f'"{os.path.basename(key)}-{size}"'
+
+
+def cache_headers(etag, cache_control=IMMUTABLE_CACHE_CONTROL):
+    return {
+        "ETag": etag,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+
+
+def is_not_modified(request, etag):
+    if_none_match = request.headers.get("if-none-match")
+    return bool(if_none_match) and (
+        if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+    )
+
+
+def parse_range(range_header, file_size):
+    """
+    Parses a single `bytes=start-end` range, returning (start, end) inclusive or None if unusable.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start, _, end = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start == "":
+            # Suffix range: the last N bytes
+            length = int(end)
+            if length <= 0:
+                return None
+            return max(0, file_size - length), file_size - 1
+        start = int(start)
+        end = int(end) if end else file_size - 1
+    except ValueError:
+        return None
+    if start > end or start >= file_size:
+        return None
+    return start, min(end, file_size - 1)
+
+
+def iter_file_range(path, start, end, chunk_size=64 * 1024):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def image_file_response(request, path, media_type="image/jpeg", cache_control=IMMUTABLE_CACHE_CONTROL):
+    """
+    Serves an image file with a strong ETag, long-lived Cache-Control, conditional GET
+    and single byte-range support. Full responses go through FileResponse, which sends
+    the file without copying it through Python when the server supports it.
+    """
+    stat_result = os.stat(path)
+    etag = file_etag(path, stat_result)
+    headers = cache_headers(etag, cache_control)
+
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if range_header:
+        # A stale If-Range validator means the client must get the whole file
+        if_range = request.headers.get("if-range")
+        if if_range is None or if_range.strip() == etag:
+            byte_range = parse_range(range_header, stat_result.st_size)
+            if byte_range is None:
+                headers["Content-Range"] = f"bytes */{stat_result.st_size}"
+                return Response(status_code=416, headers=headers)
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(
+                iter_file_range(path, start, end), status_code=206, media_type=media_type, headers=headers
+            )
+
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat_result)
+
+
+def image_bytes_response(request, key, data, media_type="image/jpeg", cache_control=IMMUTABLE_CACHE_CONTROL):
+    """
+    Serves image bytes fetched from a remote storage backend with the same caching headers
+    and conditional GET / byte-range handling as local files.
+    """
+    etag = object_etag(key, len(data))
+    headers = cache_headers(etag, cache_control)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        byte_range = parse_range(range_header, len(data))
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{len(data)}"
+            return Response(status_code=416, headers=headers)
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        return Response(content=data[start:end + 1], status_code=206, media_type=media_type, headers=headers)
+
+    return Response(content=data, media_type=media_type, headers=headers)
+
+
+async def storage_response(request, storage, key, media_type="image/jpeg", cache_control=IMMUTABLE_CACHE_CONTROL):
+    """
+    Serves a stored image, sending local files without copying them through Python.
+    """
+    path = storage.local_path(key)
+    if path is not None:
+        return image_file_response(request, path, media_type, cache_control)
+    if request.headers.get("if-none-match"):
+        # Revalidating needs only the object's size, a HEAD rather than a download
+        etag = object_etag(key, await run_in_threadpool(storage.size, key))
+        if is_not_modified(request, etag):
+            return Response(status_code=304, headers=cache_headers(etag, cache_control))
+    data = await run_in_threadpool(storage.get, key)
+    return image_bytes_response(request, key, data, media_type, cache_control)
@@ -0,0 +1,332 @@
+from sqlalchemy import select, and_, desc, func
+from worker import Job, JobCancelledError, QUEUED, RUNNING, COMPLETED, FAILED, CANCELLED
+from records import GenerationJobRecord
+from output import media_type, format_from_path
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import asyncio
+import json
+import uuid
+
+
+jobs_table = GenerationJobRecord.__table__
+
+FINISHED = (COMPLETED, FAILED, CANCELLED)
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+def epoch(value):
+    # SQLite hands timestamps back without their timezone; they are stored in UTC
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+class DurableJobQueue:
+    """
+    Generation jobs kept in the database, so API nodes and GPU workers scale
+    independently: any node can enqueue, and any number of queue workers claim
+    jobs with `SELECT ... FOR UPDATE SKIP LOCKED`, never blocking on each other.
+
+    A claimed job is leased to its worker for `lease_seconds` and the lease is
+    extended by heartbeats. Once a lease expires, because its worker crashed or
+    hung, the job goes back to the queue for another worker, until it has been
+    tried `max_attempts` times. Timestamps come from the clocks of the nodes, which
+    are expected to be in sync to well within a lease.
+
+    PostgreSQL is the production backend. SQLite works as a local stand-in: it
+    ignores the locking clause, but runs one write at a time, so claims stay atomic.
+    """
+
+    def __init__(self, database, lease_seconds=60, max_attempts=3):
+        self.database = database
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    async def enqueue(self, model, params, output, cache_key=None, priority=0, deadline=None, job_id=None):
+        """
+        Adds a job to the queue; `deadline` is an absolute time.time().
+        """
+        values = {
+            "id": job_id or str(uuid.uuid4()),
+            "model": model,
+            "params": json.dumps(params),
+            "output": json.dumps(output),
+            "cache_key": cache_key,
+            "priority": priority,
+            "deadline": datetime.fromtimestamp(deadline, timezone.utc) if deadline is not None else None,
+            "status": QUEUED,
+            "attempts": 0,
+            "max_attempts": self.max_attempts,
+            "created_at": utcnow(),
+        }
+        await self.database.execute(jobs_table.insert().values(**values))
+        return values["id"]
+
+    async def get(self, job_id):
+        row = await self.database.fetch_one(jobs_table.select().where(jobs_table.c.id == job_id))
+        return self.decode(row) if row is not None else None
+
+    async def get_many(self, job_ids):
+        if not job_ids:
+            return []
+        rows = await self.database.fetch_all(jobs_table.select().where(jobs_table.c.id.in_(list(job_ids))))
+        return [self.decode(row) for row in rows]
+
+    async def stats(self):
+        """
+        Number of waiting jobs, and of running jobs by worker.
+        """
+        query = select([jobs_table.c.status, jobs_table.c.worker_id, func.count().label("jobs")]).where(
+            jobs_table.c.status.in_([QUEUED, RUNNING])
+        ).group_by(jobs_table.c.status, jobs_table.c.worker_id)
+        queued = 0
+        workers = {}
+        for row in await self.database.fetch_all(query):
+            if row["status"] == QUEUED:
+                queued += row["jobs"]
+            else:
+                workers[row["worker_id"]] = row["jobs"]
+        return {"queued": queued, "running": workers}
+
+    async def claim(self, worker_id, models, limit=1):
+        """
+        Leases up to `limit` of the highest priority waiting jobs of the given models to a worker.
+        """
+        await self.expire()
+        now = utcnow()
+        token = str(uuid.uuid4())
+        # Rows another worker is claiming right now are skipped rather than waited for
+        candidates = select([jobs_table.c.id]).where(and_(
+            jobs_table.c.status == QUEUED,
+            jobs_table.c.model.in_(list(models)),
+        )).order_by(
+            desc(jobs_table.c.priority), jobs_table.c.created_at
+        ).limit(limit).with_for_update(skip_locked=True)
+        await self.database.execute(jobs_table.update().where(and_(
+            jobs_table.c.id.in_(candidates),
+            jobs_table.c.status == QUEUED,
+        )).values(
+            status=RUNNING,
+            worker_id=worker_id,
+            claim_token=token,
+            lease_expires_at=now + timedelta(seconds=self.lease_seconds),
+            attempts=jobs_table.c.attempts + 1,
+            started_at=now,
+        ))
+        rows = await self.database.fetch_all(
+            jobs_table.select().where(jobs_table.c.claim_token == token).order_by(
+                desc(jobs_table.c.priority), jobs_table.c.created_at
+            )
+        )
+        return [self.decode(row) for row in rows]
+
+    async def expire(self):
+        """
+        Cancels waiting jobs past their deadline and returns jobs with expired leases to the queue,
+        failing those that are out of attempts.
+        """
+        now = utcnow()
+        await self.database.execute(jobs_table.update().where(and_(
+            jobs_table.c.status == QUEUED,
+            jobs_table.c.deadline < now,
+        )).values(status=CANCELLED, error="Job was not started before its deadline.", finished_at=now))
+
+        expired = and_(jobs_table.c.status == RUNNING, jobs_table.c.lease_expires_at < now)
+        # A job that keeps taking its worker down is given up on
+        await self.database.execute(jobs_table.update().where(and_(
+            expired,
+            jobs_table.c.attempts >= jobs_table.c.max_attempts,
+        )).values(status=FAILED, error="Worker lease expired on the last attempt.", finished_at=now))
+        await self.database.execute(jobs_table.update().where(expired).values(
+            status=QUEUED, worker_id=None, claim_token=None, lease_expires_at=None
+        ))
+
+    async def heartbeat(self, worker_id, job_ids):
+        """
+        Extends the leases of a worker's jobs. Returns the ids of those it no longer holds,
+        because they were cancelled or their lease expired and another worker took them.
+        """
+        if not job_ids:
+            return set()
+        held = and_(
+            jobs_table.c.id.in_(list(job_ids)),
+            jobs_table.c.worker_id == worker_id,
+            jobs_table.c.status == RUNNING,
+        )
+        await self.database.execute(jobs_table.update().where(held).values(
+            lease_expires_at=utcnow() + timedelta(seconds=self.lease_seconds)
+        ))
+        rows = await self.database.fetch_all(select([jobs_table.c.id]).where(held))
+        return set(job_ids) - {row["id"] for row in rows}
+
+    async def complete(self, job_id, worker_id, image_path, record=None):
+        """
+        Marks a job completed, inserting the (table, values) history record of its image in the same
+        transaction. Jobs run at least once: a worker that lost its lease still records its image.
+        """
+        async with self.database.transaction():
+            if record is not None:
+                table, values = record
+                await self.database.execute(table.insert().values(**values))
+            await self.database.execute(jobs_table.update().where(and_(
+                jobs_table.c.id == job_id,
+                jobs_table.c.worker_id == worker_id,
+                jobs_table.c.status == RUNNING,
+            )).values(status=COMPLETED, image_path=image_path, finished_at=utcnow(), lease_expires_at=None))
+
+    async def fail(self, job_id, worker_id, error):
+        """
+        Returns a failed job to the queue while it has attempts left, otherwise marks it failed.
+        """
+        held = and_(
+            jobs_table.c.id == job_id,
+            jobs_table.c.worker_id == worker_id,
+            jobs_table.c.status == RUNNING,
+        )
+        await self.database.execute(jobs_table.update().where(and_(
+            held,
+            jobs_table.c.attempts >= jobs_table.c.max_attempts,
+        )).values(status=FAILED, error=error, finished_at=utcnow(), lease_expires_at=None))
+        await self.database.execute(jobs_table.update().where(held).values(
+            status=QUEUED, error=error, worker_id=None, claim_token=None, lease_expires_at=None
+        ))
+
+    async def cancel(self, job_id, worker_id=None, error="Job was cancelled."):
+        """
+        Cancels a waiting or running job; with `worker_id`, only while that worker holds it.
+        A running job stops once its worker's next heartbeat finds it cancelled.
+        """
+        conditions = [jobs_table.c.id == job_id, jobs_table.c.status.in_([QUEUED, RUNNING])]
+        if worker_id is not None:
+            conditions.append(jobs_table.c.worker_id == worker_id)
+        await self.database.execute(jobs_table.update().where(and_(*conditions)).values(
+            status=CANCELLED, error=error, finished_at=utcnow(), lease_expires_at=None
+        ))
+
+    def decode(self, row):
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["output"] = json.loads(job["output"])
+        return job
+
+
+class DurableQueueClient:
+    """
+    Takes the place of the generation worker on API nodes that leave generation to
+    queue workers (see queue_worker.py). Jobs are enqueued in the database and a
+    local Job mirrors each one, polled until a worker finishes it; the future of a
+    completed job resolves to its result, whose image and record the worker stored.
+    """
+
+    def __init__(self, queue, models, poll_interval=0.5, max_retained_jobs=1000):
+        self.queue = queue
+        self.models = set(models)
+        self.poll_interval = poll_interval
+        self.jobs = OrderedDict()
+        self.max_retained_jobs = max_retained_jobs
+        # Last queue stats seen by the poller
+        self.stats = {"queued": 0, "running": {}}
+        self._task = None
+
+    async def submit(self, model, priority=0, client_id=None, deadline=None, output=None, cache_key=None, **params):
+        if model not in self.models:
+            raise KeyError(f"Unknown model: {model}")
+        job = Job(model, params, priority, client_id, deadline)
+        await self.queue.enqueue(model, params, output, cache_key, priority, deadline, job_id=job.id)
+        self.track(job)
+        return job
+
+    def track(self, job):
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.max_retained_jobs:
+            # Forget the oldest finished job
+            for job_id, old_job in self.jobs.items():
+                if old_job.status in FINISHED:
+                    del self.jobs[job_id]
+                    break
+            else:
+                break
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    async def load_job(self, job_id):
+        """
+        Returns the job with this id, mirroring it locally if it was submitted through another node.
+        """
+        job = self.get_job(job_id)
+        if job is not None:
+            return job
+        row = await self.queue.get(job_id)
+        if row is None:
+            return None
+        job = Job(row["model"], row["params"], row["priority"])
+        job.id = row["id"]
+        job.cache_key = row["cache_key"]
+        job.created_at = epoch(row["created_at"])
+        job.waiters = 0
+        self.update_job(job, row)
+        self.track(job)
+        return job
+
+    def cancel(self, job_id):
+        job = self.get_job(job_id)
+        if job is None:
+            return None
+        job.cancel_requested.set()
+        asyncio.ensure_future(self.queue.cancel(job_id))
+        return job
+
+    def queue_depth(self):
+        return self.stats["queued"]
+
+    def resident_bytes(self):
+        # Models live on the queue workers
+        return 0
+
+    def status(self):
+        return {"backend": "database", "queue_depth": self.stats["queued"], "workers": self.stats["running"]}
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self, timeout=None):
+        if self._task is not None:
+            self._task.cancel()
+
+    def update_job(self, job, row):
+        """
+        Copies the state of a job's row onto its local Job, resolving its future once it is finished.
+        """
+        job.status = row["status"]
+        job.error = row["error"]
+        job.started_at = epoch(row["started_at"])
+        job.finished_at = epoch(row["finished_at"])
+        if row["status"] not in FINISHED or job.future.done():
+            return
+        if row["status"] == COMPLETED:
+            job.result = {"image_key": row["image_path"], "media_type": media_type(format_from_path(row["image_path"]))}
+            job.future.set_result(job.result)
+        elif row["status"] == CANCELLED:
+            job.future.set_exception(JobCancelledError(row["error"]))
+        else:
+            job.future.set_exception(RuntimeError(row["error"]))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                waiting = [job_id for job_id, job in self.jobs.items() if not job.future.done()]
+                for row in await self.queue.get_many(waiting):
+                    job = self.jobs.get(row["id"])
+                    if job is not None:
+                        self.update_job(job, row)
+                self.stats = await self.queue.stats()
+            except Exception as e:
+                print(f"Error polling the job queue: {str(e)}")
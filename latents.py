@@ -0,0 +1,65 @@
+import numpy as np
+import struct
+import torch
+import json
+import zlib
+
+
+# Latent-first storage keeps the final (4, h, w) latents of an image instead of the image,
+# 128 x 128 x 4 fp16 at 1024², and decodes them with the VAE only when the image is requested
+LATENT_EXTENSION = ".latent"
+
+# File layout: magic, header length, JSON header, zlib-compressed fp16 latents
+LATENT_MAGIC = b"SSDL1"
+
+
+def is_latent_key(key):
+    return key.endswith(LATENT_EXTENSION)
+
+
+def encode_latents(latents, model, output):
+    """
+    Serializes a latent tensor with what is needed to decode it later: the model whose VAE
+    decodes it and the output format of the decoded image.
+    """
+    array = latents.detach().to("cpu", torch.float16).numpy()
+    header = json.dumps({
+        "model": model,
+        "shape": list(array.shape),
+        "format": output["format"],
+        "quality": output["quality"],
+    }).encode()
+    return LATENT_MAGIC + struct.pack("<I", len(header)) + header + zlib.compress(array.tobytes(), 6)
+
+
+def decode_latents(data):
+    """
+    Returns the (latents, header) of serialized latents.
+    """
+    if not data.startswith(LATENT_MAGIC):
+        raise ValueError("Not a latent file.")
+    offset = len(LATENT_MAGIC)
+    (header_length,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    header = json.loads(data[offset:offset + header_length])
+    array = np.frombuffer(zlib.decompress(data[offset + header_length:]), dtype=np.float16)
+    return torch.from_numpy(array.reshape(header["shape"]).copy()), header
+
+
+def vae_decode(pipeline, latents):
+    """
+    Decodes one (4, h, w) latent to an image with a pipeline's VAE, the way the SDXL
+    pipeline does at the end of a call, including its fp32 upcast of the fp16 VAE.
+    """
+    vae = pipeline.vae
+    needs_upcasting = vae.dtype == torch.float16 and vae.config.force_upcast
+    with torch.no_grad():
+        if needs_upcasting:
+            pipeline.upcast_vae()
+        try:
+            latents = latents.unsqueeze(0).to(vae.device, next(iter(vae.post_quant_conv.parameters())).dtype)
+            image = vae.decode(latents / vae.config.scaling_factor, return_dict=False)[0]
+        finally:
+            if needs_upcasting:
+                vae.to(dtype=torch.float16)
+    return pipeline.image_processor.postprocess(image, output_type="pil")[0]
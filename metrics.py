@@ -0,0 +1,79 @@
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+
+# Stages a generation passes through, in order
+STAGES = (
+    "queue_wait",
+    "model_load",
+    "text_encoding",
+    "denoise",
+    "vae_decode",
+    "image_encode",
+    "storage_write",
+    "db_insert",
+)
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+STEP_BUCKETS = (0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1, 2)
+
+STAGE_SECONDS = Histogram(
+    "ssd_stage_seconds",
+    "Time a generation request spends in each stage",
+    ["stage", "model"],
+    buckets=STAGE_BUCKETS,
+)
+STEP_SECONDS = Histogram(
+    "ssd_denoise_step_seconds",
+    "Duration of a single denoising step of a batch",
+    ["model"],
+    buckets=STEP_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "ssd_generation_seconds",
+    "End-to-end time from submission until the result is stored",
+    ["model"],
+    buckets=STAGE_BUCKETS,
+)
+BATCH_SIZE = Histogram(
+    "ssd_batch_size",
+    "Number of prompts per pipeline call",
+    ["model"],
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16),
+)
+JOBS = Counter(
+    "ssd_jobs_total",
+    "Generation jobs by final status",
+    ["model", "status"],
+)
+MEMORY_LEVELS = Counter(
+    "ssd_memory_level_total",
+    "Pipeline calls by the memory-saving level they ran at",
+    ["model", "level"],
+)
+OOM_RETRIES = Counter(
+    "ssd_oom_retries_total",
+    "Pipeline calls retried at a more frugal memory level after running out of memory",
+    ["model"],
+)
+QUEUE_DEPTH = Gauge("ssd_queue_depth", "Generation jobs waiting for the worker")
+RECORDS_PENDING = Gauge("ssd_records_pending", "Generation records waiting to be written to the database")
+GPU_MEMORY_ALLOCATED = Gauge("ssd_gpu_memory_allocated_bytes", "Device memory allocated by tensors")
+GPU_MEMORY_RESERVED = Gauge("ssd_gpu_memory_reserved_bytes", "Device memory reserved by the caching allocator")
+MODEL_RESIDENT_BYTES = Gauge("ssd_model_resident_bytes", "Weight bytes of the models resident on the device")
+EMBEDDING_CACHE_HITS = Gauge("ssd_embedding_cache_hits", "Prompt embedding cache hits since startup")
+EMBEDDING_CACHE_MISSES = Gauge("ssd_embedding_cache_misses", "Prompt embedding cache misses since startup")
+
+
+def observe_stage(job, stage, seconds):
+    """
+    Records a stage duration on the job's own timings and in the stage histogram.
+    """
+    job.timings[stage] = job.timings.get(stage, 0.0) + seconds
+    STAGE_SECONDS.labels(stage, job.model).observe(seconds)
+
+
+def latest():
+    """
+    Returns the metrics in the Prometheus text format and its content type.
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
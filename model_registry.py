@@ -0,0 +1,277 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import time
+import torch
+
+
+# Residency states of a registered model
+UNLOADED = "unloaded"
+LOADING = "loading"
+CPU = "cpu"
+GPU = "gpu"
+
+
+def module_bytes(module):
+    """
+    Sums the parameter and buffer bytes of a torch module.
+    """
+    return sum(
+        tensor.element_size() * tensor.nelement()
+        for tensor in list(module.parameters()) + list(module.buffers())
+    )
+
+
+def pipeline_modules(pipeline):
+    """
+    Returns the torch module components of a pipeline by name.
+    """
+    return {
+        name: component for name, component in pipeline.components.items()
+        if isinstance(component, torch.nn.Module)
+    }
+
+
+def pipeline_bytes(pipeline):
+    return sum(module_bytes(module) for module in pipeline_modules(pipeline).values())
+
+
+class ModelEntry:
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self.pipeline = None
+        self.state = UNLOADED
+        self.bytes = 0
+        self.last_used = None
+        self.load_time = None
+        self.in_use = 0
+        # Set whenever the entry is not in the middle of a load
+        self.settled = threading.Event()
+        self.settled.set()
+
+
+class ModelRegistry:
+    """
+    Loads pipelines on first use and keeps as many of them on the device as the
+    memory budget allows, moving the least recently used ones to CPU (or out of
+    memory entirely) to make room or once they have been idle for too long.
+
+    Pipelines may share component modules (text encoders, VAE). Memory is counted
+    once per module, and a shared module stays on the device for as long as any
+    resident pipeline still uses it.
+    """
+
+    def __init__(self, loaders, device="cuda:0", memory_budget_bytes=None,
+                 idle_seconds=None, eviction="cpu", on_unload=None):
+        self.entries = {name: ModelEntry(name, loader) for name, loader in loaders.items()}
+        self.device = device
+        self.memory_budget_bytes = memory_budget_bytes
+        self.idle_seconds = idle_seconds
+        self.eviction = eviction
+        self.on_unload = on_unload
+        self._lock = threading.RLock()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    @contextmanager
+    def use(self, name):
+        """
+        Yields the named pipeline resident on the device, loading it if needed.
+        A model is never evicted while it is in use.
+        """
+        with self._lock:
+            entry = self.entries[name]
+            self._make_resident(entry)
+            entry.in_use += 1
+        try:
+            yield entry.pipeline
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.time()
+
+    def preload(self, names):
+        """
+        Loads the named models into memory in parallel, ahead of their first use. They move
+        to the device on first use, or right away when `use` is called during the load.
+        """
+        with self._lock:
+            entries = [self.entries[name] for name in names if self.entries[name].state == UNLOADED]
+            for entry in entries:
+                entry.state = LOADING
+                entry.settled.clear()
+        if not entries:
+            return
+        # Loading happens outside the lock so the loads overlap and status stays readable
+        with ThreadPoolExecutor(max_workers=len(entries), thread_name_prefix="preload") as executor:
+            list(executor.map(self._load, entries))
+
+    def evict_idle(self):
+        """
+        Moves models that have not been used for `idle_seconds` off the device.
+        """
+        if self.idle_seconds is None:
+            return
+        now = time.time()
+        with self._lock:
+            for entry in self.entries.values():
+                if entry.state == GPU and not entry.in_use and now - entry.last_used > self.idle_seconds:
+                    print(f"Evicting idle model {entry.name}...")
+                    self._evict(entry)
+
+    def evict_unused(self, keep):
+        """
+        Moves the least recently used resident model that is not in use, other than `keep`,
+        off the device to free memory for a call of `keep`. Returns False if there was none.
+        """
+        with self._lock:
+            candidates = [
+                entry for entry in self.entries.values()
+                if entry.state == GPU and entry.name != keep and not entry.in_use
+            ]
+            if not candidates:
+                return False
+            entry = min(candidates, key=lambda entry: entry.last_used or 0)
+            print(f"Evicting model {entry.name} to free memory for {keep}...")
+            self._evict(entry, keep=self.entries[keep])
+            return True
+
+    def resident_modules(self, exclude=None):
+        """
+        Returns the unique modules of every resident pipeline, keyed by object id.
+        """
+        modules = {}
+        for entry in list(self.entries.values()):
+            if entry.state == GPU and entry is not exclude and entry.pipeline is not None:
+                for module in pipeline_modules(entry.pipeline).values():
+                    modules[id(module)] = module
+        return modules
+
+    def resident_bytes(self):
+        return sum(module_bytes(module) for module in self.resident_modules().values())
+
+    def memory_report(self):
+        """
+        Reports per-component bytes of every loaded model and which components are shared.
+        """
+        owners = {}
+        for entry in list(self.entries.values()):
+            if entry.pipeline is not None:
+                for module in pipeline_modules(entry.pipeline).values():
+                    owners.setdefault(id(module), []).append(entry.name)
+
+        models = {}
+        unique = {}
+        for entry in list(self.entries.values()):
+            if entry.pipeline is None:
+                continue
+            components = {}
+            for name, module in pipeline_modules(entry.pipeline).items():
+                size = module_bytes(module)
+                unique[id(module)] = size
+                components[name] = {
+                    "bytes": size,
+                    "device": str(next(module.parameters()).device) if any(True for _ in module.parameters()) else None,
+                    "shared_with": [owner for owner in owners[id(module)] if owner != entry.name],
+                }
+            models[entry.name] = {"state": entry.state, "components": components}
+
+        return {
+            "models": models,
+            "total_bytes": sum(unique.values()),
+            "unshared_total_bytes": sum(
+                component["bytes"] for model in models.values() for component in model["components"].values()
+            ),
+            "resident_bytes": self.resident_bytes(),
+        }
+
+    def status(self):
+        # Read without the lock so a slow load never blocks the caller
+        return {
+            "device": self.device,
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "resident_bytes": self.resident_bytes(),
+            "models": {
+                entry.name: {
+                    "state": entry.state,
+                    "bytes": entry.bytes,
+                    "last_used": entry.last_used,
+                    "load_time": entry.load_time,
+                    "in_use": entry.in_use > 0,
+                }
+                for entry in self.entries.values()
+            },
+        }
+
+    def _make_resident(self, entry):
+        if entry.state == GPU:
+            return
+        if entry.state == LOADING:
+            # Being preloaded, wait for it instead of loading a second copy
+            entry.settled.wait()
+        if entry.state == UNLOADED:
+            entry.state = LOADING
+            entry.settled.clear()
+            self._load(entry)
+
+        # Modules shared with an already resident pipeline need no extra room, evictions leave them in place
+        resident = self.resident_modules()
+        needed_bytes = sum(
+            module_bytes(module) for module in pipeline_modules(entry.pipeline).values()
+            if id(module) not in resident
+        )
+        self._make_room(needed_bytes, keep=entry)
+        print(f"Moving model {entry.name} to {self.device}...")
+        entry.pipeline.to(self.device)
+        entry.state = GPU
+        entry.last_used = time.time()
+
+    def _load(self, entry):
+        print(f"Loading model {entry.name}...")
+        start_time = time.time()
+        try:
+            entry.pipeline = entry.loader()
+            entry.load_time = time.time() - start_time
+            entry.bytes = pipeline_bytes(entry.pipeline)
+            entry.state = CPU
+        except Exception:
+            entry.state = UNLOADED
+            raise
+        finally:
+            entry.settled.set()
+
+    def _make_room(self, needed_bytes, keep):
+        if self.memory_budget_bytes is None:
+            return
+        # Evict least recently used models until the new one fits the budget
+        candidates = sorted(
+            (entry for entry in self.entries.values()
+             if entry.state == GPU and entry is not keep and not entry.in_use),
+            key=lambda entry: entry.last_used or 0
+        )
+        for entry in candidates:
+            if self.resident_bytes() + needed_bytes <= self.memory_budget_bytes:
+                break
+            print(f"Evicting model {entry.name} to fit the memory budget...")
+            self._evict(entry, keep=keep)
+
+    def _evict(self, entry, keep=None):
+        # Leave modules on the device that another resident pipeline, or the one being made resident, still uses
+        still_needed = self.resident_modules(exclude=entry)
+        if keep is not None and keep.pipeline is not None:
+            still_needed.update((id(module), module) for module in pipeline_modules(keep.pipeline).values())
+        for module in pipeline_modules(entry.pipeline).values():
+            if id(module) not in still_needed:
+                module.to("cpu")
+
+        if self.eviction == "unload":
+            entry.pipeline = None
+            entry.state = UNLOADED
+            if self.on_unload is not None:
+                self.on_unload(entry.name)
+        else:
+            entry.state = CPU
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
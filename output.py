@@ -0,0 +1,79 @@
+import io
+
+
+# Supported output formats: PIL format name, media type and file extension
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+    "png": ("PNG", "image/png", ".png"),
+    "webp": ("WEBP", "image/webp", ".webp"),
+}
+
+MEDIA_TYPES = {media_type: name for name, (_, media_type, _) in FORMATS.items()}
+EXTENSIONS = {extension: name for name, (_, _, extension) in FORMATS.items()}
+
+
+def parse_accept(accept_header):
+    """
+    Returns the media types of an Accept header ordered by preference.
+    """
+    preferences = []
+    for position, part in enumerate((accept_header or "").split(",")):
+        media_type, _, params = part.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type and quality > 0:
+            preferences.append((-quality, position, media_type.strip().lower()))
+    return [media_type for _, _, media_type in sorted(preferences)]
+
+
+def negotiate_format(requested=None, accept_header=None, default="jpeg"):
+    """
+    Picks the output format: an explicit request field wins, then the Accept header.
+    """
+    if requested:
+        requested = requested.lower()
+        if requested == "jpg":
+            requested = "jpeg"
+        if requested not in FORMATS:
+            raise ValueError(f"Unsupported output format: {requested}")
+        return requested
+    for media_type in parse_accept(accept_header):
+        if media_type in MEDIA_TYPES:
+            return MEDIA_TYPES[media_type]
+        if media_type in ("image/*", "*/*"):
+            return default
+    return default
+
+
+def encode_image(image, output_format="jpeg", quality=75):
+    """
+    Encodes an image once into the given format and returns the bytes.
+    """
+    pil_format = FORMATS[output_format][0]
+    buffer = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buffer, format=pil_format)
+    else:
+        image.save(buffer, format=pil_format, quality=quality)
+    return buffer.getvalue()
+
+
+def media_type(output_format):
+    return FORMATS[output_format][1]
+
+
+def extension(output_format):
+    return FORMATS[output_format][2]
+
+
+def format_from_path(path):
+    for file_extension, name in EXTENSIONS.items():
+        if path.endswith(file_extension):
+            return name
+    return "jpeg"
@@ -1,13 +1,9 @@
 import streamlit as st
+import api_client
 import requests
 import json
-from PIL import Image
 
-HISTORY_ENDPOINT = "http://127.0.0.1:8000/all-records/"
-CLEAR_DB_ENDPOINT = "http://127.0.0.1:8000/clear-database/"
-EXPORT_FILENAME = "image_history.json"
-IMPORT_ENDPOINT = "http://127.0.0.1:8000/import-records/"
-DATABASE_INFO_ENDPOINT = "http://127.0.0.1:8000/database-info/"
+HISTORY_PAGE_SIZE = 50
 
 st.set_page_config(page_title="SSD-1B History", page_icon=":infinity:")
 
@@ -18,12 +14,16 @@ if 'selected_images' not in st.session_state:
 if 'compare_buttons' not in st.session_state:
     st.session_state.compare_buttons = {}
 
+# Cursor of every page visited so far, so earlier pages can be revisited
+if 'history_cursors' not in st.session_state:
+    st.session_state.history_cursors = [None]
+    st.session_state.history_page = 0
+
 # Retrieves database information from the API
 def fetch_database_info():
-    response = requests.get(DATABASE_INFO_ENDPOINT)
-    if response.status_code == 200:
-        return response.json()
-    else:
+    try:
+        return api_client.database_info()
+    except requests.RequestException:
         st.error("Failed to fetch database info.")
         return {}
 
@@ -43,36 +43,73 @@ def show_database_info():
 
 # Clears the database
 def clear_database():
-    response = requests.post(CLEAR_DB_ENDPOINT)
+    response = api_client.clear_database()
     if response.status_code == 200:
         st.sidebar.success("Database cleared successfully!")
     else:
         st.sidebar.error("Failed to clear database.")
 
-# Exports the records to a JSON file
-def export_records(records):
-    json_data = json.dumps(records)
+# Links to the streaming NDJSON export; the browser downloads it straight from the API
+def export_records():
     st.sidebar.success(f"History ready for download!")
-    st.sidebar.download_button("Download Exported History", data=json_data, file_name=EXPORT_FILENAME, mime="application/json")
+    st.sidebar.markdown(f"[Download Exported History]({api_client.export_url()})")
 
 
-# Imports records from a JSON file
+# Imports records from an NDJSON export, or a JSON list from older versions
 def import_records(uploaded_file):
+    if uploaded_file.name.endswith(".ndjson"):
+        # Stream the file to the API instead of parsing it here
+        response = api_client.import_records_stream(uploaded_file)
+        if response.status_code == 200:
+            summary = response.json()
+            st.sidebar.success(f"Imported {summary['rows']} records ({summary['rows_per_second'] or 0:.0f} rows/s)!")
+            if summary["invalid_lines"]:
+                st.sidebar.warning(f"Skipped {summary['invalid_lines']} invalid lines.")
+        else:
+            st.sidebar.error("Failed to import history.")
+        return
+
     records = json.load(uploaded_file)
-    response = requests.post(IMPORT_ENDPOINT, json=records)
+    response = api_client.import_records(records)
     if response.status_code == 200:
         st.sidebar.success("History imported successfully!")
     else:
         st.sidebar.error("Failed to import history.")
 
-# Fetches the image records from the API
-def fetch_records():
-    response = requests.get(HISTORY_ENDPOINT)
-    if response.status_code == 200:
-        return response.json()
-    else:
+# Fetches the current page of image records; pages are cached by the API client
+def fetch_history_page():
+    cursor = st.session_state.history_cursors[st.session_state.history_page]
+    try:
+        return api_client.history_page(cursor, HISTORY_PAGE_SIZE)
+    except requests.RequestException:
         st.error("Failed to fetch image history.")
-        return []
+        return {"records": [], "next_cursor": None}
+
+# Goes back to the first page, fetching the history again from the newest record
+def reset_history():
+    st.session_state.history_cursors = [None]
+    st.session_state.history_page = 0
+
+# Moves to the next page, remembering its cursor
+def next_page(next_cursor):
+    del st.session_state.history_cursors[st.session_state.history_page + 1:]
+    st.session_state.history_cursors.append(next_cursor)
+    st.session_state.history_page += 1
+
+def previous_page():
+    st.session_state.history_page -= 1
+
+# Previous/next buttons for the history pages
+def show_page_navigation(next_cursor, key):
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.session_state.history_page > 0:
+            st.button("Previous", key=f"previous_{key}", on_click=previous_page)
+    with col2:
+        st.write(f"Page {st.session_state.history_page + 1}")
+    with col3:
+        if next_cursor:
+            st.button("Next", key=f"next_{key}", on_click=next_page, args=(next_cursor,))
 
 
 
@@ -80,11 +117,9 @@ def display_selected_images():
     if len(st.session_state.selected_images) == 2:
         col1, col2 = st.columns(2)
         with col1:
-            image_obj = Image.open(st.session_state.selected_images[0])
-            st.image(image_obj, caption="Comparison Image 1", use_column_width=True)
+            st.image(api_client.image_url({"image_path": st.session_state.selected_images[0]}), caption="Comparison Image 1", use_column_width=True)
         with col2:
-            image_obj = Image.open(st.session_state.selected_images[1])
-            st.image(image_obj, caption="Comparison Image 2", use_column_width=True)
+            st.image(api_client.image_url({"image_path": st.session_state.selected_images[1]}), caption="Comparison Image 2", use_column_width=True)
         st.write("---")
 
 
@@ -98,7 +133,7 @@ def display_record(record):
 
         st.write(f"Prompt: {record['prompt']}")
         negative_prompt = record.get('negative_prompt')
-        if negative_prompt is not None:
+        if record.get('model', 'ssd-1b' if negative_prompt is not None else 'sdxl') == 'ssd-1b':
             st.write(f"Negative Prompt: {negative_prompt}")
             st.markdown("<span style='color: #0AC2FF;'>SSD 1B Record</span>", unsafe_allow_html=True)
         else:
@@ -120,8 +155,8 @@ def display_record(record):
 
 
     with col2:
-        image_obj = Image.open(record["image_path"])
-        st.image(image_obj, caption="Generated Image", use_column_width=True)
+        # Prefetched thumbnails are rendered from memory, the rest are loaded by the browser
+        st.image(api_client.thumbnail(record), caption="Generated Image", use_column_width=True)
     st.write("---")
 
 
@@ -133,19 +168,25 @@ def show():
 
     st.sidebar.header("Database Actions")
 
-    uploaded_file = st.sidebar.file_uploader("Import your JSON history to view previous sessions", type=["json"])
+    uploaded_file = st.sidebar.file_uploader("Import your JSON history to view previous sessions", type=["ndjson", "json"])
     
-    if uploaded_file:
+    # The file stays in the uploader across reruns, so each upload is imported only once
+    if uploaded_file and st.session_state.get("imported_file_id") != uploaded_file.file_id:
+        st.session_state.imported_file_id = uploaded_file.file_id
         import_records(uploaded_file)
+        reset_history()
     
-    records = fetch_records()
     if st.sidebar.button("Export History"):
-        export_records(records)
+        export_records()
     
     st.sidebar.divider()
 
     if st.sidebar.button("Clear Database"):
         clear_database()
+        reset_history()
+
+    if st.sidebar.button("Refresh History"):
+        reset_history()
     
     st.sidebar.divider()
 
@@ -163,9 +204,20 @@ def show():
     # Show selected images for comparison
     display_selected_images()
     
-    for record in records:
+    # Only one page of records is rendered at a time
+    page = fetch_history_page()
+    show_page_navigation(page["next_cursor"], "top")
+    st.write("---")
+
+    for record in page["records"]:
         display_record(record)
 
+    show_page_navigation(page["next_cursor"], "bottom")
+
+    # Fetch the next page and its thumbnails while this one is being looked at
+    if page["next_cursor"]:
+        api_client.prefetch_history_page(page["next_cursor"], HISTORY_PAGE_SIZE)
+
 
 # If running as a standalone page (useful for testing)
 if __name__ == "__main__":
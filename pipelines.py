@@ -0,0 +1,131 @@
+from diffusers import StableDiffusionXLPipeline
+from diffusers import DiffusionPipeline
+from diffusers import UNet2DConditionModel
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import torch
+import os
+
+
+# Where checkpoints are cached. With SSD_LOCAL_FILES_ONLY=1 loads never touch the network,
+# which saves the hub round trips on every restart once the cache is populated.
+MODEL_CACHE_DIR = os.environ.get("SSD_MODEL_CACHE_DIR")
+LOCAL_FILES_ONLY = os.environ.get("SSD_LOCAL_FILES_ONLY", "0") == "1"
+
+# Compile the UNets with torch.compile, keeping compiled kernels in a cache directory that
+# survives restarts so only the first start of a machine pays the full compile time
+TORCH_COMPILE = os.environ.get("SSD_TORCH_COMPILE", "0") == "1"
+COMPILE_CACHE_DIR = os.environ.get("SSD_COMPILE_CACHE_DIR", ".compile_cache")
+
+# Load the LCM-LoRA distillation adapters so requests can use the few-step "lcm" scheduler
+LCM_LORA = os.environ.get("SSD_LCM_LORA", "0") == "1"
+LCM_LORAS = {
+    "segmind/SSD-1B": "latent-consistency/lcm-lora-ssd-1b",
+    "stabilityai/stable-diffusion-xl-base-1.0": "latent-consistency/lcm-lora-sdxl",
+}
+
+# Weights of different components are read from disk concurrently
+load_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="weight-loader")
+
+
+def load_options():
+    # Safetensors checkpoints are memory-mapped, so weights are paged in rather than copied
+    return {
+        "torch_dtype": torch.float16,
+        "use_safetensors": True,
+        "variant": "fp16",
+        "cache_dir": MODEL_CACHE_DIR,
+        "local_files_only": LOCAL_FILES_ONLY,
+    }
+
+
+# SSD-1B is distilled from SDXL and keeps its text encoders, tokenizers and VAE,
+# so both pipelines are built around one copy of those and only the UNets differ
+SHARED_COMPONENTS_MODEL = "stabilityai/stable-diffusion-xl-base-1.0"
+SHARED_COMPONENT_NAMES = ("vae", "text_encoder", "text_encoder_2", "tokenizer", "tokenizer_2")
+
+shared_components = {}
+shared_components_lock = threading.Lock()
+
+
+def load_shared_components():
+    """
+    Loads the text encoders, tokenizers and VAE once and returns them for every pipeline.
+    """
+    with shared_components_lock:
+        if not shared_components:
+            print("Loading shared text encoders, tokenizers and VAE...")
+            base = DiffusionPipeline.from_pretrained(
+                SHARED_COMPONENTS_MODEL,
+                unet=None,
+                **load_options()
+            )
+            for name in SHARED_COMPONENT_NAMES:
+                shared_components[name] = getattr(base, name)
+        return dict(shared_components)
+
+
+def release_shared_components(pipelines):
+    """
+    Drops the shared components once none of `pipelines`, the ones still loaded, uses
+    them, so unloading every model frees them and the next load reads them again.
+    """
+    with shared_components_lock:
+        shared = {id(module) for module in shared_components.values()}
+        for pipeline in pipelines:
+            if any(id(module) in shared for module in pipeline.components.values()):
+                return
+        shared_components.clear()
+
+
+def compile_unet(unet):
+    """
+    Compiles a UNet, persisting the compiled graphs under COMPILE_CACHE_DIR.
+    """
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(COMPILE_CACHE_DIR))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+    unet.to(memory_format=torch.channels_last)
+    return torch.compile(unet, mode="max-autotune-no-cudagraphs")
+
+
+def build_pipeline(repo):
+    """
+    Loads a model's UNet while the shared components load alongside it, then assembles the pipeline.
+    """
+    shared = load_executor.submit(load_shared_components)
+    print(f"Loading UNet of {repo}...")
+    unet = UNet2DConditionModel.from_pretrained(repo, subfolder="unet", **load_options())
+    pipeline = StableDiffusionXLPipeline.from_pretrained(
+        repo,
+        unet=unet,
+        **shared.result(),
+        **load_options()
+    )
+    if LCM_LORA:
+        print(f"Loading LCM-LoRA adapter of {repo}...")
+        pipeline.load_lora_weights(
+            LCM_LORAS[repo], adapter_name="lcm", cache_dir=MODEL_CACHE_DIR, local_files_only=LOCAL_FILES_ONLY
+        )
+        # Off until a request asks for the lcm scheduler
+        pipeline.disable_lora()
+    if TORCH_COMPILE:
+        pipeline.unet = compile_unet(pipeline.unet)
+    return pipeline
+
+
+# Pipelines are loaded on first use rather than at import time, by the model registry
+def load_sdxl():
+    return build_pipeline("stabilityai/stable-diffusion-xl-base-1.0")
+
+
+def load_ssd_1b():
+    return build_pipeline("segmind/SSD-1B")
+
+
+# Loader of every model the API serves, by model name
+MODEL_LOADERS = {
+    "ssd-1b": load_ssd_1b,
+    "sdxl": load_sdxl,
+}
@@ -0,0 +1,38 @@
+from PIL import Image
+import base64
+import torch
+import io
+
+
+# Linear projection of the 4 SDXL latent channels onto RGB, a cheap stand-in for the VAE decoder
+SDXL_LATENT_RGB_FACTORS = [
+    [0.3920, 0.4054, 0.4549],
+    [-0.2634, -0.0196, 0.0653],
+    [0.0568, 0.1687, -0.0755],
+    [-0.3112, -0.2359, -0.2076],
+]
+SDXL_LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
+
+
+def latents_to_preview(latents, size=None):
+    """
+    Approximates the image of a single (4, h, w) latent without running the VAE.
+    The preview is h x w pixels (128 x 128 at 1024²) unless a size is given.
+    """
+    factors = torch.tensor(SDXL_LATENT_RGB_FACTORS, dtype=torch.float32, device=latents.device)
+    bias = torch.tensor(SDXL_LATENT_RGB_BIAS, dtype=torch.float32, device=latents.device)
+    rgb = torch.einsum("chw,cr->hwr", latents.float(), factors) + bias
+    rgb = ((rgb + 1.0) / 2.0).clamp(0, 1).mul(255).byte().cpu().numpy()
+    image = Image.fromarray(rgb)
+    if size is not None:
+        image = image.resize(size, Image.BILINEAR)
+    return image
+
+
+def preview_base64(latents, quality=70):
+    """
+    Encodes a latent preview as a base64 JPEG for streaming to clients.
+    """
+    buffer = io.BytesIO()
+    latents_to_preview(latents).save(buffer, format="JPEG", quality=quality)
+    return base64.b64encode(buffer.getvalue()).decode()
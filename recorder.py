@@ -0,0 +1,120 @@
+from metrics import STAGE_SECONDS
+import asyncio
+import json
+import time
+
+
+class RecordWriter:
+    """
+    Write-behind recorder for generation records. Rows are queued in memory and
+    inserted with one multi-row INSERT per table whenever `max_batch_size` rows are
+    waiting or `flush_interval` seconds have passed, so database latency stays off
+    the request path. Failed flushes are retried with exponential backoff, and
+    `stop` drains every queued row before returning. At most `max_pending` rows are
+    queued; beyond that `add` waits for a flush, so a slow database slows the callers
+    down instead of growing the queue without bound.
+    """
+
+    def __init__(self, database, max_batch_size=200, flush_interval=0.25, max_retries=5, retry_backoff=0.5,
+                 max_pending=10000):
+        self.database = database
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        # (table, model, values) waiting to be written, and those in the flush running now
+        self.pending = []
+        self.flushing = []
+        self.written = 0
+        self.failed = 0
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def add(self, table, model, values):
+        """
+        Queues a row for insertion into `table`, first waiting for room if the queue is full.
+        """
+        # Without a running flusher nothing would ever make room
+        while len(self.pending) >= self.max_pending and self._task is not None and not self._task.done():
+            self._space.clear()
+            self._wakeup.set()
+            await self._space.wait()
+        self.pending.append((table, model, values))
+        if len(self.pending) >= self.max_batch_size:
+            self._wakeup.set()
+
+    def find(self, table, column, value):
+        """
+        Returns the values of a queued, not yet written row whose column matches, if any.
+        """
+        for row_table, _, values in self.flushing + self.pending:
+            if row_table is table and values.get(column) == value:
+                return values
+        return None
+
+    def pending_rows(self, table):
+        """
+        Returns the values of the rows queued for `table` and not yet written, newest first.
+        """
+        return [values for row_table, _, values in reversed(self.flushing + self.pending) if row_table is table]
+
+    def queue_depth(self):
+        return len(self.pending) + len(self.flushing)
+
+    async def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self.pending:
+                await self._flush()
+                if not self._stopping and len(self.pending) < self.max_batch_size:
+                    break
+            if self._stopping and not self.pending:
+                return
+
+    async def _flush(self):
+        self.flushing = self.pending[:self.max_batch_size]
+        del self.pending[:len(self.flushing)]
+        self._space.set()
+
+        # One INSERT ... VALUES (...), (...) per table
+        groups = {}
+        for table, model, values in self.flushing:
+            groups.setdefault((table, model), []).append(values)
+
+        for (table, model), rows in groups.items():
+            for attempt in range(self.max_retries + 1):
+                stage_start = time.perf_counter()
+                try:
+                    async with self.database.transaction():
+                        await self.database.execute(table.insert().values(rows))
+                    STAGE_SECONDS.labels("db_insert", model).observe(time.perf_counter() - stage_start)
+                    self.written += len(rows)
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        # Out of retries: log the rows so they can be re-imported rather than lost silently
+                        print(f"Error writing {len(rows)} {table.name} records, giving up: {str(e)}")
+                        for values in rows:
+                            print(json.dumps({"unwritten_record": table.name, **values}, default=str))
+                        self.failed += len(rows)
+                        break
+                    delay = self.retry_backoff * 2 ** attempt
+                    print(f"Error writing {len(rows)} {table.name} records, retrying in {delay:.1f}s: {str(e)}")
+                    await asyncio.sleep(delay)
+        self.flushing = []
@@ -0,0 +1,88 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime, func, Index
+from sqlalchemy.ext.declarative import declarative_base
+from datetime import datetime, timezone
+
+
+# Tables shared by the API, the queue workers and the batch tools
+Base = declarative_base()
+
+
+# Image record model
+class ImageRecord(Base):
+    __tablename__ = "images"
+
+    id = Column(Integer, primary_key=True, index=True)
+    # Searched through trigram and full-text indexes, see /search
+    prompt = Column(String)
+    negative_prompt = Column(String)
+    # Looked up by /images/{image_id} to find the key of an image
+    image_path = Column(String, index=True)
+    cache_key = Column(String, index=True)
+    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+
+    # Backs keyset pagination of the history, newest first
+    __table_args__ = (Index("ix_images_timestamp_id", "timestamp", "id"),)
+
+class  SDXLImageRecord(Base):
+    __tablename__ = "sdxl_images"
+
+    id = Column(Integer, primary_key=True, index=True)
+    prompt = Column(String)
+    # Looked up by /images/{image_id} to find the key of an image
+    image_path = Column(String, index=True)
+    cache_key = Column(String, index=True)
+    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+
+    # Backs keyset pagination of the history, newest first
+    __table_args__ = (Index("ix_sdxl_images_timestamp_id", "timestamp", "id"),)
+
+# Durable generation job, see job_queue.py
+class GenerationJobRecord(Base):
+    __tablename__ = "generation_jobs"
+
+    id = Column(String, primary_key=True)
+    model = Column(String, nullable=False)
+    # JSON of the pipeline parameters and of the output format
+    params = Column(Text, nullable=False)
+    output = Column(Text, nullable=False)
+    cache_key = Column(String)
+    priority = Column(Integer, nullable=False, default=0)
+    # Jobs still waiting at their deadline are cancelled instead of run
+    deadline = Column(DateTime(timezone=True))
+    status = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False)
+    # Worker holding the job and until when; an expired lease makes the job claimable again
+    worker_id = Column(String)
+    claim_token = Column(String, index=True)
+    lease_expires_at = Column(DateTime(timezone=True))
+    image_path = Column(String)
+    error = Column(Text)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+
+    # Claims take the best waiting job, lease expiry scans the running ones
+    __table_args__ = (
+        Index("ix_generation_jobs_claim", "status", "priority", "created_at"),
+        Index("ix_generation_jobs_lease", "status", "lease_expires_at"),
+    )
+
+
+def record_table(model):
+    return SDXLImageRecord.__table__ if model == "sdxl" else ImageRecord.__table__
+
+
+def record_values(model, params, image_key, cache_key=None):
+    """
+    Values of the history row of a generated image.
+    """
+    values = {
+        "prompt": params["prompt"],
+        "image_path": image_key,
+        "cache_key": cache_key,
+        "timestamp": datetime.now(timezone.utc),
+    }
+    if model != "sdxl":
+        values["negative_prompt"] = params.get("negative_prompt")
+    return values
@@ -0,0 +1,74 @@
+import itertools
+import threading
+import queue
+import time
+
+
+class JobQueue:
+    """
+    Thread-safe queue of waiting jobs that hands out the highest priority job first.
+    Within a priority, clients take turns: the client served least recently goes
+    next, so one client submitting many jobs cannot starve the others. Jobs of the
+    same client come out in submission order.
+
+    Raises `queue.Full` and returns None on timeout, like the standard queues.
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._jobs = []
+        self._last_served = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._jobs)
+
+    def put_nowait(self, job):
+        with self._condition:
+            if self.maxsize and len(self._jobs) >= self.maxsize:
+                raise queue.Full
+            job.sequence = next(self._counter)
+            self._jobs.append(job)
+            self._condition.notify_all()
+
+    def get(self, timeout=None, match=None):
+        """
+        Removes and returns the next job, or the next one for which `match(job)` is true.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                candidates = [job for job in self._jobs if match is None or match(job)]
+                if candidates:
+                    job = min(candidates, key=self._order)
+                    self._jobs.remove(job)
+                    if any(other.client_id == job.client_id for other in self._jobs):
+                        self._last_served[job.client_id] = next(self._counter)
+                    else:
+                        # A client with nothing waiting is treated as new when it comes back
+                        self._last_served.pop(job.client_id, None)
+                    return job
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def remove(self, job):
+        """
+        Takes a job out of the queue, returning False if it was no longer waiting.
+        """
+        with self._condition:
+            if job in self._jobs:
+                self._jobs.remove(job)
+                return True
+            return False
+
+    def count_ahead(self, priority):
+        # Jobs that would be served before a new job of this priority
+        with self._condition:
+            return sum(1 for job in self._jobs if job.priority >= priority)
+
+    def _order(self, job):
+        return (-job.priority, self._last_served.get(job.client_id, -1), job.sequence)
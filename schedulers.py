@@ -0,0 +1,102 @@
+from diffusers import (
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    LCMScheduler,
+    UniPCMultistepScheduler,
+)
+from contextlib import contextmanager
+import threading
+
+
+# Scheduler class and config overrides by request name. "default" keeps the scheduler the model ships with.
+SCHEDULERS = {
+    "default": None,
+    "dpmpp_2m": (DPMSolverMultistepScheduler, {}),
+    "dpmpp_2m_karras": (DPMSolverMultistepScheduler, {"use_karras_sigmas": True}),
+    "euler": (EulerDiscreteScheduler, {}),
+    "euler_a": (EulerAncestralDiscreteScheduler, {}),
+    "unipc": (UniPCMultistepScheduler, {}),
+    "lcm": (LCMScheduler, {}),
+}
+
+# Few-step schedulers that only work with a distillation adapter loaded under this name
+ADAPTER_SCHEDULERS = {"lcm": "lcm"}
+
+
+def pipeline_adapters(pipeline):
+    """
+    Returns the names of the LoRA adapters loaded into a pipeline.
+    """
+    get_list_adapters = getattr(pipeline, "get_list_adapters", None)
+    if get_list_adapters is None:
+        return set()
+    try:
+        return {name for names in get_list_adapters().values() for name in names}
+    except Exception:
+        # No PEFT backend, so no adapters
+        return set()
+
+
+class SchedulerCache:
+    """
+    Builds each scheduler once per model from the model's own scheduler config and
+    swaps it into the pipeline for a single call, so changing samplers never reloads
+    weights. Only the worker thread of a device uses a pipeline, so one instance per
+    model and name is enough.
+    """
+
+    def __init__(self):
+        self.defaults = {}
+        self.schedulers = {}
+        self._lock = threading.Lock()
+
+    def get(self, pipeline, model, name):
+        if name not in SCHEDULERS:
+            raise ValueError(f"Unknown scheduler: {name}")
+        with self._lock:
+            default = self.defaults.setdefault(model, pipeline.scheduler)
+            if SCHEDULERS[name] is None:
+                return default
+            key = (model, name)
+            if key not in self.schedulers:
+                scheduler_class, overrides = SCHEDULERS[name]
+                self.schedulers[key] = scheduler_class.from_config(default.config, **overrides)
+            return self.schedulers[key]
+
+    def clear(self, model=None):
+        # Forget the schedulers of an unloaded model, its next pipeline brings its own default
+        with self._lock:
+            for key in [key for key in self.schedulers if model is None or key[0] == model]:
+                del self.schedulers[key]
+            for key in [key for key in self.defaults if model is None or key == model]:
+                del self.defaults[key]
+
+    @contextmanager
+    def use(self, pipeline, model, name):
+        """
+        Runs a pipeline call with the named scheduler, enabling the adapter it needs
+        and restoring the default scheduler with adapters off afterwards.
+        """
+        if name in (None, "default"):
+            # The pipeline is already in its default state
+            yield None
+            return
+
+        scheduler = self.get(pipeline, model, name)
+        adapter = ADAPTER_SCHEDULERS.get(name)
+        if adapter is not None and adapter not in pipeline_adapters(pipeline):
+            raise ValueError(f"The {name} scheduler needs the {adapter} adapter, which {model} does not have loaded.")
+
+        default = self.defaults[model]
+        pipeline.scheduler = scheduler
+        # Distillation adapters change the UNet's output, so they are only on for their scheduler
+        if adapter is not None:
+            pipeline.set_adapters([adapter])
+            pipeline.enable_lora()
+        try:
+            yield scheduler
+        finally:
+            pipeline.scheduler = default
+            if adapter is not None:
+                pipeline.disable_lora()
@@ -0,0 +1,123 @@
+from sqlalchemy import text
+import re
+
+
+# Tables searched and the model their records belong to
+SEARCH_TABLES = {"ssd-1b": "images", "sdxl": "sdxl_images"}
+
+# PostgreSQL: prompts are matched by full text (stemmed words) or as a substring/fuzzy word
+# match through the pg_trgm GIN index, and ranked by both. The expressions must match the
+# index definitions in db-init/init.py for the indexes to be used.
+POSTGRES_BRANCH = """
+    SELECT id, prompt, {negative_prompt} AS negative_prompt, image_path, timestamp, '{model}' AS model,
+           ts_rank(to_tsvector('english', prompt), websearch_to_tsquery('english', :query))
+               + word_similarity(:query, prompt) AS score
+    FROM {table}
+    WHERE to_tsvector('english', prompt) @@ websearch_to_tsquery('english', :query)
+       OR prompt ILIKE :pattern
+       OR :query <% prompt
+"""
+
+# SQLite: an FTS5 table mirrors the prompts of both tables, kept in sync by triggers.
+# Only the prompt is indexed, the other columns are carried along for the results.
+SQLITE_SEARCH_TABLE = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS prompt_search USING fts5(
+        prompt, negative_prompt UNINDEXED, image_path UNINDEXED, timestamp UNINDEXED,
+        model UNINDEXED, record_id UNINDEXED, tokenize='porter unicode61'
+    )
+"""
+SQLITE_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN
+        INSERT INTO prompt_search (prompt, negative_prompt, image_path, timestamp, model, record_id)
+        VALUES (new.prompt, {new_negative_prompt}, new.image_path, new.timestamp, '{model}', new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN
+        DELETE FROM prompt_search WHERE model = '{model}' AND record_id = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE ON {table} BEGIN
+        DELETE FROM prompt_search WHERE model = '{model}' AND record_id = old.id;
+        INSERT INTO prompt_search (prompt, negative_prompt, image_path, timestamp, model, record_id)
+        VALUES (new.prompt, {new_negative_prompt}, new.image_path, new.timestamp, '{model}', new.id);
+    END
+    """,
+)
+SQLITE_BACKFILL = """
+    INSERT INTO prompt_search (prompt, negative_prompt, image_path, timestamp, model, record_id)
+    SELECT prompt, {negative_prompt}, image_path, timestamp, '{model}', id FROM {table}
+"""
+
+
+def negative_prompt_column(model, prefix=""):
+    # Only SSD-1B records have a negative prompt
+    return f"{prefix}negative_prompt" if model == "ssd-1b" else "NULL"
+
+
+def escape_like(value):
+    return re.sub(r"([\\%_])", r"\\\1", value)
+
+
+def fts5_query(query):
+    """
+    Turns free text into an FTS5 query matching every word, the last one as a prefix.
+    Quoting each word keeps FTS5 operators in the input from being interpreted.
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    terms = ['"' + word.replace('"', '""') + '"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def postgres_search_query(query, models, limit, offset):
+    branches = [
+        POSTGRES_BRANCH.format(table=SEARCH_TABLES[model], model=model, negative_prompt=negative_prompt_column(model))
+        for model in models
+    ]
+    sql = " UNION ALL ".join(branches) + " ORDER BY score DESC, timestamp DESC, id DESC LIMIT :limit OFFSET :offset"
+    return text(sql).bindparams(
+        query=query, pattern=f"%{escape_like(query)}%", limit=limit, offset=offset
+    )
+
+
+def sqlite_search_query(query, models, limit, offset):
+    match = fts5_query(query)
+    if match is None:
+        return None
+    placeholders = ", ".join(f":model_{index}" for index in range(len(models)))
+    # bm25 is lower for better matches
+    sql = f"""
+        SELECT record_id AS id, prompt, negative_prompt, image_path, timestamp, model,
+               -bm25(prompt_search) AS score
+        FROM prompt_search
+        WHERE prompt_search MATCH :match AND model IN ({placeholders})
+        ORDER BY bm25(prompt_search), timestamp DESC
+        LIMIT :limit OFFSET :offset
+    """
+    models_params = {f"model_{index}": model for index, model in enumerate(models)}
+    return text(sql).bindparams(match=match, limit=limit, offset=offset, **models_params)
+
+
+async def ensure_sqlite_search_index(database):
+    """
+    Creates the FTS5 index and its sync triggers on SQLite, filling it from existing records
+    the first time.
+    """
+    exists = await database.fetch_val(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'prompt_search'"
+    )
+    await database.execute(SQLITE_SEARCH_TABLE)
+    for model, table in SEARCH_TABLES.items():
+        for trigger in SQLITE_TRIGGERS:
+            await database.execute(trigger.format(
+                table=table, model=model, new_negative_prompt=negative_prompt_column(model, "new.")
+            ))
+        if not exists:
+            await database.execute(SQLITE_BACKFILL.format(
+                table=table, model=model, negative_prompt=negative_prompt_column(model)
+            ))
@@ -0,0 +1,142 @@
+import tempfile
+import hashlib
+import os
+
+
+def shard_prefix(name, depth=2):
+    """
+    Spreads files over depth levels of 256 subdirectories using a hash of their name,
+    e.g. depth 2 turns "<id>.jpg" into "3f/a2/<id>.jpg".
+    """
+    digest = hashlib.sha256(name.encode()).hexdigest()
+    return "/".join(digest[i * 2:i * 2 + 2] for i in range(depth))
+
+
+class LocalStorage:
+    """
+    Stores images under a root directory, sharded by hash prefix so no directory grows too large.
+    Writes go to a temporary file that is renamed into place, so readers never see partial files.
+    """
+
+    def __init__(self, root="generated_images", shard_depth=2):
+        self.root = root
+        self.shard_depth = shard_depth
+
+    def key_for(self, name):
+        return f"{shard_prefix(name, self.shard_depth)}/{name}"
+
+    def local_path(self, key):
+        # Records from before sharding store the relative path, e.g. generated_images/<id>.jpg
+        if key.startswith(self.root.rstrip("/") + "/") or os.path.isabs(key):
+            return key
+        return os.path.join(self.root, *key.split("/"))
+
+    def put(self, key, data):
+        path = self.local_path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def get(self, key):
+        with open(self.local_path(key), "rb") as f:
+            return f.read()
+
+    def exists(self, key):
+        return os.path.exists(self.local_path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.local_path(key))
+
+    def delete(self, key):
+        if self.exists(key):
+            os.remove(self.local_path(key))
+
+
+class S3Storage:
+    """
+    Stores images in an S3-compatible bucket, so several API nodes can share output.
+    Point `endpoint_url` at a local stand-in such as MinIO for testing.
+    """
+
+    def __init__(self, bucket, prefix="generated_images", endpoint_url=None, shard_depth=2):
+        try:
+            import boto3
+        except ImportError:
+            raise ImportError("The S3 storage backend requires boto3: pip install boto3")
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.shard_depth = shard_depth
+
+    def key_for(self, name):
+        return f"{shard_prefix(name, self.shard_depth)}/{name}"
+
+    def local_path(self, key):
+        # Objects have no local file to send
+        return None
+
+    def object_key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def put(self, key, data):
+        # S3 puts are atomic, readers see either no object or the whole one
+        self.client.put_object(Bucket=self.bucket, Key=self.object_key(key), Body=data)
+
+    def get(self, key):
+        response = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))
+        return response["Body"].read()
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def size(self, key):
+        # A HEAD request, the body is not downloaded
+        response = self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        return response["ContentLength"]
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+
+def create_storage(backend="local", **options):
+    """
+    Builds the storage backend named by SSD_STORAGE_BACKEND.
+    """
+    if backend == "local":
+        return LocalStorage(root=options.get("root") or "generated_images")
+    if backend == "s3":
+        return S3Storage(
+            bucket=options["bucket"],
+            prefix=options.get("prefix") or "generated_images",
+            endpoint_url=options.get("endpoint_url")
+        )
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def storage_from_environment():
+    """
+    Builds the storage backend configured by the SSD_STORAGE_* and SSD_S3_* variables.
+    """
+    return create_storage(
+        os.environ.get("SSD_STORAGE_BACKEND", "local"),
+        root=os.environ.get("SSD_STORAGE_ROOT"),
+        bucket=os.environ.get("SSD_S3_BUCKET"),
+        prefix=os.environ.get("SSD_S3_PREFIX"),
+        endpoint_url=os.environ.get("SSD_S3_ENDPOINT_URL")
+    )
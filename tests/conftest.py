@@ -0,0 +1,45 @@
+import pytest
+import tempfile
+import asyncio
+import os
+import sys
+
+# The modules under test live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Tests never need a GPU, and keep the database and images in a throwaway directory
+work_dir = tempfile.mkdtemp(prefix="ssd-test-")
+os.environ.setdefault("SSD_DEVICE", "cpu")
+os.environ.setdefault("SSD_DATABASE_URL", f"sqlite:///{os.path.join(work_dir, 'test.db')}")
+os.environ.setdefault("SSD_STORAGE_ROOT", os.path.join(work_dir, "images"))
+
+
+@pytest.fixture
+def api_database(tmp_path, monkeypatch):
+    """
+    Points the API at a fresh, connected SQLite database with the tables created.
+    """
+    api = pytest.importorskip("api")
+    databases = pytest.importorskip("databases")
+    import sqlalchemy
+
+    url = f"sqlite:///{tmp_path / 'test.db'}"
+    api.Base.metadata.create_all(sqlalchemy.create_engine(url))
+    database = databases.Database(url)
+    monkeypatch.setattr(api, "database", database)
+    asyncio.run(database.connect())
+    yield database
+    asyncio.run(database.disconnect())
+
+
+@pytest.fixture
+def api_worker(monkeypatch):
+    """
+    Gives the API a fresh worker that is never started, so submitted jobs stay queued until a test resolves them.
+    """
+    api = pytest.importorskip("api")
+    from worker import GenerationWorker
+
+    worker = GenerationWorker(api.registry)
+    monkeypatch.setattr(api, "worker", worker)
+    return worker
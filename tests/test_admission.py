@@ -0,0 +1,125 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from admission import (
+    AdmissionController, MemoryBudgetError, memory_level, is_out_of_memory,
+    FAST, ATTENTION_SLICING, VAE_SLICING, VAE_TILING, CPU_OFFLOAD,
+)
+
+MB = 1024 * 1024
+
+
+def controller(available_bytes, total_bytes=None):
+    """
+    A controller that sees a CUDA device with the given free and total memory.
+    """
+    admission = AdmissionController("cpu")
+    admission.enabled = True
+    admission.available_bytes = lambda: available_bytes
+    admission.total_bytes = lambda: total_bytes or available_bytes
+    return admission
+
+
+def test_estimates_grow_with_resolution_and_shrink_with_each_level():
+    admission = AdmissionController("cpu")
+    small = admission.estimate_bytes("ssd-1b", {"width": 512, "height": 512}, 1)
+    assert admission.estimate_bytes("ssd-1b", {}, 1) == 4 * small
+    estimates = [admission.estimate_bytes("ssd-1b", {}, 4, level) for level in (FAST, ATTENTION_SLICING, VAE_SLICING, VAE_TILING)]
+    assert estimates == sorted(estimates, reverse=True)
+
+
+def test_plan_picks_the_fastest_level_that_fits():
+    sizes = {level: AdmissionController("cpu").estimate_bytes("ssd-1b", {}, 2, level)
+             for level in (FAST, ATTENTION_SLICING, VAE_SLICING, VAE_TILING)}
+    assert controller(sizes[FAST]).plan("ssd-1b", {}, 2) == FAST
+    assert controller(sizes[FAST] - 1).plan("ssd-1b", {}, 2) == ATTENTION_SLICING
+    assert controller(sizes[VAE_SLICING]).plan("ssd-1b", {}, 2) == VAE_SLICING
+    assert controller(sizes[VAE_TILING] - 1).plan("ssd-1b", {}, 2) == CPU_OFFLOAD
+
+
+def test_other_models_are_evicted_before_the_call_slows_down():
+    fast = AdmissionController("cpu").estimate_bytes("ssd-1b", {}, 2, FAST)
+    free = [fast - 2 * MB]
+    admission = controller(0)
+    admission.available_bytes = lambda: free[0]
+    evictions = []
+
+    def evict():
+        # One model of 1 MB per eviction, with two to go
+        if len(evictions) == 2:
+            return False
+        evictions.append(None)
+        free[0] += MB
+        return True
+
+    assert admission.plan("ssd-1b", {}, 2, evict=evict) == FAST
+    assert len(evictions) == 2
+
+    # Nothing left to evict, so the call runs at a slower level
+    free[0] = fast - 1
+    assert admission.plan("ssd-1b", {}, 2, evict=evict) == ATTENTION_SLICING
+
+
+def test_batches_are_capped_to_what_fits():
+    one = AdmissionController("cpu").estimate_bytes("ssd-1b", {}, 1, VAE_TILING)
+    assert controller(3 * one).max_batch_size("ssd-1b", {}, 8) == 3
+    # A single job is always admitted
+    assert controller(one // 2).max_batch_size("ssd-1b", {}, 8) == 1
+
+
+def test_requests_that_never_fit_are_rejected():
+    with pytest.raises(MemoryBudgetError):
+        controller(100 * MB).check("ssd-1b", {"width": 4096, "height": 4096})
+    controller(100 * MB, total_bytes=100_000 * MB).check("ssd-1b", {})
+
+
+def test_disabled_without_cuda():
+    admission = AdmissionController("cpu")
+    assert not admission.enabled
+    assert admission.plan("ssd-1b", {"width": 8192, "height": 8192}, 16) == FAST
+    assert admission.max_batch_size("ssd-1b", {}, 8) == 8
+    assert admission.stats() == {"enabled": False}
+
+
+def test_observed_peaks_scale_the_estimates():
+    admission = AdmissionController("cpu")
+    estimate = admission.estimate_bytes("ssd-1b", {}, 1)
+    admission.record("ssd-1b", {}, 1, FAST, 2 * estimate)
+    assert admission.estimate_bytes("ssd-1b", {}, 1) == 2 * estimate
+    # Smaller peaks only pull the scale down slowly
+    admission.record("ssd-1b", {}, 1, FAST, estimate)
+    assert admission.scales["ssd-1b"] == pytest.approx(1.9)
+    admission.raise_scale("ssd-1b", 2.0)
+    assert admission.scales["ssd-1b"] == pytest.approx(3.8)
+
+
+class SlicingPipeline:
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith(("enable_", "disable_")) or name in ("remove_all_hooks", "to"):
+            return lambda *args, **kwargs: self.calls.append(name)
+        raise AttributeError(name)
+
+
+def test_memory_level_enables_each_option_and_restores_the_fast_path():
+    pipeline = SlicingPipeline()
+    with memory_level(pipeline, CPU_OFFLOAD, "cuda:0"):
+        assert pipeline.calls == [
+            "enable_attention_slicing", "enable_vae_slicing", "enable_vae_tiling", "enable_sequential_cpu_offload"
+        ]
+    assert pipeline.calls[4:] == [
+        "remove_all_hooks", "to", "disable_vae_tiling", "disable_vae_slicing", "disable_attention_slicing"
+    ]
+
+    pipeline = SlicingPipeline()
+    with memory_level(pipeline, FAST, "cuda:0"):
+        pass
+    assert pipeline.calls == []
+
+
+def test_out_of_memory_is_recognized():
+    assert is_out_of_memory(RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB"))
+    assert not is_out_of_memory(RuntimeError("boom"))
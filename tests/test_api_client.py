@@ -0,0 +1,100 @@
+import pytest
+
+pytest.importorskip("requests")
+
+import api_client
+import requests
+
+
+class FakeResponse:
+    def __init__(self, payload=None, status_code=200, content=b""):
+        self.payload = payload
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+
+
+class FakeSession:
+    """
+    Answers GETs from a dict of URL to response and records every request.
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, params=None, timeout=None):
+        self.requests.append(("GET", url, params))
+        return self.responses[url]
+
+    def post(self, url, **kwargs):
+        self.requests.append(("POST", url, None))
+        return FakeResponse({"status": "success"})
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = FakeSession({
+        api_client.url("/database-info/"): FakeResponse({"total_records": 3}),
+        api_client.url("/history/"): FakeResponse({"records": [], "next_cursor": None}),
+        api_client.url("/images/abc/thumb"): FakeResponse(content=b"thumbnail"),
+    })
+    monkeypatch.setattr(api_client, "session", session)
+    monkeypatch.setattr(api_client, "response_cache", api_client.ResponseCache(ttl=60))
+    monkeypatch.setattr(api_client, "thumbnails", type(api_client.thumbnails)())
+    return session
+
+
+def test_responses_are_reused_until_something_changes(session):
+    assert api_client.database_info() == {"total_records": 3}
+    assert api_client.database_info() == {"total_records": 3}
+    assert len(session.requests) == 1
+
+    api_client.clear_database()
+    api_client.database_info()
+    assert [request[0] for request in session.requests] == ["GET", "POST", "GET"]
+
+
+def test_cache_is_keyed_by_parameters(session):
+    api_client.history_page(limit=10)
+    api_client.history_page(limit=10, model=None)
+    api_client.history_page(limit=20)
+    assert [request[2] for request in session.requests] == [{"limit": 10}, {"limit": 20}]
+
+
+def test_stale_entries_expire(session, monkeypatch):
+    monkeypatch.setattr(api_client, "response_cache", api_client.ResponseCache(ttl=-1))
+    api_client.database_info()
+    api_client.database_info()
+    assert len(session.requests) == 2
+
+
+def test_errors_are_not_cached(session):
+    session.responses[api_client.url("/database-info/")] = FakeResponse(status_code=500)
+    with pytest.raises(requests.HTTPError):
+        api_client.database_info()
+    session.responses[api_client.url("/database-info/")] = FakeResponse({"total_records": 4})
+    assert api_client.database_info() == {"total_records": 4}
+
+
+def test_image_urls_come_from_the_record():
+    record = {"image_path": "3f/a2/abc.jpg"}
+    assert api_client.image_url(record) == api_client.url("/images/abc")
+    assert api_client.image_url(record, thumb=True) == api_client.url("/images/abc/thumb")
+
+
+def test_prefetched_thumbnails_are_served_from_memory(session):
+    record = {"image_path": "abc.jpg"}
+    assert api_client.thumbnail(record) == api_client.url("/images/abc/thumb")
+    api_client.prefetch_thumbnails([record])
+    api_client.thumbnails[api_client.image_url(record, thumb=True)].result(timeout=5)
+    assert api_client.thumbnail(record) == b"thumbnail"
+    # Already fetched, so not fetched again
+    api_client.prefetch_thumbnails([record])
+    assert len([request for request in session.requests if request[1].endswith("/thumb")]) == 1
@@ -0,0 +1,137 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+import batch_generate
+from benchmark import FakePipeline
+from admission import MemoryBudgetError
+from worker import GenerationWorker
+import worker as worker_module
+from records import ImageRecord, SDXLImageRecord
+from storage import LocalStorage
+from images import thumbnail_key
+from latents import decode_latents
+from types import SimpleNamespace
+import sqlalchemy
+import functools
+import json
+
+
+def write_lines(path, *lines):
+    path.write_text("".join((line if isinstance(line, str) else json.dumps(line)) + "\n" for line in lines))
+    return str(path)
+
+
+def test_checkpoint_skips_a_line_cut_short(tmp_path):
+    path = write_lines(tmp_path / "checkpoint", {"key": "1"}, {"key": "a"}, '{"key": "3')
+    assert batch_generate.load_checkpoint(path) == {"1", "a"}
+    assert batch_generate.load_checkpoint(str(tmp_path / "missing")) == set()
+
+
+def test_invalid_lines_are_skipped(tmp_path):
+    path = write_lines(
+        tmp_path / "prompts.jsonl",
+        {"prompt": "a", "seed": 7, "extra": "ignored"},
+        "not json",
+        {"prompt": "b", "model": "sd-1.5"},
+        {"negative_prompt": "no prompt"},
+        {"prompt": "c", "scheduler": "nope"},
+        "",
+        {"id": "last", "prompt": "d", "model": "sdxl", "scheduler": "default"},
+    )
+    assert list(batch_generate.read_prompts(path, "ssd-1b")) == [
+        ("1", "ssd-1b", {"prompt": "a", "seed": 7}),
+        ("last", "sdxl", {"prompt": "d"}),
+    ]
+
+
+@pytest.fixture
+def fake_models(monkeypatch, tmp_path):
+    loader = functools.partial(FakePipeline, step_ms=0, image_size=16, steps=2)
+    monkeypatch.setattr(batch_generate, "MODEL_LOADERS", {"ssd-1b": loader, "sdxl": loader})
+    url = f"sqlite:///{tmp_path / 'batch.db'}"
+    monkeypatch.setattr(batch_generate, "DATABASE_URL", url)
+    monkeypatch.setenv("SSD_STORAGE_ROOT", str(tmp_path / "images"))
+    return sqlalchemy.create_engine(url)
+
+
+def arguments(prompts, **overrides):
+    options = {
+        "prompts": prompts, "model": "ssd-1b", "batch_size": 4, "max_wait_ms": 50, "window": 8,
+        "save_workers": 2, "commit_every": 2, "format": "png", "quality": 75, "checkpoint": None,
+        "report_every": 30, "latent_first": False,
+    }
+    options.update(overrides)
+    return SimpleNamespace(**options)
+
+
+def test_run_records_every_line_and_resumes(tmp_path, fake_models):
+    prompts = write_lines(
+        tmp_path / "prompts.jsonl",
+        *[{"prompt": f"prompt {i}", "negative_prompt": "blurry"} for i in range(5)],
+        {"prompt": "an sdxl prompt", "model": "sdxl"},
+    )
+    report = batch_generate.run(arguments(prompts))
+    assert (report["completed"], report["failed"], report["skipped"]) == (6, 0, 0)
+    assert batch_generate.load_checkpoint(report["checkpoint"]) == {str(i) for i in range(1, 7)}
+
+    with fake_models.connect() as connection:
+        images = connection.execute(sqlalchemy.select([ImageRecord.__table__.c.image_path])).fetchall()
+        sdxl = connection.execute(sqlalchemy.select([SDXLImageRecord.__table__.c.image_path])).fetchall()
+    assert (len(images), len(sdxl)) == (5, 1)
+    assert all(row[0].endswith(".png") for row in images)
+    assert (tmp_path / "images" / images[0][0]).exists()
+
+    # Everything was checkpointed, so a second run only skips
+    report = batch_generate.run(arguments(prompts))
+    assert (report["completed"], report["skipped"]) == (0, 6)
+
+
+def test_latent_first_run_stores_latents_and_previews(tmp_path, fake_models):
+    prompts = write_lines(tmp_path / "prompts.jsonl", {"prompt": "a cat"}, {"prompt": "a dog"})
+    report = batch_generate.run(arguments(prompts, latent_first=True))
+    assert (report["completed"], report["failed"]) == (2, 0)
+
+    with fake_models.connect() as connection:
+        keys = [row[0] for row in connection.execute(sqlalchemy.select([ImageRecord.__table__.c.image_path]))]
+    storage = LocalStorage(str(tmp_path / "images"))
+    for key in keys:
+        latents, header = decode_latents(storage.get(key))
+        assert (header["model"], header["format"]) == ("ssd-1b", "png")
+        assert latents.shape == (4, 8, 8)
+        assert storage.exists(thumbnail_key(key, batch_generate.THUMBNAIL_SIZES[0]))
+
+
+def test_refused_prompt_fails_on_its_own(tmp_path, fake_models, monkeypatch):
+    submit = GenerationWorker.submit
+
+    def refuse_large(self, model, **params):
+        if params["prompt"] == "too large":
+            raise MemoryBudgetError("Request needs more memory than the device has.")
+        return submit(self, model, **params)
+
+    monkeypatch.setattr(GenerationWorker, "submit", refuse_large)
+    prompts = write_lines(tmp_path / "prompts.jsonl", {"prompt": "a"}, {"prompt": "too large"}, {"prompt": "b"})
+    report = batch_generate.run(arguments(prompts))
+    assert (report["completed"], report["failed"]) == (2, 1)
+
+    lines = [json.loads(line) for line in open(report["checkpoint"])]
+    assert {"failed": "2", "error": "Request needs more memory than the device has."} in lines
+    # Not marked done, so a resumed run tries it again
+    assert batch_generate.load_checkpoint(report["checkpoint"]) == {"1", "3"}
+
+
+def test_worker_uses_the_shared_settings_with_the_batching_arguments(tmp_path, fake_models, monkeypatch):
+    built = []
+
+    def build_worker(loaders, settings, release_unused=None):
+        built.append(settings)
+        return worker_module.build_worker(loaders, settings, release_unused)
+
+    monkeypatch.setattr(batch_generate, "build_worker", build_worker)
+    monkeypatch.setitem(batch_generate.WORKER_SETTINGS, "idle_seconds", 30.0)
+    prompts = write_lines(tmp_path / "prompts.jsonl", {"prompt": "a"})
+    batch_generate.run(arguments(prompts, batch_size=3, window=5))
+    assert built[0]["idle_seconds"] == 30.0
+    assert (built[0]["max_batch_size"], built[0]["max_queue_size"], built[0]["max_wait_ms"]) == (3, 5, 50)
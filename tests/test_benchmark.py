@@ -0,0 +1,68 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from benchmark import FakePipeline, percentile, summarize
+from latents import vae_decode
+from schedulers import SchedulerCache
+from embedding_cache import PromptEmbeddingCache
+from model_registry import ModelRegistry
+from worker import GenerationWorker
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 0.50) == 50
+    assert percentile(values, 0.95) == 95
+    assert percentile(values, 0.99) == 99
+    assert percentile([7], 0.99) == 7
+    assert percentile([], 0.5) is None
+
+
+def test_summary():
+    summary = summarize([30.0, 10.0, 20.0], errors=1, elapsed=2.0)
+    assert summary == {
+        "requests": 3,
+        "errors": 1,
+        "throughput_rps": 1.5,
+        "p50_ms": 20.0,
+        "p95_ms": 30.0,
+        "p99_ms": 30.0,
+        "max_ms": 30.0,
+    }
+    assert summarize([], errors=0, elapsed=0)["throughput_rps"] is None
+
+
+def test_fake_pipeline_runs_in_the_worker():
+    pipeline = FakePipeline(step_ms=0, image_size=16, steps=3)
+    worker = GenerationWorker(
+        ModelRegistry({"ssd-1b": lambda: pipeline}, device="cpu"),
+        max_wait_ms=100,
+        embedding_cache=PromptEmbeddingCache()
+    )
+    jobs = [worker.submit("ssd-1b", prompt=prompt, negative_prompt="blurry") for prompt in ("a", "b")]
+    worker._run_batch(worker._collect_batch())
+    for job in jobs:
+        image, = job.future.result(timeout=0)
+        assert image.size == (16, 16)
+        assert (job.step, job.total_steps) == (3, 3)
+
+
+def test_fake_pipeline_swaps_in_a_requested_scheduler():
+    pipeline = FakePipeline(step_ms=0, image_size=16, steps=2)
+    default = pipeline.scheduler
+    worker = GenerationWorker(ModelRegistry({"ssd-1b": lambda: pipeline}, device="cpu"), schedulers=SchedulerCache())
+    job = worker.submit("ssd-1b", prompt="a", scheduler="dpmpp_2m_karras")
+    worker._run_batch(worker._collect_batch())
+    image, = job.future.result(timeout=0)
+    assert image.size == (16, 16)
+    scheduler = worker.schedulers.schedulers[("ssd-1b", "dpmpp_2m_karras")]
+    assert scheduler.config.use_karras_sigmas
+    assert scheduler.config.beta_schedule == default.config["beta_schedule"]
+    assert pipeline.scheduler is default
+
+
+def test_fake_pipeline_decodes_latents():
+    pipeline = FakePipeline(step_ms=0, image_size=16, steps=2)
+    image = vae_decode(pipeline, torch.zeros(4, 2, 2, dtype=torch.float16))
+    assert image.size == (16, 16)
@@ -0,0 +1,131 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from embedding_cache import PromptEmbeddingCache, encoder_key, combine_stats
+
+
+def embeds(elements=4):
+    # Four fp32 tensors, like the outputs of encode_prompt
+    return tuple(torch.zeros(elements) for _ in range(4))
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = PromptEmbeddingCache(max_entries=2)
+    cache.put(("ssd-1b", "a", None), embeds())
+    cache.put(("ssd-1b", "b", None), embeds())
+    assert cache.get(("ssd-1b", "a", None)) is not None
+    cache.put(("ssd-1b", "c", None), embeds())
+    assert cache.get(("ssd-1b", "b", None)) is None
+    assert cache.get(("ssd-1b", "a", None)) is not None
+    assert cache.evictions == 1
+
+
+def test_byte_bound():
+    # Each entry holds 4 tensors of 4 fp32 values, 64 bytes
+    cache = PromptEmbeddingCache(max_entries=10, max_bytes=128)
+    for prompt in ("a", "b", "c"):
+        cache.put(("ssd-1b", prompt, None), embeds())
+    assert cache.total_bytes == 128
+    assert cache.get(("ssd-1b", "a", None)) is None
+
+
+def test_entry_larger_than_the_cache_is_not_kept():
+    cache = PromptEmbeddingCache(max_bytes=32)
+    cache.put(("ssd-1b", "a", None), embeds())
+    assert cache.get(("ssd-1b", "a", None)) is None
+    assert cache.total_bytes == 0
+
+
+def test_hits_and_misses():
+    cache = PromptEmbeddingCache()
+    cache.put(("ssd-1b", "a", None), embeds())
+    cache.get(("ssd-1b", "a", None))
+    cache.get(("ssd-1b", "missing", None))
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.clear()
+    assert cache.get(("ssd-1b", "a", None)) is None
+    assert cache.total_bytes == 0
+
+
+class EncodingPipeline:
+    """
+    Counts encode_prompt calls and returns (batch, tokens, dim) and (batch, dim) tensors like SDXL's.
+    Pipelines built from the same text encoders share them, like SSD-1B and SDXL.
+    """
+
+    device = torch.device("cpu")
+
+    def __init__(self, text_encoder=None, text_encoder_2=None):
+        self.text_encoder = text_encoder or torch.nn.Linear(2, 2)
+        self.text_encoder_2 = text_encoder_2 or torch.nn.Linear(2, 2)
+        self.encoded = []
+
+    def encode_prompt(self, prompt, device, num_images_per_prompt, do_classifier_free_guidance, negative_prompt):
+        self.encoded.append((prompt, negative_prompt))
+        return (torch.ones(1, 77, 8), torch.zeros(1, 77, 8), torch.ones(1, 8), torch.zeros(1, 8))
+
+
+def test_encode_batch_encodes_each_prompt_once():
+    cache = PromptEmbeddingCache()
+    pipeline = EncodingPipeline()
+    params = cache.encode_batch(pipeline, ["a", "b", "a"], ["blurry", "blurry", "blurry"])
+    assert pipeline.encoded == [("a", "blurry"), ("b", "blurry")]
+    assert params["prompt_embeds"].shape == (3, 77, 8)
+    assert params["negative_prompt_embeds"].shape == (3, 77, 8)
+    assert params["pooled_prompt_embeds"].shape == (3, 8)
+    assert params["negative_pooled_prompt_embeds"].shape == (3, 8)
+
+    cache.encode_batch(pipeline, ["b"], ["blurry"])
+    assert len(pipeline.encoded) == 2
+    assert cache.stats()["hits"] == 2
+
+
+def test_negative_prompt_is_part_of_the_key():
+    cache = PromptEmbeddingCache()
+    pipeline = EncodingPipeline()
+    cache.encode(pipeline, "a", "blurry")
+    cache.encode(pipeline, "a", "ugly")
+    cache.encode(pipeline, "a")
+    assert len(pipeline.encoded) == 3
+
+
+def test_pipelines_sharing_text_encoders_share_entries():
+    cache = PromptEmbeddingCache()
+    ssd_1b = EncodingPipeline()
+    sdxl = EncodingPipeline(ssd_1b.text_encoder, ssd_1b.text_encoder_2)
+    cache.encode(ssd_1b, "a")
+    cache.encode(sdxl, "a")
+    assert ssd_1b.encoded == [("a", None)]
+    assert sdxl.encoded == []
+
+    other = EncodingPipeline()
+    cache.encode(other, "a")
+    assert other.encoded == [("a", None)]
+
+
+def test_release_keeps_the_entries_of_loaded_text_encoders():
+    cache = PromptEmbeddingCache()
+    ssd_1b = EncodingPipeline()
+    sdxl = EncodingPipeline(ssd_1b.text_encoder, ssd_1b.text_encoder_2)
+    other = EncodingPipeline()
+    for pipeline in (ssd_1b, other):
+        cache.encode(pipeline, "a")
+
+    # ssd-1b was unloaded, but sdxl still uses its text encoders
+    cache.release([sdxl])
+    assert [key[0] for key in cache.entries] == [encoder_key(sdxl)]
+    cache.release([])
+    assert cache.entries == {}
+    assert cache.total_bytes == 0
+
+
+def test_stats_of_several_caches_add_up():
+    first, second = PromptEmbeddingCache(max_entries=2), PromptEmbeddingCache(max_entries=3)
+    first.put(("ssd-1b", "a", None), embeds())
+    first.get(("ssd-1b", "a", None))
+    second.get(("ssd-1b", "a", None))
+    combined = combine_stats([first.stats(), second.stats()])
+    assert (combined["entries"], combined["max_entries"], combined["bytes"]) == (1, 5, 64)
+    assert (combined["hits"], combined["misses"], combined["hit_rate"]) == (1, 1, 0.5)
+    assert combine_stats([])["hit_rate"] == 0.0
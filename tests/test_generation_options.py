@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("torch")
+
+import api
+from fastapi import HTTPException
+
+
+def test_only_given_settings_are_passed_on():
+    assert api.generation_options() == {}
+    assert api.generation_options(num_inference_steps=20, width=768, scheduler="euler") == {
+        "num_inference_steps": 20, "width": 768, "scheduler": "euler"
+    }
+    # The default scheduler keeps requests batchable with ones that name none
+    assert api.generation_options(scheduler="default") == {}
+
+
+@pytest.mark.parametrize("options", [
+    {"num_inference_steps": 0},
+    {"num_inference_steps": 10_000},
+    {"guidance_scale": -1},
+    {"width": 1000},
+    {"height": 128},
+    {"scheduler": "nope"},
+])
+def test_invalid_settings_are_rejected(options):
+    with pytest.raises(HTTPException) as error:
+        api.generation_options(**options)
+    assert error.value.status_code == 400
+
+
+def test_lcm_needs_the_adapter(monkeypatch):
+    monkeypatch.setattr(api, "LCM_LORA", False)
+    with pytest.raises(HTTPException):
+        api.generation_options(scheduler="lcm")
@@ -0,0 +1,115 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("databases")
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+import api
+from api import encode_history_cursor, decode_history_cursor
+from fastapi import HTTPException
+from datetime import datetime, timedelta, timezone
+import asyncio
+
+
+def test_cursor_round_trip():
+    timestamp = datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+    cursor = encode_history_cursor({"timestamp": timestamp, "model": "sdxl", "id": 42})
+    assert decode_history_cursor(cursor) == (timestamp, "sdxl", 42)
+
+
+def test_cursor_is_url_safe():
+    timestamp = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    cursor = encode_history_cursor({"timestamp": timestamp, "model": "ssd-1b", "id": 2 ** 40})
+    assert not set(cursor) & set("+/?&")
+
+
+@pytest.mark.parametrize("cursor", ["", "not a cursor", "W10=", "WyJ4IiwgInNzZC0xYiIsIDFd"])
+def test_invalid_cursor(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_history_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+START = datetime(2024, 5, 1)
+
+
+@pytest.fixture
+def history(api_database):
+    """
+    Five SSD-1B and five SDXL records, one minute apart and interleaved, with the last two sharing a timestamp.
+    """
+    async def insert():
+        for i in range(10):
+            timestamp = START + timedelta(minutes=min(i, 8))
+            if i % 2:
+                query = api.SDXLImageRecord.__table__.insert().values(
+                    prompt=f"prompt {i}", image_path=f"{i}.jpg", timestamp=timestamp
+                )
+            else:
+                query = api.ImageRecord.__table__.insert().values(
+                    prompt=f"prompt {i}", negative_prompt="blurry", image_path=f"{i}.jpg", timestamp=timestamp
+                )
+            await api_database.execute(query)
+
+    asyncio.run(insert())
+    return api_database
+
+
+def read_history(**options):
+    options = {"limit": 50, "cursor": None, "model": None, "since": None, "until": None, **options}
+    return asyncio.run(api.get_history(**options))
+
+
+def prompts(page):
+    return [record["prompt"] for record in page["records"]]
+
+
+def test_history_merges_both_models_newest_first(history):
+    page = read_history()
+    # prompt 8 and 9 share a timestamp, so the model breaks the tie
+    assert prompts(page) == [f"prompt {i}" for i in (8, 9, 7, 6, 5, 4, 3, 2, 1, 0)]
+    assert page["next_cursor"] is None
+    assert {record["model"] for record in page["records"]} == {"ssd-1b", "sdxl"}
+    assert page["records"][1]["negative_prompt"] is None
+
+
+def test_history_pages_cover_every_record_once(history):
+    seen = []
+    cursor = None
+    while True:
+        page = read_history(limit=3, cursor=cursor)
+        assert len(page["records"]) <= 3
+        seen.extend(prompts(page))
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == prompts(read_history())
+
+
+def test_history_filters_by_model_and_time(history):
+    assert prompts(read_history(model="sdxl")) == ["prompt 9", "prompt 7", "prompt 5", "prompt 3", "prompt 1"]
+    window = read_history(since=START + timedelta(minutes=2), until=START + timedelta(minutes=5))
+    assert prompts(window) == ["prompt 4", "prompt 3", "prompt 2"]
+
+
+@pytest.mark.parametrize("options", [{"limit": 0}, {"limit": 501}, {"model": "sd-1.5"}])
+def test_history_rejects_bad_options(history, options):
+    with pytest.raises(HTTPException) as error:
+        read_history(**options)
+    assert error.value.status_code == 400
+
+
+def test_records_still_being_written_come_first(history, monkeypatch):
+    monkeypatch.setattr(api, "recorder", api.RecordWriter(history, flush_interval=60))
+    asyncio.run(api.recorder.add(api.ImageRecord.__table__, "ssd-1b", api.record_values("ssd-1b", {"prompt": "new"}, "new.jpg")))
+
+    page = read_history(limit=3)
+    assert prompts(page) == ["new", "prompt 8", "prompt 9", "prompt 7"]
+    assert page["records"][0]["id"] is None
+    # The cursor points at the last written row, so the next page starts right after it
+    assert prompts(read_history(limit=3, cursor=page["next_cursor"]))[0] == "prompt 6"
+    assert prompts(read_history(until=START + timedelta(minutes=2))) == ["prompt 1", "prompt 0"]
+
+    records = asyncio.run(api.get_image_records())
+    assert [record["prompt"] for record in records] == ["new", "prompt 8", "prompt 6", "prompt 4", "prompt 2"]
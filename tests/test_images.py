@@ -0,0 +1,146 @@
+import pytest
+
+pytest.importorskip("PIL")
+pytest.importorskip("starlette")
+pytest.importorskip("httpx")
+
+from images import parse_range, thumbnail_key, save_thumbnails, ensure_thumbnail, image_file_response, image_bytes_response
+from storage import LocalStorage
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from PIL import Image
+from collections import OrderedDict
+import asyncio
+import uuid
+import io
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=990-5000", (990, 999)),
+    ("bytes=999-999", (999, 999)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", [
+    None,
+    "",
+    "items=0-10",
+    "bytes=0-10,20-30",
+    "bytes=1000-",
+    "bytes=50-10",
+    "bytes=-0",
+    "bytes=a-b",
+])
+def test_parse_range_unusable(header):
+    assert parse_range(header, 1000) is None
+
+
+def test_thumbnail_key():
+    assert thumbnail_key("3f/a2/abc.png", 256) == "3f/a2/abc_thumb_256.jpg"
+
+
+def test_thumbnails_fit_their_size(tmp_path):
+    storage = LocalStorage(str(tmp_path))
+    image = Image.new("RGB", (1024, 512))
+    keys = save_thumbnails(storage, image, "ab/cd/abc.png", [128, 256])
+    assert keys == ["ab/cd/abc_thumb_128.jpg", "ab/cd/abc_thumb_256.jpg"]
+    assert [Image.open(storage.local_path(key)).size for key in keys] == [(128, 64), (256, 128)]
+
+    # Images saved before thumbnails existed get theirs on first request
+    storage.delete(keys[0])
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    storage.put("ab/cd/abc.png", buffer.getvalue())
+    assert ensure_thumbnail(storage, "ab/cd/abc.png", 128) == keys[0]
+    assert storage.exists(keys[0])
+
+
+# Local files and bytes from a remote backend must be served alike
+@pytest.fixture(params=["file", "bytes"])
+def client(request, tmp_path):
+    path = tmp_path / "image.jpg"
+    path.write_bytes(bytes(range(256)) * 4)
+
+    async def endpoint(http_request):
+        if request.param == "file":
+            return image_file_response(http_request, str(path))
+        return image_bytes_response(http_request, "image.jpg", path.read_bytes())
+
+    return TestClient(Starlette(routes=[Route("/image", endpoint)]))
+
+
+def test_full_response_is_cacheable(client):
+    response = client.get("/image")
+    assert response.status_code == 200
+    assert len(response.content) == 1024
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["etag"]
+
+
+def test_matching_etag_is_not_modified(client):
+    etag = client.get("/image").headers["etag"]
+    response = client.get("/image", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert client.get("/image", headers={"If-None-Match": '"stale"'}).status_code == 200
+
+
+def test_byte_range(client):
+    response = client.get("/image", headers={"Range": "bytes=256-259"})
+    assert response.status_code == 206
+    assert response.content == bytes([0, 1, 2, 3])
+    assert response.headers["content-range"] == "bytes 256-259/1024"
+
+
+def test_unsatisfiable_range(client):
+    response = client.get("/image", headers={"Range": "bytes=2000-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */1024"
+
+
+def test_stale_if_range_gets_the_whole_file(client):
+    response = client.get("/image", headers={"Range": "bytes=0-9", "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert len(response.content) == 1024
+
+
+@pytest.fixture
+def recorded_image(api_database, monkeypatch):
+    """
+    An image with a history record, in a storage that counts its probes.
+    """
+    api = pytest.importorskip("api")
+    probes = []
+    exists = api.storage.exists
+    monkeypatch.setattr(api.storage, "exists", lambda key: probes.append(key) or exists(key))
+    monkeypatch.setattr(api, "image_keys", OrderedDict())
+    image_id = str(uuid.uuid4())
+    image_key = api.storage.key_for(f"{image_id}.png")
+    query = api.ImageRecord.__table__.insert().values(prompt="a cat", image_path=image_key)
+    asyncio.run(api_database.execute(query))
+    return api, image_id, image_key, probes
+
+
+def test_recorded_image_is_found_without_probing_storage(recorded_image):
+    api, image_id, image_key, probes = recorded_image
+    assert asyncio.run(api.resolve_image_key(image_id)) == image_key
+    assert api.image_keys[image_id] == image_key
+    # The second lookup is answered from memory
+    assert asyncio.run(api.resolve_image_key(image_id)) == image_key
+    assert probes == []
+
+
+def test_image_without_a_record_is_probed_for(recorded_image):
+    api, _, _, probes = recorded_image
+    with pytest.raises(api.HTTPException) as error:
+        asyncio.run(api.resolve_image_key(str(uuid.uuid4())))
+    assert error.value.status_code == 404
+    assert len(probes) == len(api.candidate_image_keys(str(uuid.uuid4())))
@@ -0,0 +1,192 @@
+import pytest
+
+sqlalchemy = pytest.importorskip("sqlalchemy")
+databases = pytest.importorskip("databases")
+pytest.importorskip("aiosqlite")
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from job_queue import DurableJobQueue, DurableQueueClient
+from records import Base, ImageRecord
+from worker import QUEUED, RUNNING, COMPLETED, FAILED, CANCELLED
+import asyncio
+import time
+
+OUTPUT = {"format": "jpeg", "quality": 75}
+
+
+def run_with_queue(tmp_path, test, **options):
+    url = f"sqlite:///{tmp_path / 'queue.db'}"
+    Base.metadata.create_all(bind=sqlalchemy.create_engine(url))
+
+    async def main():
+        database = databases.Database(url)
+        await database.connect()
+        try:
+            await test(DurableJobQueue(database, **options))
+        finally:
+            await database.disconnect()
+
+    asyncio.run(main())
+
+
+async def enqueue(job_queue, prompt="a", **options):
+    return await job_queue.enqueue("ssd-1b", {"prompt": prompt}, OUTPUT, **options)
+
+
+def test_claim_takes_the_highest_priority_job_once(tmp_path):
+    async def test(job_queue):
+        low = await enqueue(job_queue, "low")
+        high = await enqueue(job_queue, "high", priority=5)
+
+        claimed = await job_queue.claim("worker-1", ["ssd-1b"])
+        assert [job["id"] for job in claimed] == [high]
+        assert claimed[0]["status"] == RUNNING
+        assert claimed[0]["attempts"] == 1
+        assert claimed[0]["params"] == {"prompt": "high"}
+
+        assert [job["id"] for job in await job_queue.claim("worker-2", ["ssd-1b"], limit=5)] == [low]
+        assert await job_queue.claim("worker-3", ["ssd-1b"]) == []
+
+    run_with_queue(tmp_path, test)
+
+
+def test_claim_only_takes_the_worker_models(tmp_path):
+    async def test(job_queue):
+        await enqueue(job_queue)
+        assert await job_queue.claim("worker-1", ["sdxl"]) == []
+        assert len(await job_queue.claim("worker-1", ["sdxl", "ssd-1b"])) == 1
+
+    run_with_queue(tmp_path, test)
+
+
+def test_complete(tmp_path):
+    async def test(job_queue):
+        job_id = await enqueue(job_queue)
+        await job_queue.claim("worker-1", ["ssd-1b"])
+        await job_queue.complete(job_id, "worker-1", "3f/a2/image.jpg")
+        job = await job_queue.get(job_id)
+        assert job["status"] == COMPLETED
+        assert job["image_path"] == "3f/a2/image.jpg"
+
+    run_with_queue(tmp_path, test)
+
+
+def test_failed_job_is_retried_until_out_of_attempts(tmp_path):
+    async def test(job_queue):
+        job_id = await enqueue(job_queue)
+        for attempt in (1, 2):
+            claimed = await job_queue.claim("worker-1", ["ssd-1b"])
+            assert claimed[0]["attempts"] == attempt
+            await job_queue.fail(job_id, "worker-1", "boom")
+            job = await job_queue.get(job_id)
+            assert job["status"] == QUEUED
+            assert job["worker_id"] is None
+
+        await job_queue.claim("worker-1", ["ssd-1b"])
+        await job_queue.fail(job_id, "worker-1", "boom")
+        job = await job_queue.get(job_id)
+        assert job["status"] == FAILED
+        assert job["error"] == "boom"
+
+    run_with_queue(tmp_path, test, max_attempts=3)
+
+
+def test_expired_lease_returns_the_job_to_another_worker(tmp_path):
+    async def test(job_queue):
+        job_id = await enqueue(job_queue)
+        await job_queue.claim("worker-1", ["ssd-1b"])
+        await asyncio.sleep(0.2)
+
+        claimed = await job_queue.claim("worker-2", ["ssd-1b"])
+        assert [job["id"] for job in claimed] == [job_id]
+        assert claimed[0]["worker_id"] == "worker-2"
+        assert claimed[0]["attempts"] == 2
+
+        # The first worker no longer holds it, and cannot complete or fail it
+        assert await job_queue.heartbeat("worker-1", [job_id]) == {job_id}
+        await job_queue.fail(job_id, "worker-1", "late")
+        assert (await job_queue.get(job_id))["status"] == RUNNING
+
+    run_with_queue(tmp_path, test, lease_seconds=0.1)
+
+
+def test_expired_lease_on_the_last_attempt_fails_the_job(tmp_path):
+    async def test(job_queue):
+        job_id = await enqueue(job_queue)
+        await job_queue.claim("worker-1", ["ssd-1b"])
+        await asyncio.sleep(0.2)
+        await job_queue.expire()
+        job = await job_queue.get(job_id)
+        assert job["status"] == FAILED
+
+    run_with_queue(tmp_path, test, lease_seconds=0.1, max_attempts=1)
+
+
+def test_heartbeat_extends_the_lease(tmp_path):
+    async def test(job_queue):
+        job_id = await enqueue(job_queue)
+        await job_queue.claim("worker-1", ["ssd-1b"])
+        for _ in range(3):
+            await asyncio.sleep(0.1)
+            assert await job_queue.heartbeat("worker-1", [job_id]) == set()
+        assert await job_queue.claim("worker-2", ["ssd-1b"]) == []
+
+    run_with_queue(tmp_path, test, lease_seconds=0.25)
+
+
+def test_waiting_job_past_its_deadline_is_cancelled(tmp_path):
+    async def test(job_queue):
+        job_id = await enqueue(job_queue, deadline=time.time() - 1)
+        assert await job_queue.claim("worker-1", ["ssd-1b"]) == []
+        assert (await job_queue.get(job_id))["status"] == CANCELLED
+
+    run_with_queue(tmp_path, test)
+
+
+def test_cancel_keeps_the_reason_and_stops_the_heartbeat(tmp_path):
+    async def test(job_queue):
+        job_id = await enqueue(job_queue)
+        await job_queue.claim("worker-1", ["ssd-1b"])
+        await job_queue.cancel(job_id, "worker-1", "Job cannot finish before its deadline.")
+        job = await job_queue.get(job_id)
+        assert job["status"] == CANCELLED
+        assert job["error"] == "Job cannot finish before its deadline."
+        assert await job_queue.heartbeat("worker-1", [job_id]) == {job_id}
+
+    run_with_queue(tmp_path, test)
+
+
+def test_complete_writes_the_record_with_the_job(tmp_path):
+    images = ImageRecord.__table__
+
+    async def test(job_queue):
+        job_id = await enqueue(job_queue)
+        await job_queue.claim("worker-1", ["ssd-1b"])
+        record = (images, {"prompt": "a", "negative_prompt": None, "image_path": "3f/a2/image.jpg"})
+        await job_queue.complete(job_id, "worker-1", "3f/a2/image.jpg", record)
+        rows = await job_queue.database.fetch_all(images.select())
+        assert [row["image_path"] for row in rows] == ["3f/a2/image.jpg"]
+
+    run_with_queue(tmp_path, test)
+
+
+def test_client_mirrors_the_job_row(tmp_path):
+    async def test(job_queue):
+        client = DurableQueueClient(job_queue, ["ssd-1b"])
+        with pytest.raises(KeyError):
+            await client.submit("sdxl", prompt="a")
+        job = await client.submit("ssd-1b", output=OUTPUT, prompt="a")
+        assert (await job_queue.get(job.id))["params"] == {"prompt": "a"}
+
+        await job_queue.claim("worker-1", ["ssd-1b"])
+        await job_queue.complete(job.id, "worker-1", "3f/a2/image.png")
+        client.update_job(job, await job_queue.get(job.id))
+        assert job.future.result(timeout=0) == {"image_key": "3f/a2/image.png", "media_type": "image/png"}
+
+        # Jobs submitted through another node are loaded from their row
+        other = await job_queue.enqueue("ssd-1b", {"prompt": "b"}, OUTPUT)
+        loaded = await client.load_job(other)
+        assert (loaded.id, loaded.status, loaded.params) == (other, QUEUED, {"prompt": "b"})
+
+    run_with_queue(tmp_path, test)
@@ -0,0 +1,107 @@
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("torch")
+
+import api
+from worker import Job, JobCancelledError, CANCELLED
+from admission import MemoryBudgetError
+from fastapi.testclient import TestClient
+import asyncio
+import time
+
+
+@pytest.fixture
+def client(api_worker):
+    return TestClient(api.app)
+
+
+def test_deadline_the_queue_cannot_meet_gets_retry_after(client, api_worker):
+    api_worker.batch_seconds = 10.0
+    api_worker.submit("ssd-1b", prompt="ahead")
+    response = client.post("/jobs/", json={"prompt": "a cat", "deadline_seconds": 15})
+    assert response.status_code == 429
+    # Ten seconds of queue, of which five fit before the deadline
+    assert response.headers["retry-after"] in ("5", "6")
+
+
+def test_deadline_shorter_than_a_generation_is_unprocessable(client, api_worker):
+    api_worker.batch_seconds = 10.0
+    response = client.post("/jobs/", json={"prompt": "a cat", "deadline_seconds": 5})
+    assert response.status_code == 422
+    assert "retry-after" not in response.headers
+
+
+def test_cancelled_job_is_gone(client, api_worker):
+    job = api_worker.submit("ssd-1b", prompt="a cat")
+    response = client.post(f"/jobs/{job.id}/cancel")
+    assert response.status_code == 200
+    assert response.json()["status"] == CANCELLED
+    assert client.get(f"/jobs/{job.id}/result").status_code == 410
+    assert client.post(f"/jobs/{job.id}/cancel").status_code == 409
+    assert client.post("/jobs/unknown/cancel").status_code == 404
+
+
+class DisconnectingRequest:
+    def __init__(self):
+        self.connected = True
+
+    async def is_disconnected(self):
+        return not self.connected
+
+
+def test_job_is_cancelled_when_its_last_client_disconnects(api_worker, monkeypatch):
+    monkeypatch.setattr(api, "DISCONNECT_POLL_SECONDS", 0.01)
+
+    async def run():
+        job = api_worker.submit("ssd-1b", prompt="a cat")
+        job.waiters = 0
+        job.save_task = asyncio.ensure_future(asyncio.wrap_future(job.future))
+        first, second = DisconnectingRequest(), DisconnectingRequest()
+        waits = [asyncio.ensure_future(api.wait_for_result(job, request)) for request in (first, second)]
+
+        first.connected = False
+        with pytest.raises(api.ClientDisconnected):
+            await waits[0]
+        # Somebody is still waiting
+        assert not job.cancel_requested.is_set()
+
+        second.connected = False
+        with pytest.raises(api.ClientDisconnected):
+            await waits[1]
+        assert job.status == CANCELLED
+        with pytest.raises(api.JobCancelledError):
+            await job.save_task
+
+    asyncio.run(run())
+
+
+def test_schedule_uses_the_client_id_header():
+    class Request:
+        headers = {"x-client-id": "batch-1"}
+        client = None
+
+    schedule = api.schedule_options(Request(), priority=3, deadline_seconds=60)
+    assert schedule["priority"] == 3
+    assert schedule["client_id"] == "batch-1"
+    assert schedule["deadline"] == pytest.approx(time.time() + 60, abs=1)
+
+
+@pytest.mark.parametrize("deadline, error, status_code", [
+    (None, JobCancelledError("Job was cancelled."), 410),
+    (-1, JobCancelledError("Job passed its deadline."), 504),
+    (None, MemoryBudgetError("Request needs more memory than the device has."), 413),
+    (None, KeyError("Unknown model: ssd-1b"), 400),
+])
+@pytest.mark.parametrize("path, body", [("/generate-image/", {"prompt": "a cat", "negative_prompt": "blurry"}), ("/sdxl-gen/", "a cat")])
+def test_waiting_handlers_answer_like_the_job_endpoints(client, monkeypatch, path, body, deadline, error, status_code):
+    async def submit_job(*args, **kwargs):
+        job = Job("ssd-1b", {"prompt": "a cat"}, deadline=None if deadline is None else time.time() + deadline)
+        job.waiters = 0
+        job.save_task = asyncio.get_event_loop().create_future()
+        job.save_task.set_exception(error)
+        return job
+
+    monkeypatch.setattr(api, "submit_job", submit_job)
+    response = client.post(path, json=body)
+    assert response.status_code == status_code, response.json()
@@ -0,0 +1,141 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("numpy")
+
+from latents import LATENT_MAGIC, encode_latents, decode_latents, is_latent_key, vae_decode
+from admission import MemoryBudgetError
+from images import save_thumbnails
+from previews import latents_to_preview
+from concurrent.futures import Future
+from collections import OrderedDict
+from types import SimpleNamespace
+from PIL import Image
+import asyncio
+import uuid
+import io
+
+
+def test_round_trip():
+    latents = torch.randn(4, 16, 12)
+    data = encode_latents(latents, "ssd-1b", {"format": "webp", "quality": 80})
+    assert data.startswith(LATENT_MAGIC)
+
+    decoded, header = decode_latents(data)
+    assert header == {"model": "ssd-1b", "shape": [4, 16, 12], "format": "webp", "quality": 80}
+    assert decoded.dtype == torch.float16
+    assert torch.equal(decoded, latents.to(torch.float16))
+
+
+def test_rejects_other_files():
+    with pytest.raises(ValueError):
+        decode_latents(b"\xff\xd8\xff\xe0 not latents")
+
+
+def test_is_latent_key():
+    assert is_latent_key("3f/a2/abc.latent")
+    assert not is_latent_key("3f/a2/abc.jpg")
+
+
+class FakeVAE(torch.nn.Module):
+    """
+    Records the latents it decodes, which come back as the "image".
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.post_quant_conv = torch.nn.Conv2d(4, 4, 1)
+        self.config = SimpleNamespace(force_upcast=False, scaling_factor=0.5)
+        self.decoded = []
+
+    @property
+    def dtype(self):
+        return torch.float32
+
+    @property
+    def device(self):
+        return torch.device("cpu")
+
+    def decode(self, latents, return_dict=True):
+        self.decoded.append(latents)
+        return (latents,)
+
+
+def test_vae_decode_scales_a_single_latent():
+    vae = FakeVAE()
+    processor = SimpleNamespace(postprocess=lambda image, output_type: [(image, output_type)])
+    pipeline = SimpleNamespace(vae=vae, image_processor=processor)
+
+    image, output_type = vae_decode(pipeline, torch.ones(4, 8, 8, dtype=torch.float16))
+    assert output_type == "pil"
+    assert image.shape == (1, 4, 8, 8)
+    assert image.dtype == torch.float32
+    assert torch.equal(image, torch.full((1, 4, 8, 8), 2.0))
+
+
+class DecodingWorker:
+    """
+    Stands in for the generation worker, resolving decode jobs with `result`.
+    """
+
+    def __init__(self, result):
+        self.result = result
+        self.decoded = []
+
+    def submit(self, model, latents):
+        self.decoded.append(model)
+        future = Future()
+        if isinstance(self.result, Exception):
+            future.set_exception(self.result)
+        else:
+            future.set_result([self.result])
+        return SimpleNamespace(future=future)
+
+
+@pytest.fixture
+def latent_image(api_database, monkeypatch):
+    """
+    A latent-first image with its record and preview thumbnails, as a generation stores them.
+    """
+    pytest.importorskip("httpx")
+    api = pytest.importorskip("api")
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(api, "image_keys", OrderedDict())
+    image_id = str(uuid.uuid4())
+    latent_key = api.storage.key_for(f"{image_id}.latent")
+    latents = torch.zeros(4, 8, 8)
+    api.storage.put(latent_key, encode_latents(latents, "ssd-1b", {"format": "png", "quality": 75}))
+    save_thumbnails(api.storage, latents_to_preview(latents), latent_key, api.THUMBNAIL_SIZES)
+    asyncio.run(api_database.execute(api.ImageRecord.__table__.insert().values(prompt="a cat", image_path=latent_key)))
+    return api, TestClient(api.app), image_id
+
+
+def test_thumbnails_follow_the_decoded_image(latent_image, monkeypatch):
+    api, client, image_id = latent_image
+    preview = client.get(f"/images/{image_id}/thumb")
+    assert preview.status_code == 200
+    assert preview.headers["cache-control"] == "no-cache"
+
+    monkeypatch.setattr(api, "worker", DecodingWorker(Image.new("RGB", (64, 64), "red")))
+    image = client.get(f"/images/{image_id}")
+    assert image.status_code == 200
+    assert image.headers["content-type"] == "image/png"
+
+    thumbnail = client.get(f"/images/{image_id}/thumb")
+    assert thumbnail.headers["cache-control"] == api.IMMUTABLE_CACHE_CONTROL
+    assert thumbnail.content != preview.content
+    assert Image.open(io.BytesIO(thumbnail.content)).getpixel((0, 0))[0] > 200
+    assert api.worker.decoded == ["ssd-1b"]
+
+
+@pytest.mark.parametrize("error, status_code", [
+    (MemoryBudgetError("Request needs more memory than the device has."), 413),
+    (RuntimeError("VAE failed"), 500),
+])
+def test_decode_errors_become_http_errors(latent_image, monkeypatch, error, status_code):
+    api, client, image_id = latent_image
+    monkeypatch.setattr(api, "worker", DecodingWorker(error))
+    response = client.get(f"/images/{image_id}")
+    assert response.status_code == status_code
+    assert str(error) in response.json()["detail"]
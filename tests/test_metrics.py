@@ -0,0 +1,56 @@
+import pytest
+
+pytest.importorskip("prometheus_client")
+pytest.importorskip("torch")
+
+from prometheus_client import REGISTRY
+from worker import Job, GenerationWorker
+from model_registry import ModelRegistry
+import metrics
+import asyncio
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_stage_time_adds_up_on_the_job_and_in_the_histogram():
+    job = Job("metrics-test", {"prompt": "a"})
+    before = sample("ssd_stage_seconds_count", stage="denoise", model="metrics-test")
+    metrics.observe_stage(job, "denoise", 0.5)
+    metrics.observe_stage(job, "denoise", 0.25)
+    assert job.timings == {"denoise": 0.75}
+    assert job.to_dict()["timings"] == {"denoise": 0.75}
+    assert sample("ssd_stage_seconds_count", stage="denoise", model="metrics-test") == before + 2
+    assert sample("ssd_stage_seconds_sum", stage="denoise", model="metrics-test") == pytest.approx(0.75)
+
+
+def test_latest_is_prometheus_text():
+    content, content_type = metrics.latest()
+    assert content_type.startswith("text/plain")
+    assert b"# TYPE ssd_stage_seconds histogram" in content
+
+
+class FailingPipeline:
+    components = {}
+
+    def to(self, device):
+        return self
+
+    def __call__(self, **params):
+        raise RuntimeError("pipeline failed")
+
+
+def test_failed_job_is_counted_once():
+    api = pytest.importorskip("api")
+    registry = ModelRegistry({"metrics-failing": FailingPipeline}, device="cpu")
+    worker = GenerationWorker(registry)
+    worker.start()
+    try:
+        before = sample("ssd_jobs_total", model="metrics-failing", status="failed")
+        job = worker.submit("metrics-failing", prompt="a")
+        with pytest.raises(RuntimeError):
+            asyncio.run(api.save_job_result(job))
+    finally:
+        worker.stop(timeout=5)
+    assert sample("ssd_jobs_total", model="metrics-failing", status="failed") == before + 1
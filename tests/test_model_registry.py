@@ -0,0 +1,255 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from model_registry import ModelRegistry, UNLOADED, LOADING, CPU, GPU
+import threading
+import time
+
+
+class TrackedLinear(torch.nn.Linear):
+    """
+    Remembers the device it was last moved to instead of moving, so tests can tell CPU from GPU without one.
+    """
+
+    def __init__(self):
+        super().__init__(16, 16)
+        self.device = "cpu"
+
+    def to(self, device):
+        self.device = device
+        return self
+
+
+class ModulePipeline:
+    """
+    A pipeline made of torch modules that records where it is moved.
+    """
+
+    def __init__(self, **modules):
+        self.components = modules or {"unet": TrackedLinear()}
+        self.moves = []
+
+    def to(self, device):
+        self.moves.append(device)
+        for module in self.components.values():
+            module.to(device)
+        return self
+
+
+# Weight bytes of the default pipeline, a 16x16 fp32 Linear with its bias
+PIPELINE_BYTES = (16 * 16 + 16) * 4
+
+
+class Loaders:
+    """
+    Builds a fresh pipeline per load and counts the loads of each model.
+    """
+
+    def __init__(self, *names):
+        self.loads = {name: 0 for name in names}
+
+    def loader(self, name):
+        def load():
+            self.loads[name] += 1
+            return ModulePipeline()
+        return load
+
+    def all(self):
+        return {name: self.loader(name) for name in self.loads}
+
+
+def states(registry):
+    return {name: model["state"] for name, model in registry.status()["models"].items()}
+
+
+def test_models_load_on_first_use_only():
+    loaders = Loaders("ssd-1b", "sdxl")
+    registry = ModelRegistry(loaders.all(), device="cpu")
+    assert states(registry) == {"ssd-1b": UNLOADED, "sdxl": UNLOADED}
+
+    with registry.use("ssd-1b") as pipeline:
+        assert pipeline.moves == ["cpu"]
+    with registry.use("ssd-1b"):
+        pass
+    assert loaders.loads == {"ssd-1b": 1, "sdxl": 0}
+    assert states(registry) == {"ssd-1b": GPU, "sdxl": UNLOADED}
+    assert registry.resident_bytes() == PIPELINE_BYTES
+
+
+def test_least_recently_used_model_makes_room():
+    loaders = Loaders("a", "b", "c")
+    registry = ModelRegistry(loaders.all(), device="cpu", memory_budget_bytes=2 * PIPELINE_BYTES)
+    for name in ("a", "b", "a", "c"):
+        with registry.use(name):
+            pass
+    assert states(registry) == {"a": GPU, "b": CPU, "c": GPU}
+    assert registry.resident_bytes() <= 2 * PIPELINE_BYTES
+
+
+def test_model_in_use_is_not_evicted():
+    registry = ModelRegistry(Loaders("a", "b").all(), device="cpu", memory_budget_bytes=PIPELINE_BYTES)
+    with registry.use("a"):
+        with registry.use("b"):
+            # Over budget, but a is still running
+            assert states(registry) == {"a": GPU, "b": GPU}
+
+
+def test_idle_models_are_evicted():
+    registry = ModelRegistry(Loaders("a").all(), device="cpu", idle_seconds=0.05)
+    with registry.use("a"):
+        pass
+    registry.evict_idle()
+    assert states(registry) == {"a": GPU}
+    time.sleep(0.1)
+    registry.evict_idle()
+    assert states(registry) == {"a": CPU}
+
+
+def test_unload_eviction_drops_the_pipeline():
+    loaders = Loaders("a", "b")
+    unloaded = []
+    registry = ModelRegistry(
+        loaders.all(), device="cpu", memory_budget_bytes=PIPELINE_BYTES, eviction="unload", on_unload=unloaded.append
+    )
+    for name in ("a", "b", "a"):
+        with registry.use(name):
+            pass
+    assert unloaded == ["a", "b"]
+    assert registry.entries["b"].pipeline is None
+    assert loaders.loads == {"a": 2, "b": 1}
+
+
+def test_failed_load_can_be_retried():
+    attempts = []
+
+    def load():
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise OSError("download failed")
+        return ModulePipeline()
+
+    registry = ModelRegistry({"a": load}, device="cpu")
+    with pytest.raises(OSError):
+        with registry.use("a"):
+            pass
+    assert states(registry) == {"a": UNLOADED}
+    with registry.use("a"):
+        pass
+    assert states(registry) == {"a": GPU}
+
+
+def test_shared_modules_are_counted_once():
+    vae = TrackedLinear()
+    loaders = {
+        "ssd-1b": lambda: ModulePipeline(unet=TrackedLinear(), vae=vae),
+        "sdxl": lambda: ModulePipeline(unet=TrackedLinear(), vae=vae),
+    }
+    registry = ModelRegistry(loaders, device="cuda:0")
+    for name in loaders:
+        with registry.use(name):
+            pass
+    assert registry.resident_bytes() == 3 * PIPELINE_BYTES
+
+    report = registry.memory_report()
+    assert report["total_bytes"] == 3 * PIPELINE_BYTES
+    assert report["unshared_total_bytes"] == 4 * PIPELINE_BYTES
+    assert report["models"]["ssd-1b"]["components"]["vae"]["shared_with"] == ["sdxl"]
+    assert report["models"]["ssd-1b"]["components"]["unet"]["shared_with"] == []
+
+
+def test_shared_module_stays_while_a_resident_pipeline_uses_it():
+    vae = TrackedLinear()
+    pipelines = {name: ModulePipeline(unet=TrackedLinear(), vae=vae) for name in ("a", "b", "c")}
+    registry = ModelRegistry(
+        {name: (lambda pipeline=pipeline: pipeline) for name, pipeline in pipelines.items()},
+        device="cuda:0",
+        memory_budget_bytes=3 * PIPELINE_BYTES
+    )
+    for name in ("a", "b", "c"):
+        with registry.use(name):
+            pass
+    # c only needed room for its UNet, so only a was evicted, and b still holds the VAE
+    assert states(registry) == {"a": CPU, "b": GPU, "c": GPU}
+    assert pipelines["a"].components["unet"].device == "cpu"
+    assert vae.device == "cuda:0"
+
+
+def test_preload_loads_models_in_parallel():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def loader():
+        # Only returns once both loads are running at the same time
+        barrier.wait()
+        return ModulePipeline()
+
+    registry = ModelRegistry({"a": loader, "b": loader}, device="cpu")
+    registry.preload(["a", "b"])
+    assert states(registry) == {"a": CPU, "b": CPU}
+
+
+def test_use_during_preload_waits_for_it():
+    started, release = threading.Event(), threading.Event()
+    loads = []
+
+    def loader():
+        loads.append(None)
+        started.set()
+        release.wait(5)
+        return ModulePipeline()
+
+    registry = ModelRegistry({"a": loader}, device="cpu")
+    preloading = threading.Thread(target=registry.preload, args=(["a"],))
+    preloading.start()
+    started.wait(5)
+    assert states(registry) == {"a": LOADING}
+
+    threading.Timer(0.1, release.set).start()
+    with registry.use("a"):
+        assert states(registry) == {"a": GPU}
+    preloading.join(5)
+    assert len(loads) == 1
+
+
+def test_failed_preload_leaves_the_model_unloaded():
+    def loader():
+        raise OSError("download failed")
+
+    registry = ModelRegistry({"a": loader}, device="cpu")
+    with pytest.raises(OSError):
+        registry.preload(["a"])
+    assert states(registry) == {"a": UNLOADED}
+    assert registry.entries["a"].settled.is_set()
+
+
+def test_eviction_keeps_modules_shared_with_the_incoming_model():
+    vae = TrackedLinear()
+    pipelines = {"a": ModulePipeline(unet=TrackedLinear(), vae=vae), "b": ModulePipeline(unet=TrackedLinear(), vae=vae)}
+    registry = ModelRegistry(
+        {name: (lambda pipeline=pipeline: pipeline) for name, pipeline in pipelines.items()},
+        device="cuda:0",
+        memory_budget_bytes=2 * PIPELINE_BYTES
+    )
+    with registry.use("a"):
+        pass
+    vae_moves = []
+    vae.to = lambda device: vae_moves.append(device) or vae
+    with registry.use("b"):
+        pass
+    # b needed room for its UNet only, so a went, but the VAE they share never left the device
+    assert states(registry) == {"a": CPU, "b": GPU}
+    assert pipelines["a"].components["unet"].device == "cpu"
+    assert "cpu" not in vae_moves
+    assert registry.resident_bytes() == 2 * PIPELINE_BYTES
+
+
+def test_evict_unused_frees_the_least_recently_used_idle_model():
+    registry = ModelRegistry(Loaders("a", "b", "c").all(), device="cpu")
+    for name in ("a", "b", "c"):
+        with registry.use(name):
+            pass
+    with registry.use("b"):
+        # b is in use and c is the one being made room for, so only a can go
+        assert registry.evict_unused("c")
+        assert states(registry) == {"a": CPU, "b": GPU, "c": GPU}
+        assert not registry.evict_unused("c")
@@ -0,0 +1,66 @@
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("torch")
+
+import api
+from fastapi.testclient import TestClient
+import json
+
+
+@pytest.fixture
+def client(api_database, monkeypatch):
+    monkeypatch.setattr(api, "IMPORT_CHUNK_SIZE", 2)
+    monkeypatch.setattr(api, "EXPORT_CHUNK_SIZE", 2)
+    # Not entered as a context manager, so startup does not connect the configured database
+    return TestClient(api.app)
+
+
+def ndjson(*items):
+    return "".join(json.dumps(item) + "\n" for item in items)
+
+
+RECORDS = [
+    {"model": "ssd-1b", "prompt": "a cat", "negative_prompt": "blurry", "image_path": "cat.jpg",
+     "timestamp": "2024-05-01T12:00:00+00:00"},
+    {"model": "sdxl", "prompt": "a dog", "image_path": "dog.jpg"},
+    {"prompt": "a fox", "negative_prompt": "", "image_path": "fox.jpg"},
+    {"prompt": "an owl", "image_path": "owl.jpg"},
+    {"model": "ssd-1b", "prompt": "a bee", "negative_prompt": None, "image_path": "bee.jpg"},
+]
+
+
+def test_import_loads_rows_in_chunks(client):
+    response = client.post("/import-records-stream/", content=ndjson(*RECORDS))
+    assert response.status_code == 200
+    summary = response.json()
+    assert (summary["rows"], summary["ssd_1b_rows"], summary["sdxl_rows"]) == (5, 3, 2)
+    assert summary["invalid_lines"] == 0
+
+
+def test_invalid_lines_are_skipped_and_reported(client):
+    body = ndjson(RECORDS[0]) + "not json\n\n" + ndjson({"model": "sd-1.5", "prompt": "x", "image_path": "x.jpg"}, {"prompt": 1})
+    summary = client.post("/import-records-stream/", content=body).json()
+    assert summary["rows"] == 1
+    assert summary["invalid_lines"] == 3
+    assert [error["line"] for error in summary["errors"]] == [2, 3, 4]
+    assert "Unknown model" in summary["errors"][1]["error"]
+
+
+def test_export_round_trips_the_import(client):
+    client.post("/import-records-stream/", content=ndjson(*RECORDS))
+    response = client.get("/export-records/")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert "attachment" in response.headers["content-disposition"]
+
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    assert [(row["model"], row["prompt"]) for row in exported] == [
+        ("ssd-1b", "a cat"), ("ssd-1b", "a fox"), ("ssd-1b", "a bee"), ("sdxl", "a dog"), ("sdxl", "an owl")
+    ]
+    assert all("negative_prompt" in row for row in exported)
+    assert exported[0]["timestamp"].startswith("2024-05-01 12:00:00")
+
+    # Exported lines import as they are
+    summary = client.post("/import-records-stream/", content=response.text).json()
+    assert (summary["rows"], summary["invalid_lines"]) == (5, 0)
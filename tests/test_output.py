@@ -0,0 +1,46 @@
+import pytest
+
+pytest.importorskip("PIL")
+
+from output import parse_accept, negotiate_format, encode_image, format_from_path, media_type, extension
+from PIL import Image
+import io
+
+
+def test_accept_is_ordered_by_quality_then_position():
+    header = "image/png;q=0.5, image/webp, text/html;q=0, image/jpeg;q=0.9, */*;q=0.1"
+    assert parse_accept(header) == ["image/webp", "image/jpeg", "image/png", "*/*"]
+    assert parse_accept(None) == []
+    assert parse_accept("image/png;q=high") == []
+
+
+@pytest.mark.parametrize("requested, accept, expected", [
+    (None, None, "jpeg"),
+    ("PNG", "image/webp", "png"),
+    ("jpg", None, "jpeg"),
+    (None, "image/webp, image/png", "webp"),
+    (None, "text/html, image/png;q=0.8", "png"),
+    (None, "text/html, image/*", "jpeg"),
+    (None, "text/html", "jpeg"),
+])
+def test_negotiate_format(requested, accept, expected):
+    assert negotiate_format(requested, accept) == expected
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError):
+        negotiate_format("gif")
+
+
+@pytest.mark.parametrize("output_format", ["jpeg", "png", "webp"])
+def test_encode_image(output_format):
+    data = encode_image(Image.new("RGB", (16, 8)), output_format)
+    image = Image.open(io.BytesIO(data))
+    assert image.format == {"jpeg": "JPEG", "png": "PNG", "webp": "WEBP"}[output_format]
+    assert image.size == (16, 8)
+
+
+def test_format_follows_the_file_extension():
+    assert format_from_path("generated_images/a" + extension("webp")) == "webp"
+    assert media_type(format_from_path("generated_images/a.png")) == "image/png"
+    assert format_from_path("generated_images/a.bmp") == "jpeg"
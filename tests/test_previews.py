@@ -0,0 +1,24 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from previews import latents_to_preview, preview_base64
+from PIL import Image
+import base64
+import io
+
+
+def test_preview_has_one_pixel_per_latent():
+    preview = latents_to_preview(torch.zeros(4, 16, 12))
+    assert preview.mode == "RGB"
+    assert preview.size == (12, 16)
+
+
+def test_preview_can_be_resized():
+    assert latents_to_preview(torch.zeros(4, 16, 16), size=(64, 64)).size == (64, 64)
+
+
+def test_preview_is_a_base64_jpeg():
+    image = Image.open(io.BytesIO(base64.b64decode(preview_base64(torch.randn(4, 8, 8)))))
+    assert image.format == "JPEG"
+    assert image.size == (8, 8)
@@ -0,0 +1,53 @@
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("torch")
+
+import api
+from worker import Job
+from fastapi.testclient import TestClient
+import asyncio
+
+
+@pytest.fixture
+def readiness(monkeypatch):
+    state = {"ready": False, "stage": "starting", "error": None}
+    monkeypatch.setattr(api, "readiness", state)
+    return state
+
+
+def test_health_is_up_before_ready(readiness):
+    client = TestClient(api.app)
+    assert client.get("/healthz").json() == {"status": "ok"}
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["stage"] == "starting"
+
+
+def test_warm_up_runs_each_model_once_then_reports_ready(readiness, monkeypatch):
+    warmed = []
+
+    def submit(model, **params):
+        warmed.append((model, params))
+        job = Job(model, params)
+        job.future.set_result(["image"])
+        return job
+
+    monkeypatch.setattr(api, "WARMUP_MODELS", ["ssd-1b", "sdxl"])
+    monkeypatch.setattr(api.worker, "submit", submit)
+    asyncio.run(api.warm_up())
+    assert [model for model, _ in warmed] == ["ssd-1b", "sdxl"]
+    assert warmed[0][1]["num_inference_steps"] == api.WARMUP_STEPS
+    assert readiness == {"ready": True, "stage": "ready", "error": None}
+    assert TestClient(api.app).get("/readyz").status_code == 200
+
+
+def test_failed_warm_up_is_reported(readiness, monkeypatch):
+    def submit(model, **params):
+        raise KeyError(model)
+
+    monkeypatch.setattr(api, "WARMUP_MODELS", ["ssd-1b"])
+    monkeypatch.setattr(api.worker, "submit", submit)
+    asyncio.run(api.warm_up())
+    assert readiness["stage"] == "failed"
+    assert not readiness["ready"]
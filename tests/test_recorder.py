@@ -0,0 +1,134 @@
+import pytest
+
+pytest.importorskip("prometheus_client")
+sqlalchemy = pytest.importorskip("sqlalchemy")
+databases = pytest.importorskip("databases")
+pytest.importorskip("aiosqlite")
+
+from records import Base, ImageRecord, record_values
+from recorder import RecordWriter
+import asyncio
+
+images = ImageRecord.__table__
+
+
+def run_with_database(tmp_path, test):
+    url = f"sqlite:///{tmp_path / 'records.db'}"
+    Base.metadata.create_all(bind=sqlalchemy.create_engine(url))
+
+    async def main():
+        database = databases.Database(url)
+        await database.connect()
+        try:
+            await test(database)
+        finally:
+            await database.disconnect()
+
+    asyncio.run(main())
+
+
+def values(prompt):
+    return record_values("ssd-1b", {"prompt": prompt, "negative_prompt": "blurry"}, f"{prompt}.jpg")
+
+
+async def count(database):
+    return await database.fetch_val(sqlalchemy.select([sqlalchemy.func.count()]).select_from(images))
+
+
+def test_rows_are_written_after_the_flush_interval(tmp_path):
+    async def test(database):
+        recorder = RecordWriter(database, max_batch_size=100, flush_interval=0.05)
+        recorder.start()
+        await recorder.add(images, "ssd-1b", values("a"))
+        # Queued rows are visible before they are written
+        assert recorder.find(images, "image_path", "a.jpg")["prompt"] == "a"
+        assert await count(database) == 0
+        await asyncio.sleep(0.3)
+        assert await count(database) == 1
+        assert recorder.find(images, "image_path", "a.jpg") is None
+        await recorder.stop()
+
+    run_with_database(tmp_path, test)
+
+
+def test_full_batch_is_written_without_waiting(tmp_path):
+    async def test(database):
+        recorder = RecordWriter(database, max_batch_size=3, flush_interval=60)
+        recorder.start()
+        for prompt in ("a", "b", "c"):
+            await recorder.add(images, "ssd-1b", values(prompt))
+        await asyncio.sleep(0.3)
+        assert await count(database) == 3
+        assert recorder.written == 3
+        await recorder.stop()
+
+    run_with_database(tmp_path, test)
+
+
+def test_stop_drains_every_queued_row(tmp_path):
+    async def test(database):
+        recorder = RecordWriter(database, max_batch_size=2, flush_interval=60)
+        recorder.start()
+        for i in range(5):
+            await recorder.add(images, "ssd-1b", values(str(i)))
+        await recorder.stop()
+        assert recorder.queue_depth() == 0
+        assert await count(database) == 5
+
+    run_with_database(tmp_path, test)
+
+
+def test_rows_that_keep_failing_are_given_up_on(tmp_path):
+    missing = sqlalchemy.Table(
+        "missing", sqlalchemy.MetaData(), sqlalchemy.Column("prompt", sqlalchemy.String)
+    )
+
+    async def test(database):
+        recorder = RecordWriter(database, flush_interval=60, max_retries=2, retry_backoff=0)
+        recorder.start()
+        await recorder.add(missing, "ssd-1b", {"prompt": "a"})
+        await recorder.add(images, "ssd-1b", values("b"))
+        await recorder.stop()
+        assert recorder.failed == 1
+        assert recorder.written == 1
+        assert await count(database) == 1
+
+    run_with_database(tmp_path, test)
+
+
+def test_pending_rows_newest_first(tmp_path):
+    async def test(database):
+        recorder = RecordWriter(database, flush_interval=60)
+        await recorder.add(images, "ssd-1b", values("old"))
+        await recorder.add(images, "ssd-1b", values("new"))
+        assert [row["prompt"] for row in recorder.pending_rows(images)] == ["new", "old"]
+
+    run_with_database(tmp_path, test)
+
+
+def test_add_waits_for_room_when_the_queue_is_full(tmp_path):
+    async def test(database):
+        recorder = RecordWriter(database, max_batch_size=2, flush_interval=60, max_pending=2)
+        recorder.start()
+        database_execute = database.execute
+        released = asyncio.Event()
+
+        async def execute(query):
+            await released.wait()
+            return await database_execute(query)
+
+        database.execute = execute
+        for prompt in ("a", "b", "c", "d"):
+            await recorder.add(images, "ssd-1b", values(prompt))
+        # a and b are being flushed, c and d fill the queue
+        adding = asyncio.ensure_future(recorder.add(images, "ssd-1b", values("e")))
+        await asyncio.sleep(0.1)
+        assert not adding.done()
+        assert len(recorder.pending) == 2
+
+        released.set()
+        await asyncio.wait_for(adding, 5)
+        await recorder.stop()
+        assert await count(database) == 5
+
+    run_with_database(tmp_path, test)
@@ -0,0 +1,101 @@
+import pytest
+
+pytest.importorskip("torch")
+
+import api
+from worker import COMPLETED
+import asyncio
+
+
+@pytest.fixture
+def generated(api_worker, monkeypatch):
+    """
+    Replaces the database lookup and the image saving, and records the jobs that were generated.
+    """
+    stored = {}
+    submitted = []
+
+    async def find_cached_result(model, cache_key):
+        return stored.get(cache_key)
+
+    async def save_job_result(job):
+        images = await asyncio.wrap_future(job.future)
+        job.result = {"image_key": images[0]}
+        job.status = COMPLETED
+        return job.result
+
+    original_submit = api_worker.submit
+
+    def submit(model, **params):
+        job = original_submit(model, **params)
+        submitted.append(job)
+        return job
+
+    monkeypatch.setattr(api, "find_cached_result", find_cached_result)
+    monkeypatch.setattr(api, "save_job_result", save_job_result)
+    monkeypatch.setattr(api_worker, "submit", submit)
+    return stored, submitted
+
+
+def test_cache_key_covers_every_parameter():
+    key = api.request_cache_key("ssd-1b", {"prompt": "a cat", "seed": 1})
+    assert key == api.request_cache_key("ssd-1b", {"seed": 1, "prompt": "a cat"})
+    assert key != api.request_cache_key("ssd-1b", {"prompt": "a cat", "seed": 2})
+    assert key != api.request_cache_key("sdxl", {"prompt": "a cat", "seed": 1})
+
+
+def test_stored_result_is_served_without_generating(generated):
+    stored, submitted = generated
+    params = {"prompt": "a cat", "seed": 1, "output": api.output_options()}
+    stored[api.request_cache_key("ssd-1b", params)] = "generated_images/cat.jpg"
+
+    job = asyncio.run(api.submit_job("ssd-1b", "a cat", seed=1))
+    assert job.cached
+    assert job.status == COMPLETED
+    assert job.result == {"image_key": "generated_images/cat.jpg", "media_type": "image/jpeg"}
+    assert api.worker.get_job(job.id) is job
+    assert submitted == []
+
+
+def test_identical_requests_share_the_running_job(generated):
+    _, submitted = generated
+
+    async def run():
+        first, second = await asyncio.gather(
+            api.submit_job("ssd-1b", "a dog", seed=7),
+            api.submit_job("ssd-1b", "a dog", seed=7),
+        )
+        assert first is second
+        assert len(api.inflight_jobs) == 1
+
+        first.future.set_result(["generated_images/dog.jpg"])
+        await first.save_task
+        # Once saved, later repeats go through the stored results instead
+        assert api.inflight_jobs == {}
+        return first
+
+    job = asyncio.run(run())
+    assert submitted == [job]
+    assert job.result == {"image_key": "generated_images/dog.jpg"}
+
+
+def test_unseeded_requests_always_generate(generated):
+    _, submitted = generated
+
+    async def run():
+        return await api.submit_job("ssd-1b", "a bird"), await api.submit_job("ssd-1b", "a bird")
+
+    first, second = asyncio.run(run())
+    assert first is not second
+    assert submitted == [first, second]
+    assert api.inflight_jobs == {}
+
+
+def test_output_format_is_part_of_the_request(generated):
+    stored, submitted = generated
+    params = {"prompt": "a cat", "seed": 1, "output": api.output_options()}
+    stored[api.request_cache_key("ssd-1b", params)] = "generated_images/cat.jpg"
+
+    job = asyncio.run(api.submit_job("ssd-1b", "a cat", seed=1, output=api.output_options("png")))
+    assert not job.cached
+    assert submitted == [job]
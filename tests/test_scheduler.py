@@ -0,0 +1,81 @@
+from scheduler import JobQueue
+import queue
+import pytest
+
+
+class FakeJob:
+    def __init__(self, name, priority=0, client_id=None):
+        self.name = name
+        self.priority = priority
+        self.client_id = client_id
+
+
+def drain(job_queue):
+    names = []
+    while True:
+        job = job_queue.get(timeout=0)
+        if job is None:
+            return names
+        names.append(job.name)
+
+
+def test_higher_priority_first():
+    job_queue = JobQueue()
+    job_queue.put_nowait(FakeJob("low", priority=0))
+    job_queue.put_nowait(FakeJob("high", priority=5))
+    job_queue.put_nowait(FakeJob("middle", priority=1))
+    assert drain(job_queue) == ["high", "middle", "low"]
+
+
+def test_clients_of_equal_priority_take_turns():
+    job_queue = JobQueue()
+    for i in range(3):
+        job_queue.put_nowait(FakeJob(f"a{i}", client_id="a"))
+    job_queue.put_nowait(FakeJob("b0", client_id="b"))
+    job_queue.put_nowait(FakeJob("b1", client_id="b"))
+    assert drain(job_queue) == ["a0", "b0", "a1", "b1", "a2"]
+
+
+def test_jobs_of_one_client_keep_submission_order():
+    job_queue = JobQueue()
+    for i in range(4):
+        job_queue.put_nowait(FakeJob(i, client_id="a"))
+    assert drain(job_queue) == [0, 1, 2, 3]
+
+
+def test_priority_beats_fairness():
+    job_queue = JobQueue()
+    job_queue.put_nowait(FakeJob("b0", client_id="b"))
+    job_queue.put_nowait(FakeJob("a0", client_id="a", priority=1))
+    job_queue.put_nowait(FakeJob("a1", client_id="a", priority=1))
+    # a was just served, but its higher priority job still goes before b's
+    assert drain(job_queue) == ["a0", "a1", "b0"]
+
+
+def test_match_skips_other_jobs():
+    job_queue = JobQueue()
+    job_queue.put_nowait(FakeJob("first"))
+    job_queue.put_nowait(FakeJob("second"))
+    assert job_queue.get(timeout=0, match=lambda job: job.name == "second").name == "second"
+    assert job_queue.get(timeout=0, match=lambda job: job.name == "second") is None
+    assert len(job_queue) == 1
+
+
+def test_full_queue_and_remove():
+    job_queue = JobQueue(maxsize=1)
+    job = FakeJob("only")
+    job_queue.put_nowait(job)
+    with pytest.raises(queue.Full):
+        job_queue.put_nowait(FakeJob("extra"))
+    assert job_queue.remove(job)
+    assert not job_queue.remove(job)
+    assert job_queue.get(timeout=0) is None
+
+
+def test_count_ahead():
+    job_queue = JobQueue()
+    job_queue.put_nowait(FakeJob("low", priority=0))
+    job_queue.put_nowait(FakeJob("high", priority=2))
+    assert job_queue.count_ahead(0) == 2
+    assert job_queue.count_ahead(1) == 1
+    assert job_queue.count_ahead(3) == 0
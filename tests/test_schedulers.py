@@ -0,0 +1,77 @@
+import pytest
+
+pytest.importorskip("diffusers")
+
+from schedulers import SchedulerCache
+from diffusers import EulerDiscreteScheduler, DPMSolverMultistepScheduler
+
+
+class SchedulerPipeline:
+    def __init__(self, adapters=()):
+        self.scheduler = EulerDiscreteScheduler(num_train_timesteps=500)
+        self.adapters = list(adapters)
+        self.lora_calls = []
+
+    def get_list_adapters(self):
+        return {"unet": self.adapters}
+
+    def set_adapters(self, names):
+        self.lora_calls.append(("set", names))
+
+    def enable_lora(self):
+        self.lora_calls.append("enable")
+
+    def disable_lora(self):
+        self.lora_calls.append("disable")
+
+
+def test_schedulers_are_built_once_from_the_model_config():
+    cache = SchedulerCache()
+    pipeline = SchedulerPipeline()
+    scheduler = cache.get(pipeline, "ssd-1b", "dpmpp_2m_karras")
+    assert isinstance(scheduler, DPMSolverMultistepScheduler)
+    assert scheduler.config.num_train_timesteps == 500
+    assert scheduler.config.use_karras_sigmas
+    assert cache.get(pipeline, "ssd-1b", "dpmpp_2m_karras") is scheduler
+    assert cache.get(pipeline, "ssd-1b", "default") is pipeline.scheduler
+
+
+def test_scheduler_is_swapped_in_for_one_call():
+    cache = SchedulerCache()
+    pipeline = SchedulerPipeline()
+    default = pipeline.scheduler
+    with cache.use(pipeline, "ssd-1b", "unipc") as scheduler:
+        assert pipeline.scheduler is scheduler
+        assert scheduler is not default
+    assert pipeline.scheduler is default
+
+    with cache.use(pipeline, "ssd-1b", None) as scheduler:
+        assert scheduler is None
+        assert pipeline.scheduler is default
+
+
+def test_adapter_is_only_on_for_its_scheduler():
+    cache = SchedulerCache()
+    with pytest.raises(ValueError):
+        with cache.use(SchedulerPipeline(), "ssd-1b", "lcm"):
+            pass
+
+    pipeline = SchedulerPipeline(adapters=["lcm"])
+    with cache.use(pipeline, "ssd-1b", "lcm"):
+        assert pipeline.lora_calls == [("set", ["lcm"]), "enable"]
+    assert pipeline.lora_calls[-1] == "disable"
+
+
+def test_unknown_scheduler_is_rejected():
+    with pytest.raises(ValueError):
+        SchedulerCache().get(SchedulerPipeline(), "ssd-1b", "ddim_but_faster")
+
+
+def test_clear_forgets_one_model():
+    cache = SchedulerCache()
+    first, second = SchedulerPipeline(), SchedulerPipeline()
+    euler_a = cache.get(first, "ssd-1b", "euler_a")
+    cache.get(second, "sdxl", "euler_a")
+    cache.clear("ssd-1b")
+    assert set(cache.defaults) == {"sdxl"}
+    assert cache.get(first, "ssd-1b", "euler_a") is not euler_a
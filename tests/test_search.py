@@ -0,0 +1,141 @@
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("torch")
+
+import api
+from search import fts5_query, escape_like, ensure_sqlite_search_index
+from fastapi.testclient import TestClient
+import asyncio
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("red car", '"red" "car"*'),
+    ("cat", '"cat"*'),
+    ('NEAR(a b) OR "x', '"NEAR" "a" "b" "OR" "x"*'),
+    ("  ?! ", None),
+])
+def test_fts5_query(query, expected):
+    assert fts5_query(query) == expected
+
+
+def test_escape_like():
+    assert escape_like(r"100%_a\b") == r"100\%\_a\\b"
+
+
+PROMPTS = {
+    "ssd-1b": ["a red car in the rain", "portrait of a cat", "red red roses"],
+    "sdxl": ["a racing car on a track", "cats sleeping on a sofa"],
+}
+
+
+@pytest.fixture
+def client(api_database):
+    async def fill():
+        # Records from before the index existed are backfilled, later ones arrive through the triggers
+        await api_database.execute(api.ImageRecord.__table__.insert().values(
+            prompt=PROMPTS["ssd-1b"][0], negative_prompt="blurry", image_path="0.jpg"
+        ))
+        await ensure_sqlite_search_index(api_database)
+        for model, prompts in PROMPTS.items():
+            table = api.SDXLImageRecord.__table__ if model == "sdxl" else api.ImageRecord.__table__
+            for index, prompt in enumerate(prompts):
+                if model == "ssd-1b" and index == 0:
+                    continue
+                await api_database.execute(table.insert().values(prompt=prompt, image_path=f"{model}-{index}.jpg"))
+
+    asyncio.run(fill())
+    return TestClient(api.app)
+
+
+def search(client, **params):
+    response = client.get("/search", params=params)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_search_matches_every_word_across_models(client):
+    results = search(client, q="car")["results"]
+    assert {(result["model"], result["prompt"]) for result in results} == {
+        ("ssd-1b", "a red car in the rain"), ("sdxl", "a racing car on a track")
+    }
+    assert [result["prompt"] for result in search(client, q="red car")["results"]] == ["a red car in the rain"]
+    negative_prompts = {result["model"]: result["negative_prompt"] for result in results}
+    assert negative_prompts == {"ssd-1b": "blurry", "sdxl": None}
+
+
+def test_search_stems_and_matches_prefixes(client):
+    assert {result["prompt"] for result in search(client, q="cat")["results"]} == {
+        "portrait of a cat", "cats sleeping on a sofa"
+    }
+    assert [result["prompt"] for result in search(client, q="sof")["results"]] == ["cats sleeping on a sofa"]
+
+
+def test_better_matches_rank_first(client):
+    results = search(client, q="red")["results"]
+    assert [result["prompt"] for result in results] == ["red red roses", "a red car in the rain"]
+    assert results[0]["score"] > results[1]["score"]
+
+
+def test_search_pages_and_filters(client):
+    page = search(client, q="a", limit=2)
+    assert len(page["results"]) == 2
+    assert page["next_offset"] == 2
+    rest = search(client, q="a", limit=2, offset=2)
+    assert not {result["prompt"] for result in page["results"]} & {result["prompt"] for result in rest["results"]}
+    assert {result["model"] for result in search(client, q="car", model="sdxl")["results"]} == {"sdxl"}
+
+
+def test_deleted_records_leave_the_index(client, api_database):
+    asyncio.run(api_database.execute(api.ImageRecord.__table__.delete()))
+    assert {result["model"] for result in search(client, q="car")["results"]} == {"sdxl"}
+
+
+@pytest.mark.parametrize("params", [{"q": " "}, {"q": "a", "limit": 0}, {"q": "a", "offset": -1}, {"q": "a", "model": "x"}])
+def test_invalid_searches_are_rejected(client, params):
+    assert client.get("/search", params=params).status_code == 400
+
+
+def test_query_without_words_finds_nothing(client):
+    assert search(client, q="?!") == {"query": "?!", "results": [], "next_offset": None}
+
+
+@pytest.fixture
+def fresh_database(tmp_path, monkeypatch):
+    """
+    An empty SQLite database, as on the first start of the API.
+    """
+    import databases
+    import sqlalchemy
+
+    url = f"sqlite:///{tmp_path / 'fresh.db'}"
+    monkeypatch.setattr(api, "DATABASE_URL", url)
+    monkeypatch.setattr(api, "engine", sqlalchemy.create_engine(url))
+    monkeypatch.setattr(api, "database", databases.Database(url))
+    return api.database
+
+
+def prepare(database):
+    async def run():
+        await database.connect()
+        try:
+            await api.prepare_database()
+            return {row[0] for row in await database.fetch_all("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        finally:
+            await database.disconnect()
+
+    return asyncio.run(run())
+
+
+def test_tables_are_created_before_the_search_index(fresh_database):
+    tables = prepare(fresh_database)
+    assert {"images", "sdxl_images", "generation_jobs", "prompt_search"} <= tables
+
+
+def test_search_index_failure_stops_the_startup(fresh_database, monkeypatch):
+    async def ensure_sqlite_search_index(database):
+        raise RuntimeError("no such module: fts5")
+
+    monkeypatch.setattr(api, "ensure_sqlite_search_index", ensure_sqlite_search_index)
+    with pytest.raises(RuntimeError, match="fts5"):
+        prepare(fresh_database)
@@ -0,0 +1,116 @@
+import pytest
+
+from storage import LocalStorage, S3Storage, create_storage, shard_prefix
+import io
+import os
+
+
+def test_keys_are_sharded_by_name_hash():
+    storage = LocalStorage(shard_depth=2)
+    key = storage.key_for("abc.jpg")
+    first, second, name = key.split("/")
+    assert name == "abc.jpg"
+    assert len(first) == len(second) == 2
+    assert key == storage.key_for("abc.jpg")
+    assert shard_prefix("abc.jpg", 1) == first
+
+
+def test_local_put_and_get(tmp_path):
+    storage = LocalStorage(str(tmp_path))
+    key = storage.key_for("abc.jpg")
+    storage.put(key, b"image")
+    assert storage.exists(key)
+    assert storage.get(key) == b"image"
+    assert storage.local_path(key) == os.path.join(str(tmp_path), *key.split("/"))
+    # Nothing is left behind from the temporary file
+    assert os.listdir(os.path.dirname(storage.local_path(key))) == ["abc.jpg"]
+
+    storage.put(key, b"replaced")
+    assert storage.get(key) == b"replaced"
+    storage.delete(key)
+    assert not storage.exists(key)
+
+
+def test_local_paths_from_before_sharding_still_resolve(tmp_path):
+    root = str(tmp_path / "generated_images")
+    storage = LocalStorage(root)
+    legacy = root + "/abc.jpg"
+    assert storage.local_path(legacy) == legacy
+
+
+class FakeS3Client:
+    """
+    An in-memory stand-in for the boto3 S3 client calls the backend makes.
+    """
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def head_object(self, Bucket, Key):
+        from botocore.exceptions import ClientError
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    boto3 = pytest.importorskip("boto3")
+    client = FakeS3Client()
+    monkeypatch.setattr(boto3, "client", lambda service, endpoint_url=None: client)
+    return client
+
+
+def test_s3_objects_live_under_the_prefix(s3):
+    storage = create_storage("s3", bucket="images", prefix="/generated/", endpoint_url="http://localhost:9000")
+    assert isinstance(storage, S3Storage)
+    key = storage.key_for("abc.jpg")
+    storage.put(key, b"image")
+    assert s3.objects == {("images", f"generated/{key}"): b"image"}
+    assert storage.get(key) == b"image"
+    assert storage.local_path(key) is None
+
+    assert storage.exists(key)
+    storage.delete(key)
+    assert not storage.exists(key)
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        create_storage("ftp")
+
+
+def test_s3_revalidation_needs_no_download(s3):
+    pytest.importorskip("httpx")
+    from images import storage_response
+    from starlette.applications import Starlette
+    from starlette.routing import Route
+    from starlette.testclient import TestClient
+
+    storage = create_storage("s3", bucket="images")
+    key = storage.key_for("abc.jpg")
+    storage.put(key, b"image")
+    downloads = []
+    get_object = s3.get_object
+    s3.get_object = lambda **options: downloads.append(options) or get_object(**options)
+
+    async def endpoint(request):
+        return await storage_response(request, storage, key)
+
+    client = TestClient(Starlette(routes=[Route("/image", endpoint)]))
+    etag = client.get("/image").headers["etag"]
+    assert len(downloads) == 1
+    response = client.get("/image", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert len(downloads) == 1
+    assert client.get("/image", headers={"If-None-Match": '"stale"'}).content == b"image"
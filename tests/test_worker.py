@@ -0,0 +1,464 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from worker import GenerationWorker, QueueFullError, DeadlineError, JobCancelledError, SAVING, FAILED, CANCELLED
+from worker import worker_settings, build_worker, check_deadline
+from model_registry import ModelRegistry
+from types import SimpleNamespace
+from contextlib import nullcontext
+import threading
+import time
+
+
+class FakePipeline:
+    """
+    Returns one string "image" per prompt and records the thread and arguments of every call.
+    Runs the step callback over `num_timesteps` steps of zero latents.
+    """
+
+    components = {}
+
+    def __init__(self, error=None, num_timesteps=2):
+        self.error = error
+        self.num_timesteps = num_timesteps
+        self.calls = []
+
+    def to(self, device):
+        return self
+
+    def __call__(self, **params):
+        callback = params.pop("callback_on_step_end", None)
+        params.pop("callback_on_step_end_tensor_inputs", None)
+        self.calls.append((threading.current_thread().name, params))
+        if self.error is not None:
+            raise self.error
+        prompts = params["prompt"] if isinstance(params["prompt"], list) else [params["prompt"]]
+        if callback is not None:
+            latents = torch.zeros(len(prompts), 4, 8, 8)
+            for step in range(self.num_timesteps):
+                callback(self, step, None, {"latents": latents})
+        return SimpleNamespace(images=[f"image of {prompt}" for prompt in prompts])
+
+
+def make_worker(pipelines, **options):
+    registry = ModelRegistry({name: (lambda pipeline=pipeline: pipeline) for name, pipeline in pipelines.items()}, device="cpu")
+    return GenerationWorker(registry, **options)
+
+
+@pytest.fixture
+def pipeline():
+    return FakePipeline()
+
+
+@pytest.fixture
+def worker(pipeline):
+    worker = make_worker({"ssd-1b": pipeline})
+    worker.start()
+    yield worker
+    worker.stop(timeout=5)
+
+
+def test_job_runs_on_the_worker_thread(worker, pipeline):
+    job = worker.submit("ssd-1b", prompt="a cat")
+    assert job.future.result(timeout=5) == ["image of a cat"]
+    assert job.status == SAVING
+    assert pipeline.calls == [("generation-worker", {"prompt": ["a cat"]})]
+    assert worker.get_job(job.id) is job
+
+
+def test_unknown_model_is_rejected(worker):
+    with pytest.raises(KeyError):
+        worker.submit("sd-1.5", prompt="a cat")
+
+
+def test_full_queue_is_rejected():
+    # Not started, so nothing leaves the queue
+    worker = make_worker({"ssd-1b": FakePipeline()}, max_queue_size=1)
+    worker.submit("ssd-1b", prompt="a")
+    with pytest.raises(QueueFullError):
+        worker.submit("ssd-1b", prompt="b")
+    assert worker.queue_depth() == 1
+
+
+def test_failed_job_leaves_the_worker_running():
+    failing = FakePipeline(RuntimeError("boom"))
+    working = FakePipeline()
+    worker = make_worker({"ssd-1b": failing, "sdxl": working})
+    worker.start()
+    try:
+        failed = worker.submit("ssd-1b", prompt="a")
+        with pytest.raises(RuntimeError):
+            failed.future.result(timeout=5)
+        assert failed.status == FAILED
+        assert failed.error == "boom"
+        assert worker.submit("sdxl", prompt="b").future.result(timeout=5) == ["image of b"]
+    finally:
+        worker.stop(timeout=5)
+
+
+def test_finished_jobs_are_pruned():
+    worker = make_worker({"ssd-1b": FakePipeline()}, max_retained_jobs=2)
+    worker.start()
+    try:
+        jobs = [worker.submit("ssd-1b", prompt=str(i)) for i in range(3)]
+        for job in jobs:
+            job.future.result(timeout=5)
+            # The API marks a job completed once its image is saved
+            job.status = "completed"
+        worker.submit("ssd-1b", prompt="last").future.result(timeout=5)
+        assert worker.get_job(jobs[0].id) is None
+        assert worker.get_job(jobs[2].id) is jobs[2]
+    finally:
+        worker.stop(timeout=5)
+
+
+def test_compatible_jobs_share_one_call():
+    pipeline = FakePipeline()
+    worker = make_worker({"ssd-1b": pipeline}, max_wait_ms=100)
+    jobs = [worker.submit("ssd-1b", prompt=str(i), negative_prompt="blurry") for i in range(3)]
+    other = worker.submit("ssd-1b", prompt="other", negative_prompt="blurry", num_inference_steps=10)
+    jobs.append(worker.submit("ssd-1b", prompt="3", negative_prompt="ugly"))
+
+    batch = worker._collect_batch()
+    assert batch == jobs
+    worker._run_batch(batch)
+    assert pipeline.calls[0][1] == {
+        "prompt": ["0", "1", "2", "3"],
+        "negative_prompt": ["blurry", "blurry", "blurry", "ugly"],
+    }
+    # One image back per job, in submission order
+    assert [job.future.result(timeout=0) for job in jobs] == [["image of 0"], ["image of 1"], ["image of 2"], ["image of 3"]]
+    assert {job.batch_size for job in jobs} == {4}
+
+    # The job with other settings was deferred to the next call
+    assert worker._collect_batch() == [other]
+
+
+def test_batch_size_is_bounded():
+    worker = make_worker({"ssd-1b": FakePipeline()}, max_batch_size=2, max_wait_ms=100)
+    jobs = [worker.submit("ssd-1b", prompt=str(i)) for i in range(3)]
+    assert worker._collect_batch() == jobs[:2]
+    assert worker._collect_batch() == jobs[2:]
+
+
+def test_jobs_with_and_without_negative_prompt_do_not_mix():
+    worker = make_worker({"ssd-1b": FakePipeline()}, max_wait_ms=0)
+    with_negative = worker.submit("ssd-1b", prompt="a", negative_prompt="blurry")
+    without = worker.submit("ssd-1b", prompt="b")
+    assert worker._collect_batch() == [with_negative]
+    assert worker._collect_batch() == [without]
+
+
+def test_concurrent_submissions_are_batched():
+    pipeline = FakePipeline()
+    worker = make_worker({"ssd-1b": pipeline}, max_wait_ms=500)
+    worker.start()
+    try:
+        jobs = [worker.submit("ssd-1b", prompt=str(i)) for i in range(4)]
+        for job in jobs:
+            job.future.result(timeout=5)
+        assert [call[1]["prompt"] for call in pipeline.calls] == [["0", "1", "2", "3"]]
+    finally:
+        worker.stop(timeout=5)
+
+
+def test_steps_are_reported_to_listeners():
+    worker = make_worker({"ssd-1b": FakePipeline(num_timesteps=4)}, preview_every=2, preview_fn=lambda latents: tuple(latents.shape))
+    watched = worker.submit("ssd-1b", prompt="a")
+    unwatched = worker.submit("ssd-1b", prompt="b")
+    events = []
+    watched.add_listener(lambda event, data: events.append((event, data)))
+
+    worker._run_batch(worker._collect_batch())
+    assert events == [
+        ("progress", {"step": 1, "total_steps": 4}),
+        ("progress", {"step": 2, "total_steps": 4}),
+        ("preview", {"step": 2, "image": (4, 8, 8)}),
+        ("progress", {"step": 3, "total_steps": 4}),
+        ("progress", {"step": 4, "total_steps": 4}),
+    ]
+    # Progress is tracked without listeners too, for polling clients
+    assert (unwatched.step, unwatched.total_steps) == (4, 4)
+
+
+def test_failed_preview_does_not_fail_the_job():
+    def preview_fn(latents):
+        raise ValueError("bad latents")
+
+    worker = make_worker({"ssd-1b": FakePipeline(num_timesteps=2)}, preview_every=1, preview_fn=preview_fn)
+    job = worker.submit("ssd-1b", prompt="a")
+    events = []
+    job.add_listener(lambda event, data: events.append(event))
+    worker._run_batch(worker._collect_batch())
+    assert events == ["progress", "progress"]
+    assert job.future.result(timeout=0) == ["image of a"]
+
+
+def test_batch_stages_are_timed():
+    worker = make_worker({"ssd-1b": FakePipeline(num_timesteps=3)}, max_wait_ms=0)
+    job = worker.submit("ssd-1b", prompt="a")
+    worker._run_batch(worker._collect_batch())
+    assert set(job.timings) == {"queue_wait", "model_load", "denoise", "vae_decode"}
+    assert all(seconds >= 0 for seconds in job.timings.values())
+
+
+class OutOfMemoryOnce(FakePipeline):
+    def __call__(self, **params):
+        if not self.calls:
+            self.calls.append((threading.current_thread().name, params))
+            raise RuntimeError("CUDA out of memory")
+        return super().__call__(**params)
+
+
+def test_out_of_memory_retries_at_the_next_level():
+    from admission import AdmissionController, FAST
+
+    admission = AdmissionController("cpu")
+    admission.enabled = True
+    admission.available_bytes = lambda: 10 ** 15
+    admission.total_bytes = lambda: 10 ** 15
+    admission.measure = lambda *args: nullcontext()
+    pipeline = OutOfMemoryOnce()
+    worker = make_worker({"ssd-1b": pipeline}, max_wait_ms=0, admission=admission)
+    job = worker.submit("ssd-1b", prompt="a")
+    worker._run_batch(worker._collect_batch())
+    assert job.future.result(timeout=0) == ["image of a"]
+    assert len(pipeline.calls) == 2
+    assert admission.plan("ssd-1b", {}, 1) == FAST
+    assert admission.scales["ssd-1b"] > 1.0
+
+
+def test_cancelled_job_leaves_the_queue():
+    worker = make_worker({"ssd-1b": FakePipeline()}, max_wait_ms=0)
+    cancelled = worker.submit("ssd-1b", prompt="a")
+    kept = worker.submit("ssd-1b", prompt="b", negative_prompt="blurry")
+    assert worker.cancel(cancelled.id) is cancelled
+    assert cancelled.status == CANCELLED
+    with pytest.raises(JobCancelledError):
+        cancelled.future.result(timeout=0)
+    assert worker.queue_depth() == 1
+    assert worker._collect_batch() == [kept]
+    assert worker.cancel("unknown") is None
+
+
+def test_job_past_its_deadline_is_dropped_instead_of_run():
+    pipeline = FakePipeline()
+    worker = make_worker({"ssd-1b": pipeline}, max_wait_ms=0)
+    late = worker.submit("ssd-1b", prompt="a", deadline=time.time() + 0.05)
+    time.sleep(0.1)
+    assert worker._collect_batch() == []
+    assert late.status == CANCELLED
+    assert late.error == "Job passed its deadline."
+    assert pipeline.calls == []
+
+
+def test_abandoned_batch_stops_at_the_next_step():
+    pipeline = FakePipeline(num_timesteps=10)
+    worker = make_worker({"ssd-1b": pipeline}, max_wait_ms=0)
+    job = worker.submit("ssd-1b", prompt="a")
+    steps = []
+
+    def listener(event, data):
+        steps.append(data["step"])
+        if data["step"] == 2:
+            job.cancel_requested.set()
+
+    job.add_listener(listener)
+    worker._run_batch(worker._collect_batch())
+    assert steps == [1, 2]
+    assert job.status == CANCELLED
+    with pytest.raises(JobCancelledError):
+        job.future.result(timeout=0)
+
+
+def test_batch_keeps_running_for_the_jobs_still_wanted():
+    worker = make_worker({"ssd-1b": FakePipeline(num_timesteps=3)}, max_wait_ms=100)
+    cancelled, kept = worker.submit("ssd-1b", prompt="a"), worker.submit("ssd-1b", prompt="b")
+    batch = worker._collect_batch()
+    cancelled.add_listener(lambda event, data: cancelled.cancel_requested.set())
+    worker._run_batch(batch)
+    assert cancelled.status == CANCELLED
+    assert kept.future.result(timeout=0) == ["image of b"]
+
+
+def test_higher_priority_runs_first():
+    worker = make_worker({"ssd-1b": FakePipeline()}, max_wait_ms=0)
+    low = worker.submit("ssd-1b", prompt="low", negative_prompt="x")
+    high = worker.submit("ssd-1b", prompt="high", priority=1)
+    assert worker._collect_batch() == [high]
+    assert worker._collect_batch() == [low]
+
+
+def test_deadline_that_the_queue_cannot_meet_is_rejected():
+    worker = make_worker({"ssd-1b": FakePipeline()}, max_batch_size=1)
+    worker.batch_seconds = 10.0
+    worker.submit("ssd-1b", prompt="a")
+    assert worker.estimate_wait() == 10.0
+    with pytest.raises(DeadlineError) as error:
+        worker.submit("ssd-1b", prompt="b", deadline=time.time() + 15)
+    # The queue has to shrink by about 5 seconds before the deadline can be met
+    assert error.value.retry_after == pytest.approx(5.0, abs=0.5)
+    worker.submit("ssd-1b", prompt="b", deadline=time.time() + 25)
+
+
+def test_deadline_is_not_checked_before_a_batch_was_timed():
+    check_deadline(time.time() - 10, None, None)
+    check_deadline(time.time() + 10, 4, 5)
+
+
+def test_deadline_shorter_than_a_generation_is_not_retryable():
+    with pytest.raises(DeadlineError) as error:
+        check_deadline(time.time() + 3, 0, 5)
+    assert error.value.retry_after is None
+
+
+class SchedulerPipeline(FakePipeline):
+    """
+    Records the scheduler each call ran with.
+    """
+
+    def __init__(self, scheduler):
+        super().__init__()
+        self.scheduler = scheduler
+        self.schedulers_seen = []
+
+    def __call__(self, **params):
+        self.schedulers_seen.append(type(self.scheduler))
+        return super().__call__(**params)
+
+
+def test_jobs_run_with_the_scheduler_they_ask_for():
+    from schedulers import SchedulerCache
+    from diffusers import EulerDiscreteScheduler, UniPCMultistepScheduler
+
+    pipeline = SchedulerPipeline(EulerDiscreteScheduler())
+    worker = make_worker({"ssd-1b": pipeline}, max_wait_ms=0, schedulers=SchedulerCache())
+    unipc = worker.submit("ssd-1b", prompt="a", scheduler="unipc")
+    default = worker.submit("ssd-1b", prompt="b")
+    # Different schedulers never share a call
+    assert worker._collect_batch() == [unipc]
+    worker._run_batch([unipc])
+    worker._run_batch(worker._collect_batch())
+    assert pipeline.schedulers_seen == [UniPCMultistepScheduler, EulerDiscreteScheduler]
+    assert "scheduler" not in pipeline.calls[0][1]
+    assert default.future.result(timeout=0) == ["image of b"]
+
+
+def test_stored_latents_are_decoded_on_their_own(monkeypatch, worker, pipeline):
+    decoded = []
+
+    def vae_decode(pipeline, latents):
+        decoded.append(latents)
+        return "decoded image"
+
+    monkeypatch.setattr("worker.vae_decode", vae_decode)
+    latents = torch.zeros(4, 8, 8)
+    first = worker.submit("ssd-1b", latents=latents)
+    second = worker.submit("ssd-1b", latents=latents)
+    assert first.batch_key() != second.batch_key()
+    assert first.future.result(timeout=5) == ["decoded image"]
+    assert second.future.result(timeout=5) == ["decoded image"]
+    assert len(decoded) == 2
+    # The denoising pipeline itself is never called
+    assert pipeline.calls == []
+
+
+def test_unconvertible_latents_fail_the_batch_not_the_worker(worker):
+    # The fake pipeline returns strings, which cannot be converted like latents
+    job = worker.submit("ssd-1b", prompt="a cat", output_type="latent")
+    with pytest.raises(AttributeError):
+        job.future.result(timeout=5)
+    assert job.status == FAILED
+    assert worker.is_alive()
+    assert worker.submit("ssd-1b", prompt="a dog").future.result(timeout=5) == ["image of a dog"]
+
+
+def test_worker_is_built_from_the_environment_settings():
+    settings = worker_settings({
+        "SSD_DEVICE": "cpu",
+        "SSD_GPU_MEMORY_BUDGET_MB": "2",
+        "SSD_MODEL_IDLE_SECONDS": "30",
+        "SSD_MAX_BATCH_SIZE": "2",
+        "SSD_EMBEDDING_CACHE_MB": "1",
+        "SSD_ADMISSION_CONTROL": "0",
+    })
+    assert settings["max_queue_size"] == 16
+    worker = build_worker({"ssd-1b": FakePipeline}, settings)
+    assert not worker.is_alive()
+    assert (worker.registry.device, worker.registry.memory_budget_bytes, worker.registry.idle_seconds) == ("cpu", 2 * 1024 * 1024, 30.0)
+    assert worker.max_batch_size == 2
+    assert worker.embedding_cache.max_bytes == 1024 * 1024
+    assert worker.admission is None
+
+
+def test_unloading_a_model_releases_what_the_loaded_ones_no_longer_use():
+    settings = dict(worker_settings({"SSD_DEVICE": "cpu", "SSD_MODEL_IDLE_SECONDS": "0", "SSD_MODEL_EVICTION": "unload"}))
+    pipelines = {"ssd-1b": FakePipeline(), "sdxl": FakePipeline()}
+    released = []
+    worker = build_worker({name: (lambda pipeline=pipeline: pipeline) for name, pipeline in pipelines.items()}, settings, released.append)
+    for name in pipelines:
+        with worker.registry.use(name):
+            pass
+    worker.registry.evict_idle()
+    # Each call sees only the pipelines that were still loaded
+    assert len(released) == 2
+    assert released[1] == []
+    assert released[0] in ([pipelines["ssd-1b"]], [pipelines["sdxl"]])
+
+
+def test_shared_components_are_released_once_no_loaded_pipeline_uses_them(monkeypatch):
+    pipelines = pytest.importorskip("pipelines")
+    vae = torch.nn.Linear(2, 2)
+    monkeypatch.setattr(pipelines, "shared_components", {"vae": vae})
+    sharing = SimpleNamespace(components={"unet": torch.nn.Linear(2, 2), "vae": vae})
+    unrelated = SimpleNamespace(components={"unet": torch.nn.Linear(2, 2)})
+
+    pipelines.release_shared_components([unrelated, sharing])
+    assert pipelines.shared_components == {"vae": vae}
+    pipelines.release_shared_components([unrelated])
+    assert pipelines.shared_components == {}
+
+
+class TilingPipeline(FakePipeline):
+    """
+    Records the VAE tiling switches the memory levels make.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.switches = []
+
+    def enable_vae_tiling(self):
+        self.switches.append("enable")
+
+    def disable_vae_tiling(self):
+        self.switches.append("disable")
+
+
+def test_decode_runs_at_the_planned_memory_level(monkeypatch):
+    from admission import VAE_TILING
+
+    planned = []
+    admission = SimpleNamespace(
+        plan=lambda model, params, batch_size, evict: planned.append(params) or VAE_TILING,
+        max_batch_size=lambda model, params, batch_size: batch_size,
+    )
+    attempts = []
+
+    def vae_decode(pipeline, latents):
+        attempts.append(list(pipeline.switches))
+        if len(attempts) == 1:
+            raise RuntimeError("CUDA out of memory")
+        return "decoded image"
+
+    monkeypatch.setattr("worker.vae_decode", vae_decode)
+    pipeline = TilingPipeline()
+    worker = make_worker({"ssd-1b": pipeline}, admission=admission)
+    job = worker.submit("ssd-1b", latents=torch.zeros(4, 16, 8))
+    worker._run_batch(worker._collect_batch())
+    assert job.future.result(timeout=0) == ["decoded image"]
+    assert planned == [{"width": 64, "height": 128}]
+    # Tiled on the planned attempt, and still after running out of memory at the next level
+    assert attempts == [["enable"], ["enable", "disable", "enable"]]
+    assert pipeline.switches[-1] == "disable"
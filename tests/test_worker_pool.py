@@ -0,0 +1,250 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from worker_pool import WorkerPool, describe_failure
+from worker import QueueFullError, DeadlineError, JobCancelledError, QUEUED, SAVING, FAILED, CANCELLED
+from worker import worker_settings
+from model_registry import GPU
+from admission import MemoryBudgetError
+from embedding_cache import PromptEmbeddingCache
+from benchmark import FakePipeline
+import functools
+import asyncio
+import threading
+import queue
+import time
+
+
+def settings(environ):
+    return worker_settings(dict({"SSD_DEVICE": "cpu", "SSD_ADMISSION_CONTROL": "0"}, **environ))
+
+
+def make_pool(devices=("cuda:0", "cuda:1"), **options):
+    """
+    A pool whose device workers are plain queues instead of processes.
+    """
+    pool = WorkerPool(
+        list(devices), {"ssd-1b": FakePipeline, "sdxl": FakePipeline},
+        settings({"SSD_MAX_BATCH_SIZE": "1"}), **options
+    )
+    for device_worker in pool.workers:
+        device_worker.requests = queue.Queue()
+    pool.results = queue.Queue()
+    return pool
+
+
+def sent(device_worker):
+    messages = []
+    while not device_worker.requests.empty():
+        messages.append(device_worker.requests.get_nowait())
+    return messages
+
+
+def test_jobs_go_to_the_least_loaded_worker():
+    pool = make_pool()
+    jobs = [pool.submit("ssd-1b", prompt=str(i)) for i in range(3)]
+    assert [job.device for job in jobs] == ["cuda:0", "cuda:1", "cuda:0"]
+    assert [message[3] for message in sent(pool.workers[0])] == [{"prompt": "0"}, {"prompt": "2"}]
+    assert pool.queue_depth() == 3
+    assert pool.get_job(jobs[1].id) is jobs[1]
+
+
+def test_workers_with_the_model_resident_are_preferred_until_busy():
+    pool = make_pool()
+    pool.workers[1].status = {"models": {"sdxl": {"state": GPU}}}
+    # Two batches of one job each are outstanding before the other worker loads the model
+    assert [pool.submit("sdxl", prompt=str(i)).device for i in range(3)] == ["cuda:1", "cuda:1", "cuda:0"]
+
+
+def test_devices_listed_twice_are_kept_apart():
+    pool = make_pool(devices=("cpu", "cpu"))
+    pool.results.put(("heartbeat", 1, {"queue_depth": 3}))
+    thread = threading.Thread(target=pool._collect_results, daemon=True)
+    thread.start()
+    while not pool.results.empty():
+        time.sleep(0.01)
+    pool._stopping.set()
+    thread.join(5)
+    status = pool.status()["devices"]
+    assert list(status) == ["0", "1"]
+    assert status["1"]["device"] == "cpu"
+    assert pool.workers[1].status == {"queue_depth": 3}
+    assert pool.workers[0].status == {}
+
+
+def test_events_are_streamed_only_once_listened_to():
+    pool = make_pool(devices=["cuda:0"])
+    quiet = pool.submit("ssd-1b", prompt="a")
+    assert sent(pool.workers[0])[0][-1] is False
+
+    quiet.add_listener(lambda event, data: None)
+    assert sent(pool.workers[0]) == [("stream", quiet.id)]
+    # Later listeners are already covered
+    quiet.add_listener(lambda event, data: None)
+    assert sent(pool.workers[0]) == []
+
+
+def test_submit_rejects_unknown_models_and_full_workers():
+    pool = make_pool(devices=["cuda:0"], max_jobs_per_device=1)
+    with pytest.raises(KeyError):
+        pool.submit("sd-1.5", prompt="a")
+    pool.submit("ssd-1b", prompt="a")
+    with pytest.raises(QueueFullError):
+        pool.submit("ssd-1b", prompt="b")
+
+
+@pytest.fixture
+def collecting():
+    pool = make_pool()
+    thread = threading.Thread(target=pool._collect_results, daemon=True)
+    thread.start()
+    yield pool
+    pool._stopping.set()
+    thread.join(5)
+
+
+def test_embedding_cache_stats_add_up_the_devices_heartbeats(collecting):
+    pool = collecting
+    first, second = PromptEmbeddingCache(), PromptEmbeddingCache()
+    first.get(("ssd-1b", "a", None))
+    second.put(("ssd-1b", "a", None), (torch.zeros(4),))
+    second.get(("ssd-1b", "a", None))
+    pool.results.put(("heartbeat", 0, {"queue_depth": 0, "embedding_cache": first.stats()}))
+    pool.results.put(("heartbeat", 1, {"queue_depth": 0, "embedding_cache": second.stats()}))
+    deadline = time.time() + 5
+    while len(pool.embedding_cache_stats()["devices"]) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+
+    stats = pool.embedding_cache_stats()
+    assert stats["devices"] == {"0": first.stats(), "1": second.stats()}
+    assert (stats["entries"], stats["bytes"], stats["hits"], stats["misses"]) == (1, 16, 1, 1)
+    assert stats["max_entries"] == 2 * first.max_entries
+
+
+def test_api_reports_the_embedding_caches_of_the_pool(monkeypatch):
+    api = pytest.importorskip("api")
+    from prometheus_client import REGISTRY
+    pool = make_pool()
+    cache = PromptEmbeddingCache()
+    cache.put(("ssd-1b", "a", None), (torch.zeros(4),))
+    for _ in range(3):
+        cache.get(("ssd-1b", "a", None))
+    pool.workers[1].status = {"embedding_cache": cache.stats()}
+    monkeypatch.setattr(api, "worker", pool)
+
+    assert asyncio.run(api.get_embedding_cache_info()) == pool.embedding_cache_stats()
+    assert pool.embedding_cache_stats()["hits"] == 3
+    assert REGISTRY.get_sample_value("ssd_embedding_cache_hits") == 3
+
+    monkeypatch.setattr(api, "QUEUE_BACKEND", "database")
+    with pytest.raises(api.HTTPException) as error:
+        asyncio.run(api.get_embedding_cache_info())
+    assert error.value.status_code == 404
+
+
+def test_results_resolve_jobs(collecting):
+    pool = collecting
+    done, failed = pool.submit("ssd-1b", prompt="a"), pool.submit("ssd-1b", prompt="b")
+    events = []
+    done.add_listener(lambda event, data: events.append((event, data)))
+
+    pool.results.put(("heartbeat", 1, {"queue_depth": 1, "resident_bytes": 10}))
+    pool.results.put(("event", done.id, "progress", {"step": 1, "total_steps": 2}))
+    pool.results.put(("done", done.id, ["image"], {"batch_size": 1, "timings": {"denoise": 0.5}}))
+    pool.results.put(("failed", failed.id, ("RuntimeError", "boom"), {}))
+
+    assert done.future.result(timeout=5) == ["image"]
+    assert done.status == SAVING
+    assert (done.step, done.batch_size, done.timings) == (1, 1, {"denoise": 0.5})
+    assert events == [("progress", {"step": 1, "total_steps": 2})]
+    with pytest.raises(RuntimeError, match="boom"):
+        failed.future.result(timeout=5)
+    assert failed.status == FAILED
+    assert pool.queue_depth() == 0
+    assert pool.resident_bytes() == 10
+
+
+def test_jobs_of_a_crashed_worker_move_to_another(monkeypatch):
+    pool = make_pool(max_job_retries=1)
+    started = []
+    monkeypatch.setattr(pool, "_start_process", started.append)
+    job = pool.submit("ssd-1b", prompt="a")
+    crashed = pool.workers[0]
+    sent(crashed)
+
+    pool._restart(crashed)
+    assert started == [crashed]
+    assert crashed.restarts == 1
+    assert job.device == "cuda:1"
+    assert job.status == QUEUED
+    assert [message[1] for message in sent(pool.workers[1])] == [job.id]
+
+    # Out of retries once the second worker crashes too
+    pool._restart(pool.workers[1])
+    assert job.status == FAILED
+    with pytest.raises(RuntimeError, match="crashed"):
+        job.future.result(timeout=0)
+
+
+def test_pool_runs_jobs_in_worker_processes():
+    loader = functools.partial(FakePipeline, step_ms=0, image_size=16, steps=2)
+    pool = WorkerPool(
+        ["cpu"], {"ssd-1b": loader},
+        settings({"SSD_BATCH_MAX_WAIT_MS": "0"})
+    )
+    pool.start()
+    try:
+        job = pool.submit("ssd-1b", prompt="a cat", negative_prompt="blurry")
+        image, = job.future.result(timeout=120)
+        assert image.size == (16, 16)
+        assert job.device == "cpu"
+        assert "denoise" in job.timings
+    finally:
+        pool.stop(timeout=10)
+
+
+def test_cancel_is_forwarded_to_the_worker_process(collecting):
+    pool = collecting
+    job = pool.submit("ssd-1b", prompt="a", priority=2, client_id="c")
+    message = pool.workers[0].requests.get_nowait()
+    assert message[0] == "submit"
+    assert message[4] == {"priority": 2, "client_id": "c", "deadline": None}
+
+    assert pool.cancel(job.id) is job
+    assert job.cancel_requested.is_set()
+    assert pool.workers[0].requests.get_nowait() == ("cancel", job.id)
+
+    pool.results.put(("cancelled", job.id, "Job was cancelled.", {}))
+    with pytest.raises(JobCancelledError):
+        job.future.result(timeout=5)
+    assert job.status == CANCELLED
+
+
+def test_deadline_is_checked_against_the_chosen_worker():
+    pool = make_pool(devices=["cuda:0"])
+    pool.workers[0].status = {"batch_seconds": 10.0}
+    pool.submit("ssd-1b", prompt="a")
+    with pytest.raises(DeadlineError):
+        pool.submit("ssd-1b", prompt="b", deadline=time.time() + 15)
+
+
+def test_deadline_rejections_of_a_worker_keep_their_type(collecting):
+    pool = collecting
+    job = pool.submit("ssd-1b", prompt="a", deadline=time.time() + 5)
+    pool.results.put(("deadline", job.id, ("Deadline is shorter than the time a generation takes.", None), {}))
+    with pytest.raises(DeadlineError) as error:
+        job.future.result(timeout=5)
+    assert error.value.retry_after is None
+    assert job.status == FAILED
+
+
+@pytest.mark.parametrize("error", [MemoryBudgetError("Request needs more memory than the device has."), KeyError("Unknown model: sdxl")])
+def test_failures_keep_the_types_the_api_answers_for(collecting, error):
+    pool = collecting
+    job = pool.submit("ssd-1b", prompt="a")
+    pool.results.put(("failed", job.id, describe_failure(error), {}))
+    with pytest.raises(type(error)) as raised:
+        job.future.result(timeout=5)
+    assert raised.value.args == error.args
+    assert job.error == error.args[0]
@@ -0,0 +1,639 @@
+from concurrent.futures import Future
+from contextlib import nullcontext
+from collections import OrderedDict
+import threading
+import queue
+import math
+from metrics import observe_stage, STEP_SECONDS, BATCH_SIZE, MEMORY_LEVELS, OOM_RETRIES
+from admission import AdmissionController, LEVELS, CPU_OFFLOAD, memory_level, is_out_of_memory
+from embedding_cache import PromptEmbeddingCache
+from model_registry import ModelRegistry
+from schedulers import SchedulerCache
+from previews import preview_base64
+from scheduler import JobQueue
+from latents import vae_decode
+import torch
+import time
+import uuid
+import os
+
+
+# Job lifecycle states
+QUEUED = "queued"
+RUNNING = "running"
+SAVING = "saving"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+# Per-job parameters that can differ within one batched pipeline call
+BATCHED_PARAMS = ("prompt", "negative_prompt", "seed")
+
+
+class QueueFullError(Exception):
+    """
+    Raised when the generation queue cannot accept any more jobs.
+    """
+
+
+class DeadlineError(Exception):
+    """
+    Raised when a job would not finish before its deadline. `retry_after` is the estimated
+    seconds until the queue is short enough, or None when the generation alone takes longer.
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def check_deadline(deadline, wait, batch_seconds):
+    """
+    Raises DeadlineError if a job that starts after `wait` seconds and runs for `batch_seconds`
+    would finish after `deadline`. Nothing is checked before a batch has been timed.
+    """
+    if wait is None or batch_seconds is None:
+        return
+    slack = deadline - time.time() - batch_seconds
+    if slack < 0:
+        raise DeadlineError("Deadline is shorter than the time a generation takes.", None)
+    if wait > slack:
+        raise DeadlineError("Generation queue is too long to meet the deadline.", wait - slack)
+
+
+class JobCancelledError(Exception):
+    """
+    Set on the future of a job that was cancelled, abandoned by its client or ran past its deadline.
+    """
+
+
+class Job:
+    """
+    A single generation request handed to the worker thread.
+    """
+
+    def __init__(self, model, params, priority=0, client_id=None, deadline=None):
+        self.id = str(uuid.uuid4())
+        self.model = model
+        self.params = params
+        # Higher priorities run first, clients of equal priority take turns
+        self.priority = priority
+        self.client_id = client_id
+        # Absolute time.time() after which the result is no longer wanted
+        self.deadline = deadline
+        self.cancel_requested = threading.Event()
+        self.status = QUEUED
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.batch_size = None
+        self.cache_key = None
+        self.cached = False
+        self.step = 0
+        self.total_steps = None
+        # Seconds spent in each stage, see metrics.STAGES
+        self.timings = {}
+        # Called from the worker thread with (event, data) progress events
+        self.listeners = []
+        # Called with the job when it gets its first listener, for workers that only send events on demand
+        self.on_listen = None
+        # Resolved by the worker thread with the list of generated images
+        self.future = Future()
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "model": self.model,
+            "status": self.status,
+            "priority": self.priority,
+            "deadline": self.deadline,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "batch_size": self.batch_size,
+            "cached": self.cached,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "timings": self.timings,
+        }
+
+    def abandoned(self):
+        """
+        True once nobody wants the result any more, so its GPU time is better spent elsewhere.
+        """
+        return self.cancel_requested.is_set() or (self.deadline is not None and time.time() > self.deadline)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        if len(self.listeners) == 1 and self.on_listen is not None:
+            self.on_listen(self)
+
+    def emit(self, event, data):
+        for listener in list(self.listeners):
+            listener(event, data)
+
+    def batch_key(self):
+        """
+        Jobs with equal keys can share one pipeline call: same model, same shared
+        parameters (resolution, steps, ...) and the same use of a negative prompt.
+        """
+        if "latents" in self.params:
+            # Decodes of stored latents run one at a time
+            return (self.model, "decode", self.id)
+        shared = tuple(sorted(
+            (name, value) for name, value in self.params.items() if name not in BATCHED_PARAMS
+        ))
+        return (self.model, shared, "negative_prompt" in self.params)
+
+
+class GenerationWorker(threading.Thread):
+    """
+    Owns the model registry and runs every generation on a dedicated thread,
+    so the event loop never blocks on a load or a denoise.
+
+    Waiting jobs are served by priority, with clients of equal priority taking turns.
+    Compatible jobs arriving within `max_wait_ms` of each other are grouped into
+    a single list-of-prompts pipeline call of up to `max_batch_size` prompts.
+    A batch whose jobs are all cancelled or past their deadline stops at the next step.
+
+    With an admission controller, batches are capped to what fits the device and
+    each call runs with just enough memory-saving options to fit; a call that still
+    runs out of memory is retried at the next, more frugal level.
+    """
+
+    def __init__(self, registry, max_queue_size=16, max_retained_jobs=1000,
+                 max_batch_size=4, max_wait_ms=50, embedding_cache=None,
+                 preview_every=5, preview_fn=None, admission=None, schedulers=None):
+        super().__init__(name="generation-worker", daemon=True)
+        self.registry = registry
+        self.embedding_cache = embedding_cache
+        self.admission = admission
+        # Swaps in the scheduler a job asks for by name, see schedulers.SchedulerCache
+        self.schedulers = schedulers
+        # Jobs with listeners get a preview every `preview_every` steps, built by `preview_fn(latents)`
+        self.preview_every = preview_every
+        self.preview_fn = preview_fn
+        self.queue = JobQueue(maxsize=max_queue_size)
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        # Moving average of the seconds a batch takes, for queue time estimates
+        self.batch_seconds = None
+        self._running = None
+        self.jobs = OrderedDict()
+        self.max_retained_jobs = max_retained_jobs
+        self._jobs_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def submit(self, model, priority=0, client_id=None, deadline=None, **params):
+        """
+        Queues a generation job and returns it immediately. Jobs that would not
+        finish before their `deadline` are rejected up front.
+        """
+        if model not in self.registry:
+            raise KeyError(f"Unknown model: {model}")
+        if self.admission is not None and "latents" not in params:
+            self.admission.check(model, params)
+
+        if deadline is not None:
+            check_deadline(deadline, self.estimate_wait(priority), self.batch_seconds)
+
+        job = Job(model, params, priority, client_id, deadline)
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFullError("Generation queue is full, try again later.")
+
+        with self._jobs_lock:
+            self.jobs[job.id] = job
+            self._prune_jobs()
+        return job
+
+    def track(self, job):
+        """
+        Registers a job that was resolved without running, e.g. from the result cache.
+        """
+        with self._jobs_lock:
+            self.jobs[job.id] = job
+            self._prune_jobs()
+
+    def get_job(self, job_id):
+        with self._jobs_lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancels a job: a waiting job leaves the queue, a running one stops at its
+        next denoising step unless other jobs in its batch still need it.
+        Returns the job, or None if it is unknown.
+        """
+        job = self.get_job(job_id)
+        if job is None:
+            return None
+        job.cancel_requested.set()
+        if self.queue.remove(job):
+            self._finish_cancelled(job)
+        return job
+
+    def queue_depth(self):
+        return len(self.queue)
+
+    def estimate_wait(self, priority=0):
+        """
+        Estimates the seconds until a new job of this priority would start, once a batch has been timed.
+        """
+        if self.batch_seconds is None:
+            return None
+        batches_ahead = math.ceil(self.queue.count_ahead(priority) / self.max_batch_size)
+        if self._running is not None:
+            batches_ahead += 1
+        return batches_ahead * self.batch_seconds
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        # The thread notices within a second, its queue waits time out
+        self.join(timeout)
+
+    def run(self):
+        while not self._stopping.is_set():
+            batch = []
+            try:
+                batch = self._collect_batch()
+                if batch:
+                    self._run_batch(batch)
+            except Exception as e:
+                # This is the only generation thread, it must outlive any one batch
+                print(f"Error occurred in generation worker: {str(e)}")
+                for job in batch:
+                    if not job.future.done():
+                        job.status = FAILED
+                        job.error = str(e)
+                        job.finished_at = time.time()
+                        job.future.set_exception(e)
+
+    def _collect_batch(self):
+        """
+        Takes the next job plus every compatible waiting job, and any that arrive
+        within the batching window, in scheduling order.
+        """
+        first = self._next_job()
+        if first is None:
+            return []
+
+        batch = [first]
+        key = first.batch_key()
+        max_batch_size = self.max_batch_size
+        if self.admission is not None:
+            max_batch_size = self.admission.max_batch_size(first.model, first.params, max_batch_size)
+
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            job = self._next_job(timeout=remaining, match=lambda job: job.batch_key() == key)
+            if job is None:
+                break
+            batch.append(job)
+        return batch
+
+    def _next_job(self, timeout=1.0, match=None):
+        # Jobs nobody wants any more are dropped here rather than run
+        while True:
+            job = self.queue.get(timeout=timeout, match=match)
+            if job is None:
+                if match is None:
+                    # Nothing to do, use the time to release idle models
+                    self.registry.evict_idle()
+                return None
+            if not job.abandoned():
+                return job
+            self._finish_cancelled(job)
+
+    def _finish_cancelled(self, job):
+        job.status = CANCELLED
+        job.error = "Job passed its deadline." if not job.cancel_requested.is_set() else "Job was cancelled."
+        job.finished_at = time.time()
+        job.future.set_exception(JobCancelledError(job.error))
+
+    def _run_batch(self, batch):
+        # Jobs cancelled while the batch was being collected
+        for job in [job for job in batch if job.abandoned()]:
+            batch.remove(job)
+            self._finish_cancelled(job)
+        if not batch:
+            return
+        if "latents" in batch[0].params:
+            self._run_decode(batch[0])
+            return
+
+        first = batch[0]
+        self._running = batch
+        started_at = time.time()
+        for job in batch:
+            job.status = RUNNING
+            job.started_at = started_at
+            job.batch_size = len(batch)
+            observe_stage(job, "queue_wait", started_at - job.created_at)
+        BATCH_SIZE.labels(first.model).observe(len(batch))
+
+        # Shared parameters come from any job, the prompts are passed as lists
+        params = {name: value for name, value in first.params.items() if name not in BATCHED_PARAMS}
+        scheduler = params.pop("scheduler", None)
+        prompts = [job.params["prompt"] for job in batch]
+        negative_prompts = None
+        if "negative_prompt" in first.params:
+            negative_prompts = [job.params["negative_prompt"] for job in batch]
+
+        seeds = [job.params.get("seed") for job in batch]
+
+        try:
+            stage_start = time.perf_counter()
+            with self.registry.use(first.model) as pipeline:
+                self._observe_batch(batch, "model_load", time.perf_counter() - stage_start)
+
+                if self.embedding_cache is not None:
+                    # Repeated prompts reuse cached text encoder outputs
+                    stage_start = time.perf_counter()
+                    params.update(self.embedding_cache.encode_batch(pipeline, prompts, negative_prompts))
+                    self._observe_batch(batch, "text_encoding", time.perf_counter() - stage_start)
+                else:
+                    params["prompt"] = prompts
+                    if negative_prompts is not None:
+                        params["negative_prompt"] = negative_prompts
+
+                level = LEVELS[0]
+                if self.admission is not None:
+                    # Idle models on the device are moved off before the call is slowed down to fit
+                    level = self.admission.plan(
+                        first.model, first.params, len(batch), evict=lambda: self.registry.evict_unused(first.model)
+                    )
+                while True:
+                    try:
+                        images, denoise_seconds, decode_seconds = self._call_pipeline(
+                            pipeline, batch, params, seeds, level, scheduler
+                        )
+                        break
+                    except Exception as e:
+                        if self.admission is None or not is_out_of_memory(e) or level == CPU_OFFLOAD:
+                            raise
+                    # Retry outside the except block so the failed call's tensors can be freed
+                    torch.cuda.empty_cache()
+                    self.admission.raise_scale(first.model)
+                    level = LEVELS[LEVELS.index(level) + 1]
+                    OOM_RETRIES.labels(first.model).inc()
+                    print(f"Out of memory, retrying {first.model} batch with {level}...")
+
+            self._observe_batch(batch, "denoise", denoise_seconds)
+            self._observe_batch(batch, "vae_decode", decode_seconds)
+
+            if params.get("output_type") == "latent":
+                # Latents are stored in fp16 and may have to cross to another process
+                images = [latents.to("cpu", torch.float16) for latents in images]
+        except JobCancelledError:
+            print(f"Stopped {first.model} batch of {len(batch)} prompt(s), nobody is waiting for it")
+            for job in batch:
+                self._finish_cancelled(job)
+            return
+        except Exception as e:
+            print(f"Error occurred in generation batch: {str(e)}")
+            for job in batch:
+                job.status = FAILED
+                job.error = str(e)
+                job.finished_at = time.time()
+                job.future.set_exception(e)
+            return
+        finally:
+            self._running = None
+
+        seconds = time.time() - started_at
+        self.batch_seconds = seconds if self.batch_seconds is None else 0.8 * self.batch_seconds + 0.2 * seconds
+
+        # Fan the images back out, one per job in submission order
+        for job, image in zip(batch, images):
+            if job.abandoned():
+                self._finish_cancelled(job)
+                continue
+            job.status = SAVING
+            job.future.set_result([image])
+
+    def _run_decode(self, job):
+        """
+        Decodes the stored latents of a job with its model's VAE, on this thread like every other use of the pipelines.
+        """
+        self._running = [job]
+        job.status = RUNNING
+        job.started_at = time.time()
+        observe_stage(job, "queue_wait", job.started_at - job.created_at)
+        latents = job.params["latents"]
+        # The decode is planned like a batch of one at the latents' resolution
+        size = {"width": latents.shape[-1] * 8, "height": latents.shape[-2] * 8}
+        try:
+            stage_start = time.perf_counter()
+            with self.registry.use(job.model) as pipeline:
+                observe_stage(job, "model_load", time.perf_counter() - stage_start)
+                level = LEVELS[0]
+                if self.admission is not None:
+                    level = self.admission.plan(job.model, size, 1, evict=lambda: self.registry.evict_unused(job.model))
+                while True:
+                    MEMORY_LEVELS.labels(job.model, level).inc()
+                    try:
+                        stage_start = time.perf_counter()
+                        with memory_level(pipeline, level, self.registry.device):
+                            image = vae_decode(pipeline, latents)
+                        observe_stage(job, "vae_decode", time.perf_counter() - stage_start)
+                        break
+                    except Exception as e:
+                        if self.admission is None or not is_out_of_memory(e) or level == CPU_OFFLOAD:
+                            raise
+                    torch.cuda.empty_cache()
+                    level = LEVELS[LEVELS.index(level) + 1]
+                    OOM_RETRIES.labels(job.model).inc()
+                    print(f"Out of memory, retrying {job.model} decode with {level}...")
+        except Exception as e:
+            print(f"Error occurred decoding latents: {str(e)}")
+            job.status = FAILED
+            job.error = str(e)
+            job.finished_at = time.time()
+            job.future.set_exception(e)
+            return
+        finally:
+            self._running = None
+        job.status = SAVING
+        job.future.set_result([image])
+
+    def _call_pipeline(self, pipeline, batch, params, seeds, level, scheduler=None):
+        """
+        Runs one pipeline call at a memory level with the named scheduler, returning
+        the images and the seconds spent denoising and decoding.
+        """
+        params = dict(params)
+        # Seeded jobs get their own CPU generator so their image does not depend on the batch.
+        # They are rebuilt for every attempt so a retried call produces the same images.
+        if any(seed is not None for seed in seeds):
+            generators = []
+            for seed in seeds:
+                generator = torch.Generator()
+                if seed is None:
+                    generator.seed()
+                else:
+                    generator.manual_seed(seed)
+                generators.append(generator)
+            params["generator"] = generators
+
+        # The step callback records when each step ends, splitting the call into denoise and decode
+        step_times = {"last": None}
+        params["callback_on_step_end"] = self._step_callback(batch, step_times)
+        params["callback_on_step_end_tensor_inputs"] = ["latents"]
+
+        model = batch[0].model
+        MEMORY_LEVELS.labels(model, level).inc()
+        print(f"Running {model} batch of {len(batch)} prompt(s) ({level})...")
+        if self.schedulers is not None:
+            scheduler_context = self.schedulers.use(pipeline, model, scheduler)
+        elif scheduler not in (None, "default"):
+            raise ValueError("This worker cannot change schedulers.")
+        else:
+            scheduler_context = nullcontext()
+        with scheduler_context, memory_level(pipeline, level, self.registry.device):
+            measure = self.admission.measure(model, batch[0].params, len(batch), level) if self.admission else nullcontext()
+            with measure:
+                stage_start = time.perf_counter()
+                images = pipeline(**params).images
+                stage_end = time.perf_counter()
+
+        last_step = step_times["last"] or stage_end
+        return images, last_step - stage_start, stage_end - last_step
+
+    def _observe_batch(self, batch, stage, seconds):
+        for job in batch:
+            observe_stage(job, stage, seconds)
+
+    def _step_callback(self, batch, step_times):
+        """
+        Builds the pipeline step callback that times each step and reports progress
+        and latent previews per job.
+        """
+        def callback(pipeline, step, timestep, callback_kwargs):
+            latents = callback_kwargs.get("latents")
+            # Wait for the queued kernels so the step time is real GPU time
+            if latents is not None and latents.is_cuda:
+                torch.cuda.synchronize(latents.device)
+            now = time.perf_counter()
+            if step_times["last"] is not None:
+                STEP_SECONDS.labels(batch[0].model).observe(now - step_times["last"])
+            step_times["last"] = now
+
+            total_steps = getattr(pipeline, "num_timesteps", None)
+            for index, job in enumerate(batch):
+                job.step = step + 1
+                job.total_steps = total_steps
+                if not job.listeners:
+                    continue
+                job.emit("progress", {"step": job.step, "total_steps": total_steps})
+                if (self.preview_fn is not None and latents is not None and self.preview_every
+                        and job.step % self.preview_every == 0 and job.step != total_steps):
+                    try:
+                        job.emit("preview", {"step": job.step, "image": self.preview_fn(latents[index])})
+                    except Exception as e:
+                        print(f"Error building preview for job {job.id}: {str(e)}")
+
+            # Abort the call, skipping the remaining steps and the decode, once every job is abandoned
+            if all(job.abandoned() for job in batch):
+                raise JobCancelledError("Every job in the batch was cancelled.")
+            return callback_kwargs
+        return callback
+
+    def _prune_jobs(self):
+        # Forget the oldest finished jobs once we hold more than we should
+        while len(self.jobs) > self.max_retained_jobs:
+            oldest_id, oldest = next(iter(self.jobs.items()))
+            if oldest.status not in (COMPLETED, FAILED, CANCELLED):
+                break
+            del self.jobs[oldest_id]
+
+
+def worker_settings(environ=None):
+    """
+    Reads the SSD_* settings of a generation worker: its device, model residency,
+    batching, embedding cache and admission control. Every process that generates
+    (the API, the worker pool's device processes, queue workers and the batch CLI)
+    builds its worker from these, see `build_worker`.
+    """
+    environ = os.environ if environ is None else environ
+    memory_budget_mb = environ.get("SSD_GPU_MEMORY_BUDGET_MB")
+    idle_seconds = environ.get("SSD_MODEL_IDLE_SECONDS")
+    return {
+        "device": environ.get("SSD_DEVICE", "cuda:0"),
+        # How much device memory the pipelines may occupy
+        "memory_budget_bytes": int(memory_budget_mb) * 1024 * 1024 if memory_budget_mb else None,
+        # Models idle for this long are moved off the device, either to CPU or out of memory
+        "idle_seconds": float(idle_seconds) if idle_seconds else None,
+        "eviction": environ.get("SSD_MODEL_EVICTION", "cpu"),
+        # Maximum number of generation jobs allowed to wait in the queue
+        "max_queue_size": int(environ.get("SSD_MAX_QUEUE_SIZE", "16")),
+        # Batching window: up to max_batch_size compatible prompts arriving within max_wait_ms share one call
+        "max_batch_size": int(environ.get("SSD_MAX_BATCH_SIZE", "4")),
+        "max_wait_ms": float(environ.get("SSD_BATCH_MAX_WAIT_MS", "50")),
+        # Prompt embedding cache bounds, shared by every model
+        "embedding_cache_entries": int(environ.get("SSD_EMBEDDING_CACHE_ENTRIES", "256")),
+        "embedding_cache_bytes": int(environ.get("SSD_EMBEDDING_CACHE_MB", "256")) * 1024 * 1024,
+        # Memory kept free for the allocator and other processes when admitting work. Requests are
+        # batched and run with slicing, tiling or CPU offload only as far as needed to fit the rest.
+        "admission_control": environ.get("SSD_ADMISSION_CONTROL", "1") == "1",
+        "memory_headroom_bytes": int(environ.get("SSD_MEMORY_HEADROOM_MB", "512")) * 1024 * 1024,
+        # Streaming clients get a cheap latent preview every this many denoising steps
+        "preview_every": int(environ.get("SSD_PREVIEW_EVERY_N_STEPS", "5")),
+    }
+
+
+def build_worker(loaders, settings, release_unused=None):
+    """
+    Builds a generation worker for the models of `loaders` from `worker_settings()`,
+    with its model registry, embedding cache, schedulers and admission controller.
+    The worker is returned unstarted; its parts are attributes of it.
+
+    Whenever a model is unloaded, `release_unused` (e.g. pipelines.release_shared_components)
+    is called with the pipelines still loaded, to free what only the unloaded one used.
+    """
+    embedding_cache = PromptEmbeddingCache(
+        max_entries=settings["embedding_cache_entries"],
+        max_bytes=settings["embedding_cache_bytes"]
+    )
+    # Scheduler instances per model, swapped in per call by name
+    schedulers = SchedulerCache()
+
+    def clear_model_caches(model):
+        # Schedulers belong to the pipeline being unloaded, cached embeddings to its
+        # text encoders, which other loaded pipelines may still share
+        loaded = [entry.pipeline for entry in registry.entries.values() if entry.pipeline is not None]
+        embedding_cache.release(loaded)
+        schedulers.clear(model)
+        if release_unused is not None:
+            release_unused(loaded)
+
+    registry = ModelRegistry(
+        loaders,
+        device=settings["device"],
+        memory_budget_bytes=settings["memory_budget_bytes"],
+        idle_seconds=settings["idle_seconds"],
+        eviction=settings["eviction"],
+        on_unload=clear_model_caches
+    )
+    admission = None
+    if settings["admission_control"]:
+        admission = AdmissionController(settings["device"], settings["memory_headroom_bytes"])
+    return GenerationWorker(
+        registry,
+        max_queue_size=settings["max_queue_size"],
+        max_batch_size=settings["max_batch_size"],
+        max_wait_ms=settings["max_wait_ms"],
+        embedding_cache=embedding_cache,
+        preview_every=settings["preview_every"],
+        preview_fn=preview_base64,
+        admission=admission,
+        schedulers=schedulers
+    )
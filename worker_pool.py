@@ -0,0 +1,406 @@
+from worker import Job, QueueFullError, DeadlineError, JobCancelledError, build_worker, check_deadline
+from worker import QUEUED, RUNNING, SAVING, COMPLETED, FAILED, CANCELLED
+from model_registry import GPU
+from embedding_cache import combine_stats
+from admission import MemoryBudgetError
+from collections import OrderedDict
+from metrics import STAGE_SECONDS
+import multiprocessing
+import threading
+import queue
+import math
+import time
+
+
+# Failures of a device worker raised again with their own type in the pool's process,
+# so the API can answer 413 or 400 rather than 500; any other failure becomes a RuntimeError
+FAILURE_TYPES = {error.__name__: error for error in (MemoryBudgetError, KeyError)}
+
+
+def describe_failure(error):
+    """
+    Returns the (type name, message) a device worker sends for a failed job.
+    """
+    # str() of a KeyError quotes its message
+    message = error.args[0] if isinstance(error, KeyError) and error.args else error
+    return type(error).__name__, str(message)
+
+
+def device_worker_main(index, device, loaders, options, requests, results):
+    """
+    Entry point of a device worker process: owns its own pipelines on one device
+    and runs the jobs the pool hands it on a local GenerationWorker. Progress events
+    and previews are only built and sent for jobs the pool asks to stream.
+    """
+    worker = build_worker(loaders, dict(options["settings"], device=device), options["release_unused"])
+    registry = worker.registry
+    worker.start()
+    if options["preload"]:
+        # Load in the background so heartbeats start right away
+        threading.Thread(target=registry.preload, args=(options["preload"],), name="preload", daemon=True).start()
+
+    def heartbeat():
+        while True:
+            status = registry.status()
+            results.put(("heartbeat", index, {
+                "queue_depth": worker.queue_depth(),
+                "batch_seconds": worker.batch_seconds,
+                "models": status["models"],
+                "resident_bytes": status["resident_bytes"],
+                "embedding_cache": worker.embedding_cache.stats(),
+            }))
+            time.sleep(options["heartbeat_interval"])
+
+    threading.Thread(target=heartbeat, name="heartbeat", daemon=True).start()
+
+    # Local job of every pool job id still running here
+    jobs = {}
+
+    def stream(job_id, job):
+        if not job.listeners:
+            job.add_listener(lambda event, data: results.put(("event", job_id, event, data)))
+
+    def send_result(job_id, job, future):
+        jobs.pop(job_id, None)
+        if isinstance(future.exception(), JobCancelledError):
+            results.put(("cancelled", job_id, str(future.exception()), job.to_dict()))
+        elif future.exception() is not None:
+            results.put(("failed", job_id, describe_failure(future.exception()), job.to_dict()))
+        else:
+            results.put(("done", job_id, future.result(), job.to_dict()))
+
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        if message[0] == "cancel":
+            job = jobs.get(message[1])
+            if job is not None:
+                worker.cancel(job.id)
+            continue
+        if message[0] == "stream":
+            job = jobs.get(message[1])
+            if job is not None:
+                stream(message[1], job)
+            continue
+
+        _, job_id, model, params, schedule, streamed = message
+        try:
+            job = worker.submit(model, **schedule, **params)
+        except DeadlineError as e:
+            # Sent apart from other failures so the client still gets 429 or 422
+            results.put(("deadline", job_id, (str(e), e.retry_after), {}))
+            continue
+        except Exception as e:
+            results.put(("failed", job_id, describe_failure(e), {}))
+            continue
+        jobs[job_id] = job
+        if streamed:
+            stream(job_id, job)
+        job.future.add_done_callback(lambda future, job_id=job_id, job=job: send_result(job_id, job, future))
+
+    worker.stop(timeout=5)
+
+
+class DeviceWorker:
+    """
+    The pool's handle on one device worker process and the jobs it is running.
+    """
+
+    def __init__(self, index, device):
+        self.index = index
+        self.device = device
+        self.process = None
+        self.requests = None
+        self.outstanding = {}
+        self.last_heartbeat = None
+        self.status = {}
+        self.restarts = 0
+
+    def load(self):
+        return len(self.outstanding)
+
+    def has_resident(self, model):
+        return self.status.get("models", {}).get(model, {}).get("state") == GPU
+
+
+class WorkerPool:
+    """
+    Runs one worker process per configured device (e.g. "cuda:0,cuda:1", or "cpu"
+    for testing) and dispatches each job to the least-loaded worker that already has
+    the requested model resident. Only when every such worker has `resident_max_load`
+    or more outstanding jobs (default two batches) does a job go to a worker that has
+    to load the model. Workers that die or stop sending heartbeats are restarted and
+    their jobs handed to another worker.
+
+    Offers the same submit/get_job/track/queue_depth interface as GenerationWorker.
+    Each process builds its worker from `settings` (see worker.worker_settings) on its own device,
+    passing it `release_unused` (see worker.build_worker), which must be picklable.
+    """
+
+    def __init__(self, devices, loaders, settings, preload_models=(), max_jobs_per_device=16, max_retained_jobs=1000,
+                 heartbeat_interval=1.0, heartbeat_timeout=30.0, max_job_retries=1, resident_max_load=None,
+                 release_unused=None):
+        self.loaders = loaders
+        self.options = {
+            "settings": settings,
+            "preload": list(preload_models),
+            "heartbeat_interval": heartbeat_interval,
+            "release_unused": release_unused,
+        }
+        self.max_jobs_per_device = max_jobs_per_device
+        self.max_batch_size = max(1, settings["max_batch_size"])
+        self.resident_max_load = resident_max_load or 2 * self.max_batch_size
+        self.max_retained_jobs = max_retained_jobs
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_job_retries = max_job_retries
+        # Spawned children start clean instead of inheriting CUDA state from the parent
+        self.context = multiprocessing.get_context("spawn")
+        self.results = self.context.Queue()
+        self.workers = [DeviceWorker(index, device) for index, device in enumerate(devices)]
+        self.jobs = OrderedDict()
+        self._lock = threading.RLock()
+        self._stopping = threading.Event()
+
+    def __contains__(self, model):
+        return model in self.loaders
+
+    def start(self):
+        for device_worker in self.workers:
+            self._start_process(device_worker)
+        threading.Thread(target=self._collect_results, name="pool-results", daemon=True).start()
+        threading.Thread(target=self._monitor, name="pool-monitor", daemon=True).start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        for device_worker in self.workers:
+            device_worker.requests.put(None)
+        for device_worker in self.workers:
+            device_worker.process.join(timeout)
+            if device_worker.process.is_alive():
+                device_worker.process.terminate()
+
+    def submit(self, model, priority=0, client_id=None, deadline=None, **params):
+        """
+        Dispatches a job to a worker process and returns it immediately.
+        """
+        if model not in self.loaders:
+            raise KeyError(f"Unknown model: {model}")
+
+        job = Job(model, params, priority, client_id, deadline)
+        job.attempts = 0
+        job.on_listen = self._stream
+        with self._lock:
+            self._dispatch(job, enforce_deadline=True)
+            self.jobs[job.id] = job
+            self._prune_jobs()
+        return job
+
+    def track(self, job):
+        with self._lock:
+            self.jobs[job.id] = job
+            self._prune_jobs()
+
+    def get_job(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Asks the worker process running a job to cancel it. Returns the job, or None if it is unknown.
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job.cancel_requested.set()
+            device_worker = self._find_worker(job_id)
+            if device_worker is not None:
+                device_worker.requests.put(("cancel", job_id))
+        return job
+
+    def queue_depth(self):
+        return sum(device_worker.load() for device_worker in self.workers)
+
+    def resident_bytes(self):
+        return sum(device_worker.status.get("resident_bytes") or 0 for device_worker in self.workers)
+
+    def embedding_cache_stats(self):
+        """
+        Adds up the prompt embedding caches of the device workers as of their last heartbeats,
+        and lists each one under "devices".
+        """
+        devices = {
+            str(device_worker.index): device_worker.status["embedding_cache"]
+            for device_worker in self.workers
+            if "embedding_cache" in device_worker.status
+        }
+        return {**combine_stats(list(devices.values())), "devices": devices}
+
+    def status(self):
+        return {
+            # Keyed by position, a device can be listed more than once
+            "devices": {
+                str(device_worker.index): {
+                    "device": device_worker.device,
+                    "alive": device_worker.process is not None and device_worker.process.is_alive(),
+                    "outstanding_jobs": device_worker.load(),
+                    "last_heartbeat": device_worker.last_heartbeat,
+                    "restarts": device_worker.restarts,
+                    **device_worker.status,
+                }
+                for device_worker in self.workers
+            },
+            "queue_depth": self.queue_depth(),
+        }
+
+    def _dispatch(self, job, exclude=None, enforce_deadline=False):
+        candidates = [
+            device_worker for device_worker in self.workers
+            if device_worker is not exclude and device_worker.load() < self.max_jobs_per_device
+        ]
+        if not candidates:
+            raise QueueFullError("All generation workers are busy, try again later.")
+
+        # A worker holding the model, unless they are all busy, so models are not loaded or evicted needlessly
+        resident = [
+            device_worker for device_worker in candidates
+            if device_worker.has_resident(job.model) and device_worker.load() < self.resident_max_load
+        ]
+        device_worker = min(resident or candidates, key=lambda w: (w.load(), not w.has_resident(job.model)))
+        batch_seconds = device_worker.status.get("batch_seconds")
+        if enforce_deadline and job.deadline is not None and batch_seconds is not None:
+            wait = math.ceil(device_worker.load() / self.max_batch_size) * batch_seconds
+            check_deadline(job.deadline, wait, batch_seconds)
+        job.device = device_worker.device
+        job.attempts += 1
+        device_worker.outstanding[job.id] = job
+        schedule = {"priority": job.priority, "client_id": job.client_id, "deadline": job.deadline}
+        device_worker.requests.put(("submit", job.id, job.model, job.params, schedule, bool(job.listeners)))
+
+    def _stream(self, job):
+        # The first listener of a running job: have its worker start sending events
+        with self._lock:
+            device_worker = self._find_worker(job.id)
+            if device_worker is not None:
+                device_worker.requests.put(("stream", job.id))
+
+    def _start_process(self, device_worker):
+        device_worker.requests = self.context.Queue()
+        device_worker.last_heartbeat = time.time()
+        device_worker.status = {}
+        device_worker.process = self.context.Process(
+            target=device_worker_main,
+            args=(device_worker.index, device_worker.device, self.loaders, self.options, device_worker.requests, self.results),
+            name=f"generation-worker-{device_worker.device}",
+            daemon=True
+        )
+        device_worker.process.start()
+        print(f"Started generation worker process for {device_worker.device}...")
+
+    def _find_worker(self, job_id):
+        for device_worker in self.workers:
+            if job_id in device_worker.outstanding:
+                return device_worker
+        return None
+
+    def _collect_results(self):
+        while not self._stopping.is_set():
+            try:
+                message = self.results.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+            kind = message[0]
+            with self._lock:
+                if kind == "heartbeat":
+                    _, index, status = message
+                    self.workers[index].last_heartbeat = time.time()
+                    self.workers[index].status = status
+                    continue
+
+                job_id = message[1]
+                device_worker = self._find_worker(job_id)
+                job = device_worker.outstanding.get(job_id) if device_worker else None
+                if job is None:
+                    continue
+
+                if kind == "event":
+                    _, _, event, data = message
+                    job.status = RUNNING
+                    job.step = data.get("step", job.step)
+                    job.total_steps = data.get("total_steps", job.total_steps)
+                    job.emit(event, data)
+                    continue
+
+                del device_worker.outstanding[job_id]
+
+            _, _, payload, details = message
+            self._copy_details(job, details)
+            if kind == "done":
+                job.status = SAVING
+                job.future.set_result(payload)
+            elif kind == "deadline":
+                job.status = FAILED
+                job.error = payload[0]
+                job.finished_at = time.time()
+                job.future.set_exception(DeadlineError(*payload))
+            elif kind == "cancelled":
+                job.status = CANCELLED
+                job.error = payload
+                job.finished_at = time.time()
+                job.future.set_exception(JobCancelledError(payload))
+            else:
+                error_type, job.error = payload
+                job.status = FAILED
+                job.finished_at = time.time()
+                job.future.set_exception(FAILURE_TYPES.get(error_type, RuntimeError)(job.error))
+
+    def _copy_details(self, job, details):
+        for name in ("started_at", "batch_size", "timings"):
+            if details.get(name) is not None:
+                setattr(job, name, details[name])
+        # Stage histograms live in this process, /metrics never sees the children's
+        for stage, seconds in job.timings.items():
+            STAGE_SECONDS.labels(stage, job.model).observe(seconds)
+
+    def _monitor(self):
+        while not self._stopping.wait(1.0):
+            for device_worker in self.workers:
+                alive = device_worker.process.is_alive()
+                stale = time.time() - device_worker.last_heartbeat > self.heartbeat_timeout
+                if alive and not stale:
+                    continue
+                print(f"Generation worker for {device_worker.device} is {'unresponsive' if alive else 'dead'}, restarting...")
+                if alive:
+                    device_worker.process.terminate()
+                    device_worker.process.join(5)
+                self._restart(device_worker)
+
+    def _restart(self, device_worker):
+        with self._lock:
+            orphaned = list(device_worker.outstanding.values())
+            device_worker.outstanding.clear()
+            device_worker.restarts += 1
+            self._start_process(device_worker)
+
+            # Hand the lost jobs to another worker, or fail them once out of retries
+            for job in orphaned:
+                if job.attempts <= self.max_job_retries:
+                    job.status = QUEUED
+                    try:
+                        self._dispatch(job, exclude=device_worker if len(self.workers) > 1 else None)
+                        continue
+                    except QueueFullError:
+                        pass
+                job.status = FAILED
+                job.error = f"Generation worker for {device_worker.device} crashed."
+                job.finished_at = time.time()
+                job.future.set_exception(RuntimeError(job.error))
+
+    def _prune_jobs(self):
+        while len(self.jobs) > self.max_retained_jobs:
+            oldest_id, oldest = next(iter(self.jobs.items()))
+            if oldest.status not in (COMPLETED, FAILED, CANCELLED):
+                break
+            del self.jobs[oldest_id]